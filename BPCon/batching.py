@@ -0,0 +1,81 @@
+import asyncio
+
+from BPCon.metrics import REGISTRY
+from BPCon.protocol import valid_op
+
+"""
+Batching front end for BPConProtocol.request
+
+Proposals submitted within a window are joined into one newline
+separated ballot value. The window closes after max_delay seconds or
+once max_ops proposals are waiting, whichever comes first. Each caller
+gets its own future resolved with the code for its op. Up to
+pipeline_window batches are kept in flight, further proposals keep
+filling the next window meanwhile.
+"""
+
+class ProposalBatcher(object):
+    def __init__(self, bpcon, conf):
+        self.bpcon = bpcon
+        self.log = conf['log']
+        self.max_ops = conf['batch_max_ops']
+        self.max_delay = conf['batch_max_delay']
+        self.max_inflight = conf['pipeline_window']
+        self.inflight = set()   # batch commit tasks
+        self.queue = []         # (proposal, future) waiting for a ballot
+        self.full = asyncio.Event()
+        self.drainer = None
+        REGISTRY.gauge('batch_queue', lambda: len(self.queue), group=bpcon.gid)
+        REGISTRY.gauge('batches_in_flight', lambda: len(self.inflight), group=bpcon.gid)
+
+    def submit(self, proposal):
+        """
+        queues proposal for the next batch, returns its future
+        """
+        future = asyncio.Future()
+        if not valid_op(proposal):
+            self.log.error("db commit proposal not in key,value format")
+            future.set_result({'code': 1}) # invalid request failcase
+            return future
+
+        self.queue.append((proposal, future))
+        if len(self.queue) >= self.max_ops:
+            self.full.set()
+        if self.drainer is None or self.drainer.done():
+            self.drainer = asyncio.ensure_future(self.drain())
+        return future
+
+    @asyncio.coroutine
+    def drain(self):
+        while self.queue:
+            if len(self.queue) < self.max_ops:
+                try: # let the window fill
+                    yield from asyncio.wait_for(self.full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            self.inflight = set(t for t in self.inflight if not t.done())
+            if len(self.inflight) >= self.max_inflight:
+                _, self.inflight = yield from asyncio.wait(self.inflight, return_when=asyncio.FIRST_COMPLETED)
+            batch, self.queue = self.queue[:self.max_ops], self.queue[self.max_ops:]
+            if len(self.queue) < self.max_ops:
+                self.full.clear()
+            self.inflight.add(asyncio.ensure_future(self.commit(batch)))
+
+    @asyncio.coroutine
+    def commit(self, batch):
+        value = "\n".join(proposal for proposal,_ in batch)
+        self.log.debug("committing batch of %s", len(batch))
+        try:
+            res = yield from self.bpcon.request(value, asyncio.Future(), batch=True)
+        except Exception as e:
+            self.log.info("batch commit failed: {}".format(e))
+            res = {'code': 1}
+
+        results = res.get('results')
+        for i,(_,future) in enumerate(batch):
+            if future.done():
+                continue
+            if res['code'] == 0 and results:
+                future.set_result({'code': results[i]})
+            else:
+                future.set_result(res) # whole ballot failed
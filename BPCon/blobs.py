@@ -0,0 +1,220 @@
+import asyncio
+import collections
+import hashlib
+import os
+import string
+import time
+
+from BPCon import wire
+
+"""
+Content-addressed storage for large values
+
+A ballot value longer than blob_threshold bytes does not travel in the
+1c. The leader stores it under its SHA-256 digest and proposes the
+reference
+    L,<digest>,<length>
+instead, so only the reference is voted on, logged and replicated.
+An acceptor missing the value pulls it before it votes, from the
+leader or else any peer holding it, in blob_chunk_bytes chunks over the
+pooled peer connection with up to PULL_WINDOW chunk requests in
+flight. A peer without the blob answers bn so the next one is tried
+at once. Concurrent fetches of one digest share a transfer and a
+stored value is never fetched again. StateManager swaps the value
+back in when the ballot is applied.
+
+Blobs stay on disk while held: by a request proposing them and by
+each log entry referring to them, until a checkpoint covers it. The
+last release deletes the blob.
+
+######### Message Formats ##########
+bf [ts, chunk, digest]
+bc [ts, chunk, more, data]
+bn [ts, chunk]              blob not held
+"""
+
+REF_MAX = 128   # longest reference, longer values are never references
+PULL_WINDOW = 8 # chunk requests in flight per blob transfer
+_hex = set(string.hexdigits.lower())
+
+def make_ref(digest, length):
+    return "L,{},{}".format(digest, length)
+
+def valid_digest(digest):
+    return len(digest) == 64 and set(digest) <= _hex
+
+def parse_ref(value):
+    """
+    (digest, length) of a reference, None for ordinary values
+    value is a str or UTF-8 bytes, either may be in the text 1c encoding
+    """
+    if len(value) > 3 * REF_MAX:
+        return None
+    if not isinstance(value, str):
+        value = bytes(value).decode('utf-8', 'replace')
+    if not ',' in value:
+        try:
+            value = wire.decode_text_value(value)
+        except (ValueError, OverflowError, UnicodeDecodeError):
+            return None
+    parts = value.split(',')
+    if len(parts) != 3 or parts[0] != 'L' or not valid_digest(parts[1]) or not parts[2].isdigit():
+        return None
+    return parts[1], int(parts[2])
+
+def write_blob(directory, data):
+    """
+    stores data under its digest and returns the reference, runs in the worker pool
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    path = os.path.join(directory, digest)
+    if not os.path.exists(path):
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, 'wb') as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, path)
+    return make_ref(digest, len(data))
+
+
+class BlobStore(object):
+    def __init__(self, directory, chunk_bytes, timeout, logger):
+        self.directory = directory
+        self.chunk_bytes = chunk_bytes
+        self.timeout = timeout  # seconds allowed per chunk request
+        self.log = logger
+        self.fetching = {}      # digest -> transfer task
+        self.refs = collections.Counter() # digest -> requests and log entries holding it
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def get(self, digest):
+        """
+        the stored value, raises KeyError if it is missing
+        """
+        try:
+            with open(self.path(digest), 'rb') as fh:
+                return fh.read()
+        except FileNotFoundError:
+            raise KeyError(digest)
+
+    def hold(self, digest):
+        self.refs[digest] += 1
+
+    def release(self, digest):
+        # deletes the blob once nothing holds it any more
+        self.refs[digest] -= 1
+        if self.refs[digest] > 0:
+            return
+        del self.refs[digest]
+        if digest not in self.fetching:
+            try:
+                os.unlink(self.path(digest))
+            except FileNotFoundError:
+                pass
+
+    ### serving side ###
+
+    def serve(self, chunk, digest):
+        try:
+            if not valid_digest(digest):
+                raise FileNotFoundError(digest)
+            with open(self.path(digest), 'rb') as fh:
+                fh.seek(chunk * self.chunk_bytes)
+                data = fh.read(self.chunk_bytes + 1)
+        except FileNotFoundError:
+            return wire.encode("bn", [time.time(), chunk])
+        more = int(len(data) > self.chunk_bytes)
+        return wire.encode("bc", [time.time(), chunk, more, data[:self.chunk_bytes]])
+
+    ### requesting side ###
+
+    @asyncio.coroutine
+    def fetch(self, digest, length, sources, connections):
+        """
+        True once the blob is stored, pulling it from the first of
+        sources that has it if it is not
+        """
+        if self.has(digest):
+            return True
+        task = self.fetching.get(digest)
+        if task is None:
+            task = asyncio.ensure_future(self.pull(digest, length, sources, connections))
+            self.fetching[digest] = task
+            task.add_done_callback(lambda t: self.fetching.pop(digest, None))
+        return (yield from asyncio.shield(task)) # one waiter giving up leaves the transfer running
+
+    @asyncio.coroutine
+    def pull(self, digest, length, sources, connections):
+        for peer in sources:
+            try:
+                if (yield from self.pull_from(peer, digest, length, connections)):
+                    return True
+            except Exception as e:
+                self.log.info("blob {} from {} failed: {}".format(digest[:12], peer, e))
+        return False
+
+    def request_chunk(self, peer, digest, chunk, connections):
+        request = wire.encode("bf", [time.time(), chunk, digest])
+        return asyncio.ensure_future(asyncio.wait_for(connections.request(peer, request), self.timeout))
+
+    @asyncio.coroutine
+    def pull_from(self, peer, digest, length, connections):
+        """
+        keeps PULL_WINDOW chunk requests in flight, the replies are
+        hashed and written in chunk order
+        """
+        tmp = self.path(digest) + ".part"
+        hasher = hashlib.sha256()
+        size = 0
+        chunks = max(1, -(-length // self.chunk_bytes)) # as many as the reference's length needs
+        pending = collections.deque()
+        requested = 0
+        try:
+            with open(tmp, 'wb') as fh:
+                for chunk in range(chunks):
+                    while requested < chunks and len(pending) < PULL_WINDOW:
+                        pending.append(self.request_chunk(peer, digest, requested, connections))
+                        requested += 1
+                    reply = yield from pending.popleft()
+                    msg_type, fields = wire.decode(reply)
+                    if msg_type == "bn":
+                        return False # peer does not have it
+                    if msg_type != "bc" or wire.to_int(fields[1]) != chunk:
+                        raise ValueError("unexpected reply {} for chunk {}".format(msg_type, chunk))
+                    data = fields[3]
+                    size += len(data)
+                    if size > length or wire.to_int(fields[2]) != int(chunk + 1 < chunks):
+                        raise ValueError("length differs from its reference")
+                    hasher.update(data)
+                    fh.write(data)
+                if hasher.hexdigest() != digest:
+                    raise ValueError("digest mismatch")
+                fh.flush()
+                yield from asyncio.get_event_loop().run_in_executor(None, os.fsync, fh.fileno())
+            os.replace(tmp, self.path(digest))
+            return True
+        finally:
+            for task in pending:
+                task.cancel()
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+
+_stores = {}
+
+def blob_store(conf):
+    """
+    the node's store for conf['blob_dir'], shared by all its groups
+    """
+    directory = conf['blob_dir']
+    if directory not in _stores:
+        _stores[directory] = BlobStore(directory, conf['blob_chunk_bytes'], conf['phase_timeout'], conf['log'])
+    return _stores[directory]
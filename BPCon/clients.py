@@ -0,0 +1,139 @@
+import asyncio
+import json
+import websockets
+
+from BPCon.connections import ConnectionManager, wrap, unwrap
+from BPCon.metrics import REGISTRY
+from BPCon.utils import get_ssl_context
+
+"""
+Client API served on c_wss
+
+Clients pipeline requests over one websocket, each tagged with a
+correlation id (see BPCon.connections) and answered as soon as its
+result is known, not necessarily in order.
+
+######### Message Formats ##########
+cid#P,key,value     put
+cid#D,key,          delete
+cid#G,key,mode      get, mode is lease (default), index or stale
+cid#{result json}   reply, {"code": 0, ...} on success
+
+Writes go to the batcher of the owning group. At most
+client_queue_size requests are outstanding per node, while full the
+server stops reading from its clients. Writes reaching a node that
+knows another node leads the owning group are forwarded there, marked
+with a leading '!' so they are not forwarded again.
+"""
+
+def client_wss(p_wss):
+    # clients are served one port above the peer port
+    head, _, port = p_wss.rpartition(':')
+    return "{}:{}".format(head, int(port) + 1)
+
+
+class ClientServer(object):
+    def __init__(self, router, conf):
+        self.router = router
+        self.log = conf['log']
+        self.wss = conf['p_wss']
+        self.max_lag = conf['read_max_lag'] # ballots a stale read may trail by
+        self.slots = asyncio.Semaphore(conf['client_queue_size'])
+        self.outstanding = 0    # requests holding a slot
+        REGISTRY.gauge('client_requests', lambda: self.outstanding)
+        self.leaders = ConnectionManager(get_ssl_context(conf['peer_certs']), conf['log'])
+
+    @asyncio.coroutine
+    def main_loop(self, websocket, path):
+        """
+        server socket, one per client connection
+        """
+        try:
+            while True:
+                raw = yield from websocket.recv()
+                if raw is None: # closed
+                    break
+                cid, msg = unwrap(raw)
+                yield from self.admit() # backpressure, stop reading while full
+                asyncio.ensure_future(self.serve(websocket, cid, msg))
+        except websockets.exceptions.ConnectionClosed:
+            self.log.debug("client closed connection")
+        except Exception as e:
+            self.log.error("client loop exception: {}".format(e))
+
+    @asyncio.coroutine
+    def admit(self):
+        # waits for one of the client_queue_size slots
+        yield from self.slots.acquire()
+        self.outstanding += 1
+
+    @asyncio.coroutine
+    def answer(self, cid, msg):
+        """
+        reply to an admitted request, frees its slot
+        """
+        try:
+            res = yield from self.handle(msg)
+        except Exception as e:
+            self.log.info("client request failed: {}".format(e))
+            res = {'code': 1}
+        finally:
+            self.outstanding -= 1
+            self.slots.release()
+        reply = json.dumps(res)
+        return wrap(cid, reply) if cid is not None else reply
+
+    @asyncio.coroutine
+    def serve(self, websocket, cid, msg):
+        reply = yield from self.answer(cid, msg)
+        try:
+            yield from websocket.send(reply)
+        except Exception as e:
+            self.log.debug("reply to client failed: {}".format(e))
+
+    @asyncio.coroutine
+    def handle(self, msg):
+        """
+        returns the result dict for one client request
+        """
+        if not isinstance(msg, str):
+            msg = str(msg, 'utf-8')
+        forwarded = msg.startswith('!')
+        op = msg[1:] if forwarded else msg
+        try:
+            t,k,v = op.split(',')
+        except ValueError:
+            return {'code': 1} # invalid request failcase
+
+        if t == 'G':
+            return (yield from self.router.read(k, v or 'lease', self.max_lag))
+        if t not in ('P', 'D'):
+            return {'code': 1}
+
+        leader = None if forwarded else self.leader_of(k)
+        if leader:
+            res = yield from self.forward(leader, op)
+            if res is not None:
+                return res
+        return (yield from self.router.submit(op))
+
+    def leader_of(self, key):
+        # another node last seen leading the key's group, None if it is us or unknown
+        leader = self.router.groups[self.router.owner(key)].leader
+        if leader != self.wss:
+            return leader
+
+    @asyncio.coroutine
+    def forward(self, leader, op):
+        try:
+            reply = yield from self.leaders.request(client_wss(leader), "!" + op)
+            if not isinstance(reply, str):
+                reply = bytes(reply).decode()
+            return json.loads(reply)
+        except Exception as e:
+            self.log.info("forward to {} failed, proposing here: {}".format(leader, e))
+            return None
+
+    @asyncio.coroutine
+    def close(self):
+        yield from self.leaders.close_all()
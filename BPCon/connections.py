@@ -0,0 +1,157 @@
+import asyncio
+import itertools
+import struct
+import time
+import websockets
+
+"""
+Long-lived connections between group members
+
+One authenticated websocket is kept per peer wss and shared by every
+ballot. Requests are tagged with a correlation id so that several
+exchanges can be in flight on the same socket.
+
+######### Envelope Format ##########
+text:   cid#msg
+binary: '#' cid(8) frame
+"""
+
+_cid = struct.Struct('!Q')
+
+def wrap(cid, msg):
+    if isinstance(msg, bytes):
+        return b'#' + _cid.pack(cid) + msg
+    return "{}#{}".format(cid, msg)
+
+def unwrap(raw):
+    """
+    returns (cid, msg), cid is None for untagged (single-shot) messages
+    """
+    if isinstance(raw, bytes):
+        if raw[:1] == b'#' and len(raw) > _cid.size:
+            return _cid.unpack_from(raw, 1)[0], memoryview(raw)[1+_cid.size:]
+        return None, raw
+    head, sep, body = raw.partition('#')
+    if sep and head.isdigit():
+        return int(head), body
+    return None, raw
+
+def tagged(raw):
+    # True for a message wrapped with a cid, without unwrapping it
+    if isinstance(raw, bytes):
+        return raw[:1] == b'#' and len(raw) > _cid.size
+    head, sep, _ = raw[:21].partition('#')
+    return bool(sep) and head.isdigit()
+
+
+class ConnectionManager(object):
+    """
+    pool of persistent peer sockets
+
+    reconnects lazily with exponential backoff, a peer in backoff
+    fails fast instead of stalling the caller on a connect timeout
+    """
+    def __init__(self, ctx, logger, path='', min_backoff=0.5, max_backoff=30.0):
+        self.ctx = ctx
+        self.path = path        # selects the consensus group served at each peer
+        self.log = logger
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.sockets = {}       # wss -> open websocket
+        self.readers = {}       # wss -> task reading replies
+        self.locks = {}         # wss -> lock serializing connects
+        self.backoff = {}       # wss -> (delay, next attempt time)
+        self.waiting = {}       # cid -> (wss, future)
+        self.cids = itertools.count()
+
+    @asyncio.coroutine
+    def get(self, wss):
+        sock = self.sockets.get(wss)
+        if sock is not None and sock.open:
+            return sock
+
+        lock = self.locks.setdefault(wss, asyncio.Lock())
+        with (yield from lock):
+            sock = self.sockets.get(wss)
+            if sock is not None and sock.open: # connected while waiting
+                return sock
+
+            delay, retry_at = self.backoff.get(wss, (0, 0))
+            if time.time() < retry_at:
+                raise ConnectionError("peer {} in backoff".format(wss))
+            try:
+                sock = yield from websockets.connect(wss + self.path, ssl=self.ctx)
+            except Exception:
+                delay = min(max(delay * 2, self.min_backoff), self.max_backoff)
+                self.backoff[wss] = (delay, time.time() + delay)
+                raise
+
+            self.backoff.pop(wss, None)
+            self.sockets[wss] = sock
+            self.readers[wss] = asyncio.ensure_future(self.reader(wss, sock))
+            self.log.debug("connected to {}".format(wss))
+            return sock
+
+    @asyncio.coroutine
+    def reader(self, wss, sock):
+        """
+        routes replies on sock to their waiting callers
+        """
+        try:
+            while True:
+                raw = yield from sock.recv()
+                cid, msg = unwrap(raw)
+                waiter = self.waiting.pop(cid, None)
+                if waiter and not waiter[1].done():
+                    waiter[1].set_result(msg)
+                else:
+                    self.log.debug("unmatched reply from {}".format(wss))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.log.debug("connection to {} lost: {}".format(wss, e))
+        finally:
+            if self.sockets.get(wss) is sock:
+                self.sockets.pop(wss)
+                self.readers.pop(wss, None)
+            self.fail_waiting(wss)
+
+    def fail_waiting(self, wss):
+        for cid, (peer, fut) in list(self.waiting.items()):
+            if peer == wss:
+                self.waiting.pop(cid)
+                if not fut.done():
+                    fut.set_exception(ConnectionError("connection to {} closed".format(wss)))
+
+    @asyncio.coroutine
+    def request(self, wss, msg):
+        """
+        sends msg to wss and returns the matching reply
+        """
+        sock = yield from self.get(wss)
+        cid = next(self.cids)
+        fut = asyncio.Future()
+        self.waiting[cid] = (wss, fut)
+        try:
+            yield from sock.send(wrap(cid, msg))
+            return (yield from fut)
+        finally:
+            self.waiting.pop(cid, None)
+
+    @asyncio.coroutine
+    def close(self, wss):
+        sock = self.sockets.pop(wss, None)
+        reader = self.readers.pop(wss, None)
+        if reader:
+            reader.cancel()
+        if sock:
+            try:
+                yield from sock.close()
+            except Exception as e:
+                self.log.debug("close of {} failed: {}".format(wss, e))
+        self.fail_waiting(wss)
+
+    @asyncio.coroutine
+    def close_all(self):
+        for wss in list(self.sockets):
+            yield from self.close(wss)
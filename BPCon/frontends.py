@@ -0,0 +1,314 @@
+import asyncio
+import itertools
+import os
+import struct
+import subprocess
+import sys
+import websockets
+
+from BPCon.connections import tagged, unwrap
+from BPCon.protocol import PEER_INFLIGHT
+
+"""
+Multi-process node mode
+
+With frontends = n > 0 a node runs n front-end processes next to its
+core. Every front end binds the peer and client ports with SO_REUSEPORT,
+so the kernel spreads incoming connections across them, and does the
+TLS and websocket framing for its connections. Messages are relayed
+unparsed over a unix socket to the core, the one process owning the
+groups' BPConProtocol and StateManager instances, which parses and
+answers them as if they had come in on its own sockets, dropping
+malformed ones as it would there. Connections the node opens to its
+peers stay in the core.
+
+A front end relays at most frontend_inflight client requests at a time
+and stops reading from its clients while that many are unanswered,
+tagged peer messages are relayed concurrently up to PEER_INFLIGHT per
+connection as in BPConProtocol.main_loop. The core likewise serves at
+most frontend_inflight client and as many peer frames per link at once.
+Both sides drain the link after each frame they write.
+
+######### Channel Frames ##########
+body length (4 bytes), tag (4 bytes), kind (1 byte), body
+kind      body
+p / P     peer message, binary / text: gid '\n' frame as received
+c / C     client request, binary / text: frame as received
+r / R     reply, binary / text
+n         no reply, empty body
+Lower case kinds carry binary websocket frames, upper case text ones.
+A front end tags each request, the core answers with the same tag as
+soon as the answer is ready, not necessarily in order.
+"""
+
+_head = struct.Struct('>IIc')
+
+def frame(tag, kind, body):
+    return _head.pack(len(body), tag, kind) + body
+
+@asyncio.coroutine
+def read_frame(reader):
+    """
+    returns (tag, kind, body), raises asyncio.IncompleteReadError once the link closes
+    """
+    length, tag, kind = _head.unpack((yield from reader.readexactly(_head.size)))
+    body = yield from reader.readexactly(length)
+    return tag, kind, body
+
+def reply_frame(tag, reply):
+    if not reply:
+        return frame(tag, b'n', b'')
+    if isinstance(reply, str):
+        return frame(tag, b'R', reply.encode())
+    return frame(tag, b'r', bytes(reply))
+
+
+class CoreServer(object):
+    """
+    core side, starts the front ends and serves their links
+    """
+    def __init__(self, router, clients, conf):
+        self.router = router
+        self.clients = clients
+        self.log = conf['log']
+        self.count = conf['frontends']
+        self.path = conf['frontend_socket']
+        self.inflight = conf['frontend_inflight']
+        self.server = None
+        self.procs = []
+
+    @asyncio.coroutine
+    def start(self, config_file):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = yield from asyncio.start_unix_server(self.serve_link, self.path)
+        cmd = [sys.executable, '-m', 'BPCon.frontends', config_file, self.path]
+        self.procs = [subprocess.Popen(cmd) for _ in range(self.count)]
+
+    @asyncio.coroutine
+    def serve_link(self, reader, writer):
+        """
+        one persistent link per front end
+        """
+        draining = asyncio.Lock()
+        client_slots = asyncio.Semaphore(self.inflight)
+        peer_slots = asyncio.Semaphore(self.inflight)
+        try:
+            while True:
+                tag, kind, body = yield from read_frame(reader)
+                client = kind in (b'c', b'C')
+                slots = client_slots if client else peer_slots
+                yield from slots.acquire() # stop reading while the front end has too many in flight
+                if client:
+                    answer = self.client_answer(body, kind == b'c')
+                else:
+                    answer = self.peer_answer(body, kind == b'p')
+                task = asyncio.ensure_future(self.reply(writer, tag, answer, draining))
+                task.add_done_callback(lambda t, slots=slots: slots.release())
+        except asyncio.IncompleteReadError:
+            self.log.info("front end closed its link")
+        except Exception as e:
+            self.log.error("front end link exception: {}".format(e))
+        writer.close()
+
+    @asyncio.coroutine
+    def client_answer(self, body, binary):
+        # waits for a client slot without holding up the link, peer
+        # messages share it and must not queue behind clients
+        cid, msg = unwrap(body if binary else body.decode())
+        yield from self.clients.admit()
+        return (yield from self.clients.answer(cid, msg))
+
+    @asyncio.coroutine
+    def peer_answer(self, body, binary):
+        gid, _, raw = body.partition(b'\n')
+        bpcon = self.router.peer_group(gid.decode())
+        if bpcon is None:
+            self.log.info("message for unknown group '{}'".format(gid.decode()))
+            return None
+        return (yield from bpcon.serve_msg(raw if binary else raw.decode()))
+
+    @asyncio.coroutine
+    def reply(self, writer, tag, answer, draining):
+        try:
+            reply = yield from answer
+        except Exception as e:
+            self.log.error("relayed message failed: {}".format(e))
+            reply = None
+        # frames are written whole, replies from concurrent tasks do not interleave
+        writer.write(reply_frame(tag, reply))
+        try:
+            with (yield from draining): # one drain at a time per writer
+                yield from writer.drain()
+        except Exception as e:
+            self.log.debug("front end link lost: {}".format(e))
+
+    def close(self):
+        if self.server:
+            self.server.close()
+        for p in self.procs:
+            p.terminate()
+        for p in self.procs:
+            try:
+                p.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                p.kill()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class FrontEnd(object):
+    """
+    front-end side, serves the node's ports and relays to the core
+    """
+    def __init__(self, conf):
+        self.conf = conf
+        self.log = conf['log']
+        self.tags = itertools.count()
+        self.waiting = {}   # tag -> future of the core's reply
+        self.slots = asyncio.Semaphore(conf['frontend_inflight']) # client requests relayed at once
+        self.writer = None
+        self.draining = asyncio.Lock()
+        self.servers = []
+
+    @asyncio.coroutine
+    def start(self, path):
+        reader, self.writer = yield from asyncio.open_unix_connection(path)
+        asyncio.ensure_future(self.read_replies(reader))
+        conf = self.conf
+        for handler, port in ((self.peer_loop, conf['port']), (self.client_loop, conf['port'] + 1)):
+            server = yield from websockets.serve(handler, conf['ip_addr'], port, ssl=conf['ssl'], reuse_port=True)
+            self.servers.append(server)
+
+    @asyncio.coroutine
+    def request(self, kind, body):
+        """
+        relays a frame to the core, returns the future of its reply
+        """
+        tag = next(self.tags) & 0xffffffff
+        future = asyncio.Future()
+        self.waiting[tag] = future
+        self.writer.write(frame(tag, kind, body))
+        with (yield from self.draining): # one drain at a time per writer
+            yield from self.writer.drain()
+        return future
+
+    @asyncio.coroutine
+    def read_replies(self, reader):
+        try:
+            while True:
+                tag, kind, body = yield from read_frame(reader)
+                future = self.waiting.pop(tag, None)
+                if future is None or future.done():
+                    continue
+                if kind == b'n':
+                    future.set_result(None)
+                else:
+                    future.set_result(body.decode() if kind == b'R' else body)
+        except asyncio.IncompleteReadError:
+            self.log.info("core closed the link, stopping")
+        except Exception as e:
+            self.log.error("core link exception: {}".format(e))
+        for future in self.waiting.values():
+            future.cancel()
+        self.waiting = {}
+        asyncio.get_event_loop().stop()
+
+    @asyncio.coroutine
+    def peer_loop(self, websocket, path):
+        """
+        server socket for a peer, like BPConProtocol.main_loop tagged
+        messages are relayed concurrently and untagged ones in order
+        """
+        gid = path.strip('/').encode()
+        sending = asyncio.Lock()
+        inflight = asyncio.Semaphore(PEER_INFLIGHT)
+        try:
+            while True:
+                raw = yield from websocket.recv()
+                if raw is None: # closed
+                    break
+                binary = not isinstance(raw, str)
+                body = gid + b'\n' + (bytes(raw) if binary else raw.encode())
+                kind = b'p' if binary else b'P'
+                if not tagged(raw):
+                    yield from self.relay(websocket, (yield from self.request(kind, body)), sending)
+                    continue
+                yield from inflight.acquire()
+                try:
+                    reply = yield from self.request(kind, body)
+                except Exception:
+                    inflight.release()
+                    raise
+                task = asyncio.ensure_future(self.relay(websocket, reply, sending))
+                task.add_done_callback(lambda t: inflight.release())
+        except websockets.exceptions.ConnectionClosed:
+            self.log.debug("peer closed connection")
+        except Exception as e:
+            self.log.error("front end peer loop exception: {}".format(e))
+
+    @asyncio.coroutine
+    def client_loop(self, websocket, path):
+        """
+        server socket for a client, requests are relayed as they arrive
+        and answered in the order the core finishes them
+        """
+        sending = asyncio.Lock()
+        try:
+            while True:
+                raw = yield from websocket.recv()
+                if raw is None: # closed
+                    break
+                yield from self.slots.acquire() # backpressure, stop reading while full
+                try:
+                    if isinstance(raw, str):
+                        reply = yield from self.request(b'C', raw.encode())
+                    else:
+                        reply = yield from self.request(b'c', bytes(raw))
+                except Exception:
+                    self.slots.release()
+                    raise
+                task = asyncio.ensure_future(self.relay(websocket, reply, sending))
+                task.add_done_callback(lambda t: self.slots.release())
+        except websockets.exceptions.ConnectionClosed:
+            self.log.debug("client closed connection")
+        except Exception as e:
+            self.log.error("front end client loop exception: {}".format(e))
+
+    @asyncio.coroutine
+    def relay(self, websocket, reply, sending):
+        try:
+            reply = yield from reply
+            if reply:
+                with (yield from sending): # one frame at a time
+                    yield from websocket.send(reply)
+        except Exception as e:
+            self.log.debug("relayed reply failed: {}".format(e))
+
+    def close(self):
+        for server in self.servers:
+            server.close()
+        if self.writer:
+            self.writer.close()
+
+
+def run_frontend(config_file, path):
+    """
+    front-end process entry point, runs until the core goes away
+    """
+    from configManager import ConfigManager
+    conf = ConfigManager().load_config(config_file)
+    loop = asyncio.get_event_loop()
+    front = FrontEnd(conf)
+    loop.run_until_complete(front.start(path))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        front.close()
+        loop.close()
+
+
+if __name__ == '__main__':
+    run_frontend(sys.argv[1], sys.argv[2])
@@ -0,0 +1,100 @@
+import math
+
+"""
+Per-peer latency tracking and failure suspicion
+
+Each peer keeps an EWMA of its reply latency and deviation next to a
+histogram with logarithmic buckets for percentiles. Suspicion follows
+phi accrual: phi = -log10(P(latency > t)), t being how long the last
+exchange went unanswered, under a normal fit of the EWMA figures. A
+peer that answered its last request has phi 0, one that timed out
+climbs with the time it stayed silent.
+"""
+
+BUCKET_BASE = 0.0001    # upper bound of the first bucket, seconds
+BUCKET_GROWTH = math.sqrt(2)
+NUM_BUCKETS = 48        # last bucket holds anything over ~1 minute
+MAX_SAMPLES = 10000     # histogram counts halve past this, old samples fade
+
+def bucket_of(latency):
+    if latency <= BUCKET_BASE:
+        return 0
+    i = int(math.ceil(math.log(latency / BUCKET_BASE, BUCKET_GROWTH)))
+    return min(i, NUM_BUCKETS - 1)
+
+def bucket_bound(i):
+    return BUCKET_BASE * BUCKET_GROWTH ** i
+
+
+class Histogram(object):
+    """
+    log-bucket histogram, with max_samples counts halve past that
+    many samples so old ones fade
+    """
+    def __init__(self, max_samples=None):
+        self.max_samples = max_samples
+        self.counts = [0] * NUM_BUCKETS
+        self.samples = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bucket_of(value)] += 1
+        self.samples += 1
+        self.total += value
+        if self.max_samples and self.samples > self.max_samples:
+            self.counts = [c // 2 for c in self.counts]
+            self.samples = sum(self.counts)
+            self.total /= 2
+
+    def percentile(self, p):
+        """
+        upper bucket bound below which p percent of samples fall, None without samples
+        """
+        if not self.samples:
+            return None
+        wanted = self.samples * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return bucket_bound(i)
+        return bucket_bound(NUM_BUCKETS - 1)
+
+
+class LatencyTracker(object):
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.mean = None        # EWMA of latency
+        self.dev = 0.0          # EWMA of squared deviation
+        self.histogram = Histogram(MAX_SAMPLES)
+        self.silent_for = 0.0   # unanswered time of the last exchange, 0 if answered
+        self.last_probe = 0.0
+
+    @property
+    def samples(self):
+        return self.histogram.samples
+
+    def record(self, latency):
+        if self.mean is None:
+            self.mean = latency
+        else:
+            diff = latency - self.mean
+            self.mean += self.alpha * diff
+            self.dev = (1 - self.alpha) * (self.dev + self.alpha * diff * diff)
+        self.histogram.observe(latency)
+        self.silent_for = 0.0
+
+    def record_failure(self, elapsed):
+        self.silent_for = max(elapsed, self.silent_for)
+
+    def percentile(self, p):
+        return self.histogram.percentile(p)
+
+    def phi(self):
+        if not self.silent_for:
+            return 0.0
+        if self.mean is None:
+            return float('inf') # never answered
+        std = max(math.sqrt(self.dev), self.mean * 0.1, 0.001)
+        p_later = 0.5 * math.erfc((self.silent_for - self.mean) / (std * math.sqrt(2)))
+        return -math.log10(max(p_later, 1e-300))
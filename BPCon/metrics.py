@@ -0,0 +1,222 @@
+import asyncio
+import collections
+import json
+import time
+
+from BPCon.latency import Histogram
+
+"""
+Protocol metrics and ballot tracing
+
+One registry per process holds named counters, histograms and gauges,
+each optionally labelled (e.g. by group). Code asks the registry for a
+metric once, at construction, and keeps the object; while metrics are
+off the registry hands out a shared no-op instead, so an instrumented
+hot path costs a method call that does nothing. Gauges are callbacks
+read only when a snapshot is taken.
+
+Spans time one step of one ballot (request, phase1b, verify_sigs, ...)
+and land in a bounded ring, enabled separately with tracing.
+
+snapshot() returns everything as a dict for in-process use, serve()
+exposes it over plain HTTP on localhost:
+    /metrics       text, one "name{labels} value" line per series
+    /metrics.json  snapshot() as JSON
+    /spans         finished spans as JSON, oldest first
+"""
+
+PERCENTILES = (50, 90, 99)
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+    def inc(self, n=1):
+        self.value += n
+
+
+class Timer(Histogram):
+    """
+    histogram of durations in seconds
+    """
+    def time(self):
+        return _Timing(self)
+
+
+class _Timing(object):
+    def __init__(self, timer):
+        self.timer = timer
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        self.timer.observe(time.perf_counter() - self.start)
+
+
+class Span(object):
+    def __init__(self, ring, name, labels):
+        self.ring = ring
+        self.name = name
+        self.labels = labels
+    def __enter__(self):
+        self.start = time.time()
+        self.perf = time.perf_counter()
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        span = {'name': self.name, 'start': self.start,
+                'duration': time.perf_counter() - self.perf}
+        span.update(self.labels)
+        if exc_type is not None:
+            span['error'] = exc_type.__name__
+        self.ring.append(span)
+
+
+class _Null(object):
+    # stands in for every metric and span while disabled
+    value = 0
+    def inc(self, n=1):
+        pass
+    def observe(self, value):
+        pass
+    def time(self):
+        return self
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+NULL = _Null()
+
+
+class Registry(object):
+    def __init__(self, enabled=False, tracing=False, span_capacity=10000):
+        self.enabled = enabled
+        self.tracing = tracing
+        self.metrics = {}       # (name, labels) -> Counter/Timer
+        self.gauges = {}        # (name, labels) -> callable
+        self.spans = collections.deque(maxlen=span_capacity)
+
+    def configure(self, conf):
+        self.enabled = conf['metrics']
+        self.tracing = conf['tracing']
+        self.spans = collections.deque(self.spans, maxlen=conf['span_capacity'])
+
+    def key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def get(self, cls, name, labels):
+        if not self.enabled:
+            return NULL
+        key = self.key(name, labels)
+        metric = self.metrics.get(key)
+        if metric is None:
+            metric = self.metrics[key] = cls()
+        return metric
+
+    def counter(self, name, **labels):
+        return self.get(Counter, name, labels)
+
+    def timer(self, name, **labels):
+        return self.get(Timer, name, labels)
+
+    def gauge(self, name, fn, **labels):
+        if self.enabled:
+            self.gauges[self.key(name, labels)] = fn
+
+    def span(self, name, **labels):
+        """
+        with registry.span('phase1b', group=gid, ballot=N): ...
+        """
+        if not self.tracing:
+            return NULL
+        return Span(self.spans, name, labels)
+
+    def drop(self, **labels):
+        # forgets every series carrying these labels, e.g. a removed group
+        wanted = set(labels.items())
+        for table in (self.metrics, self.gauges):
+            for key in [k for k in table if wanted <= set(k[1])]:
+                del table[key]
+
+    def snapshot(self):
+        """
+        {name: [{'labels': {...}, 'value': n} or {'labels', 'count', 'sum', 'p50', ...}]}
+        """
+        snap = {}
+        for (name, labels), metric in sorted(self.metrics.items()):
+            entry = {'labels': dict(labels)}
+            if isinstance(metric, Timer):
+                entry['count'] = metric.samples
+                entry['sum'] = metric.total
+                for p in PERCENTILES:
+                    entry['p{}'.format(p)] = metric.percentile(p)
+            else:
+                entry['value'] = metric.value
+            snap.setdefault(name, []).append(entry)
+        for (name, labels), fn in sorted(self.gauges.items(), key=lambda item: item[0]):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            snap.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        return snap
+
+    def render(self):
+        """
+        snapshot() as text, timers as _count, _sum and quantile lines
+        """
+        lines = []
+        for name, entries in sorted(self.snapshot().items()):
+            for entry in entries:
+                labels = entry['labels']
+                if 'count' in entry:
+                    lines.append(series(name + '_count', labels, entry['count']))
+                    lines.append(series(name + '_sum', labels, entry['sum']))
+                    for p in PERCENTILES:
+                        if entry['p{}'.format(p)] is not None:
+                            quantile = dict(labels, quantile=p / 100.0)
+                            lines.append(series(name, quantile, entry['p{}'.format(p)]))
+                else:
+                    lines.append(series(name, labels, entry['value']))
+        return "\n".join(lines) + "\n"
+
+    @asyncio.coroutine
+    def serve(self, host, port):
+        """
+        starts the HTTP endpoint, returns the asyncio server
+        """
+        return (yield from asyncio.start_server(self.handle_http, host, port))
+
+    @asyncio.coroutine
+    def handle_http(self, reader, writer):
+        try:
+            request = yield from reader.readline()
+            while (yield from reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass # headers are ignored
+            parts = request.decode('latin-1').split()
+            path = parts[1].split('?')[0] if len(parts) > 1 else ''
+            if path == '/metrics':
+                status, ctype, body = "200 OK", "text/plain", self.render()
+            elif path == '/metrics.json':
+                status, ctype, body = "200 OK", "application/json", json.dumps(self.snapshot())
+            elif path == '/spans':
+                status, ctype, body = "200 OK", "application/json", json.dumps(list(self.spans))
+            else:
+                status, ctype, body = "404 Not Found", "text/plain", "not found\n"
+            body = body.encode()
+            writer.write("HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n".format(
+                status, ctype, len(body)).encode() + body)
+            yield from writer.drain()
+        except Exception:
+            pass # client went away
+        finally:
+            writer.close()
+
+
+def series(name, labels, value):
+    if labels:
+        name += "{" + ",".join('{}="{}"'.format(k, v) for k, v in sorted(labels.items())) + "}"
+    return "{} {}".format(name, value)
+
+
+REGISTRY = Registry()
@@ -0,0 +1,111 @@
+import bisect
+
+"""
+Ordered key index for range and prefix scans
+
+Keys are kept in sorted chunks of up to 2*load entries next to a list
+of each chunk's largest key, a flat B-tree: a lookup is two bisections
+and an insert or delete shifts a single chunk. Iterators copy one
+chunk at a time and find the next by searching again from the last
+key returned, so ballots may apply between steps.
+"""
+
+def prefix_end(prefix):
+    """
+    smallest key greater than every key starting with prefix, None if unbounded
+    """
+    while prefix and prefix[-1] == chr(0x10ffff):
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SortedKeys(object):
+    def __init__(self, keys=(), load=512):
+        self.load = load
+        self.chunks = []
+        self.maxes = []         # largest key of each chunk
+        keys = sorted(set(keys))
+        for i in range(0, len(keys), load):
+            self.chunks.append(keys[i:i+load])
+            self.maxes.append(self.chunks[-1][-1])
+        self.size = len(keys)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            return False
+        chunk = self.chunks[i]
+        return chunk[bisect.bisect_left(chunk, key)] == key
+
+    def add(self, key):
+        if not self.maxes:
+            self.chunks.append([key])
+            self.maxes.append(key)
+            self.size = 1
+            return
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes): # past the end
+            i -= 1
+            self.chunks[i].append(key)
+            self.maxes[i] = key
+        else:
+            chunk = self.chunks[i]
+            j = bisect.bisect_left(chunk, key)
+            if chunk[j] == key:
+                return
+            chunk.insert(j, key)
+        self.size += 1
+
+        chunk = self.chunks[i]
+        if len(chunk) > 2 * self.load:
+            half = chunk[self.load:]
+            del chunk[self.load:]
+            self.chunks.insert(i + 1, half)
+            self.maxes[i] = chunk[-1]
+            self.maxes.insert(i + 1, half[-1])
+
+    def discard(self, key):
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            return
+        chunk = self.chunks[i]
+        j = bisect.bisect_left(chunk, key)
+        if chunk[j] != key:
+            return
+        del chunk[j]
+        self.size -= 1
+        if not chunk:
+            del self.chunks[i]
+            del self.maxes[i]
+        elif j == len(chunk):
+            self.maxes[i] = chunk[-1]
+
+    def irange(self, start=None, end=None):
+        """
+        yields keys with start <= key < end in order
+        """
+        last = None
+        while True:
+            if last is None:
+                i = 0 if start is None else bisect.bisect_left(self.maxes, start)
+            else:
+                i = bisect.bisect_right(self.maxes, last)
+            if i >= len(self.chunks):
+                return
+            chunk = self.chunks[i]
+            if last is not None:
+                batch = chunk[bisect.bisect_right(chunk, last):]
+            elif start is not None:
+                batch = chunk[bisect.bisect_left(chunk, start):]
+            else:
+                batch = chunk[:]
+            for key in batch:
+                if end is not None and key >= end:
+                    return
+                yield key
+                last = key
@@ -1,15 +1,23 @@
 import asyncio
+import functools
+import itertools
+import logging
 import websockets
 import time
 
-from Crypto.Signature import PKCS1_v1_5
-from Crypto.Hash import SHA
-from Crypto.PublicKey import RSA
-
-from BPCon.quorum import Quorum
-from BPCon.utils import get_ssl_context
+from BPCon import wire
+from BPCon.metrics import REGISTRY
+from BPCon.blobs import blob_store, parse_ref, write_blob
+from BPCon.signing import load_signer, KeyFile
+from BPCon.quorum import Quorum, FillQuorum, PROMISED, APPLIED, REFUSED
+from BPCon.connections import wrap, unwrap, tagged
 from BPCon.routing import GroupManager
 from BPCon.storage import InMemoryStorage
+from BPCon.wal import WriteAheadLog
+from BPCon.transfer import StateTransfer
+from BPCon.replicalog import ReplicaLog
+from BPCon.utils import group_path
+from BPCon.workers import CONSENSUS, CODEC, BACKGROUND
 
 """
 Replicates changes to DB and group membership
@@ -22,10 +30,133 @@ Sole purpose is to get consensus from group
 1b-N-v-nack-sig
 1c-N,v 
 2b-N,v,acc
+2n-N-maxBal  (2b refused, higher ballot promised)
+ri-id        (read-index query)
+rr-id-maxVBal
 B: 1aMsg U 1bMsg U 1cMsg U 2avMsg U 2bMsg
 
+Text messages are '&' delimited, binary ones are BPCon.wire frames:
+1a [ts, N, leader wss]
+1b [ts, N, maxVBal, maxVVal, avs, sig]  sig covers the frame before it
+1c [ts, N, v, wss, 1b, wss, 1b, ...]
+2b [ts, N]
+2n [ts, N, maxBal]
+ri [ts, read id]
+rr [ts, read id, maxVBal]
+Replies use the format of the message they answer.
+
+Slots whose ballot failed are filled in rounds, binary only:
+fa [ts, N, round, leader wss]
+fb [ts, N, round, status, vote round, vote, sig]  status 0 promised, 1 applied, 2 refused
+fc [ts, N, round, leader wss, v, wss, fb, wss, fb, ...]
+answered by 2b, or 2n carrying the fill round promised instead.
+
 """
 
+NOOP = "N,," # fills a ballot slot its leader abandoned
+PEER_INFLIGHT = 64 # tagged messages served at once per peer connection
+
+
+def valid_op(op):
+    # one "t,k,v" op, '\n' separates the ops of a batch and '&' the fields of a text message
+    return op.count(',') == 2 and '\n' not in op and '&' not in op
+
+def expect(fields, *counts):
+    if len(fields) not in counts:
+        raise ValueError("{} fields".format(len(fields)))
+
+def binary_1c_proofs(fields):
+    return fields[2], binary_proofs(fields, 3)
+
+def binary_proofs(fields, start):
+    # (wss, signed msg, sig) of the proofs closing a 1c or fc from fields[start] on
+    if len(fields) < start or (len(fields) - start) % 2:
+        raise ValueError("{} fields".format(len(fields)))
+    signed_msgs = []
+    for i in range(start, len(fields), 2):
+        proof = fields[i+1]
+        if wire.is_binary(proof):
+            body, sig = wire.split_signed(proof)
+        else: # text 1b relayed in a binary 1c
+            body, sig = wire.to_str(proof).split(';')
+            body, sig = body.encode(), int(sig)
+        signed_msgs.append((wire.to_str(fields[i]), body, sig))
+    return signed_msgs
+
+def fill_proofs(fields):
+    """
+    (round, leader, v, proofs) of an fc, every proof must be a promise for its slot and round
+    """
+    N, round_ = wire.to_int(fields[1]), wire.to_int(fields[2])
+    for i in range(6, len(fields), 2):
+        msg_type, fb = wire.decode(fields[i])
+        if msg_type != "fb" or len(fb) != 7 or [wire.to_int(f) for f in fb[1:4]] != [N, round_, PROMISED]:
+            raise ValueError("proof is not a promise for fill round {} of {}".format(round_, N))
+    return round_, wire.to_str(fields[3]), fields[4], binary_proofs(fields, 5)
+
+def text_1c_proofs(proofs):
+    signed_msgs = [] # 1b proofs in wss;msg;sig format
+    for item in proofs.split(','):
+        wss, body, sig = item.split(';')
+        signed_msgs.append((wss, body.encode(), int(sig))) # sig width known to the verifier
+    return signed_msgs
+
+# args of each message type from its decoded fields and raw frame, see parse_msg
+BINARY_PARSERS = {
+    "1a": lambda f, msg: expect(f, 2, 3) or (wire.to_str(f[2]) if len(f) == 3 else None,),
+    "1b": lambda f, msg: expect(f, 6) or (wire.to_int(f[2]), msg),
+    "1c": lambda f, msg: binary_1c_proofs(f),
+    "2b": lambda f, msg: expect(f, 2) or (),
+    "2n": lambda f, msg: expect(f, 3) or (wire.to_int(f[2]),),
+    "st": lambda f, msg: expect(f, 4) or (wire.to_int(f[2]), wire.to_int(f[3])),
+    "ri": lambda f, msg: expect(f, 2) or (),
+    "rr": lambda f, msg: expect(f, 3) or (wire.to_int(f[2]),),
+    "bf": lambda f, msg: expect(f, 3) or (wire.to_str(f[2]),),
+    "fa": lambda f, msg: expect(f, 4) or (wire.to_int(f[2]), wire.to_str(f[3])),
+    "fb": lambda f, msg: expect(f, 7) or (wire.to_int(f[2]), wire.to_int(f[3]), wire.to_int(f[4]), f[5], msg),
+    "fc": lambda f, msg: fill_proofs(f),
+}
+
+# same from the '&' separated parts of a text message, 1c proofs come split off
+TEXT_PARSERS = {
+    "1a": lambda p, msg, proofs: expect(p, 3, 4) or (p[3] if len(p) == 4 else None,),
+    "1b": lambda p, msg, proofs: expect(p, 6) or (int(p[3]), msg),
+    "1c": lambda p, msg, proofs: expect(p, 4) or (p[3], text_1c_proofs(proofs)),
+    "2b": lambda p, msg, proofs: expect(p, 4) or (),
+    "2n": lambda p, msg, proofs: expect(p, 4) or (int(p[3]),),
+    "ri": lambda p, msg, proofs: expect(p, 3) or (),
+    "rr": lambda p, msg, proofs: expect(p, 4) or (int(p[3]),),
+}
+
+def parse_msg(msg, binary=None):
+    """
+    parses a text or binary message into (type, N, args)
+      1a: (leader wss or None)
+      1b: (maxVBal, raw 1b for use as a proof)
+      1c: (value, [(wss, signed msg, sig)])
+      2b: ()
+      2n: (maxBal,)
+      st: (snapshot id, chunk)  N is the requester's last applied ballot
+      ri: ()  N is the read id
+      rr: (maxVBal,)
+      bf: (digest,)  N is the chunk, binary only
+      fa: (round, leader wss)
+      fb: (round, status, vote round, vote, raw fb for use as a proof)
+      fc: (round, leader wss, value, [(wss, signed msg, sig)])
+    raises ValueError, IndexError or KeyError for malformed messages
+    """
+    if binary is None:
+        binary = wire.is_binary(msg)
+    if binary:
+        msg_type, fields = wire.decode(msg)
+        return msg_type, wire.to_int(fields[1]), BINARY_PARSERS[msg_type](fields, msg)
+    msg_type = msg[:2]
+    proofs = None
+    if msg_type == "1c":
+        msg, proofs = msg.split('&;')
+    parts = msg.split('&')
+    return msg_type, int(parts[2]), TEXT_PARSERS[msg_type](parts, msg, proofs)
+
 class BPConProtocol:
     def __init__(self, conf, state):
         """
@@ -38,21 +169,80 @@ class BPConProtocol:
         self.maxVVal = None     # value voted for maxVBal
         self.avs = {}           # msg dict keyed by value (max ballot saved only)
         self.seen = {}          # 1b messages -> use to check if v is safe at b
-        self.bmsgs = []         # log of values in 2b messages sent by this instance       
-        self.Q = None
+        self.bmsgs = ReplicaLog(conf['log_capacity']) # decided values, for bringing peers up-to-date
+        self.instances = {}     # in-flight Quorum objects keyed by ballot
+        self.next_bal = 0       # next ballot slot to propose in
+        self.applied = -1       # highest ballot applied to state
+        self.ready = {}         # decided but unapplied values keyed by ballot
+        self.promised = set()   # unapplied ballots answered with a 1b
+        self.fill_rounds = {}   # unapplied slot -> (round, leader wss) of the fill promised for it
+        self.vote_rounds = {}   # unapplied slot -> fill round its vote came from, 0 for its ballot
+        self.filling = set()    # slots a fill_slot task is running for
+        self.gap_timer = None   # pending check_gap call
         
-        with open(conf['keyfile'], 'r') as fh:
-            key = RSA.importKey(fh.read())
-        self.signer = PKCS1_v1_5.new(key)
+        self.signer = load_signer(conf)
 
         # initialize localgroup
         self.peers = GroupManager(conf)
         self.peers.init_local_group()
         self.state = state
-        #self.state.groups['G1'] = self.peers
+        self.pool = self.peers.pool # signing, codec and snapshot work, see BPCon.workers
+        if isinstance(self.signer, KeyFile):
+            self.pool.submit(BACKGROUND, self.signer.get) # parses our key off the startup path
+        self.offload_bytes = conf['offload_bytes'] # text values longer than this are coded in the pool
+        self.blobs = blob_store(conf)
+        self.blob_threshold = conf['blob_threshold'] # longer proposals go through consensus as a reference
+        self.blob_refs = {}     # ballot -> digest of the blob its log entries refer to
+
+        self.window = asyncio.Semaphore(conf['pipeline_window'])
+        self.phase_timeout = conf['phase_timeout'] # seconds allowed per phase fan-out
+        self.binary = conf['wire_format'] == 'binary' # format of messages this node initiates
+
+        # stable leader: a successful phase 1 covers lease_ballots ballots
+        self.lease_ballots = conf['lease_ballots']
+        self.lease = None       # (first, last+1) ballots covered
+        self.lease_proofs = None
+
+        # read lease: acceptors answering our 1a ignore other leaders'
+        # 1a for read_lease seconds, so no other value can be decided
+        self.wss = conf['p_wss']
+        self.leader = None      # wss of the node last seen winning phase 1
+        self.read_lease = conf['read_lease']
+        self.read_lease_until = 0   # loop time our read lease runs out
+        self.lease_index = -1   # highest ballot voted in when the read lease was won
+        self.lease_grant = (None, 0) # (leader wss, loop time) we granted a read lease to
+        self.read_rounds = {}   # read id -> maxVBal replies of a read-index round
+        self.read_ids = itertools.count()
+        self.apply_waiters = [] # (ballot, future) resolved once applied reaches ballot
+
+        # durability: accepted ballots are logged before they are acknowledged
+        self.wal = WriteAheadLog(group_path(conf['wal_file'], conf['gid']), self.logger, conf['wal_sync_delay'])
+        self.snapshot_interval = conf['snapshot_interval'] # ballots between state snapshots
+        self.checkpointing = False  # a snapshot is being written in the background
+        self.checkpoint_pending = False # another was asked for meanwhile
+        self.recover()
+        self.transfer = StateTransfer(self, conf)
+        self.init_metrics(conf['gid'])
+        self.handlers = {'1a': self.on_1a, '1b': self.on_1b, '1c': self.on_1c, '2b': self.on_2b,
+                         '2n': self.on_2n, 'st': self.on_st, 'ri': self.on_ri, 'rr': self.on_rr,
+                         'bf': self.on_bf, 'fa': self.on_fa, 'fb': self.on_fb, 'fc': self.on_fc}
 
-        self.ctx = get_ssl_context(conf['peer_certs'])
-        self.pending = None
+    def init_metrics(self, gid):
+        # no-ops unless metrics are enabled, see BPCon.metrics
+        self.gid = gid
+        m = REGISTRY
+        self.m_ballots = {result: m.counter('ballots', group=gid, result=result)
+                          for result in ('started', 'committed', 'rejected', 'failed')}
+        self.m_phase = {phase: m.timer('phase_seconds', group=gid, phase=phase)
+                        for phase in ('1', '2', 'wal', 'apply')}
+        self.m_request = m.timer('request_seconds', group=gid)
+        self.m_sign = m.timer('sign_seconds', group=gid)
+        self.m_verify = m.timer('verify_seconds', group=gid)
+        self.m_sent = m.counter('wire_bytes', group=gid, direction='sent')
+        self.m_received = m.counter('wire_bytes', group=gid, direction='received')
+        m.gauge('ballots_in_flight', lambda: len(self.instances), group=gid)
+        m.gauge('ready_backlog', lambda: len(self.ready), group=gid)
+        m.gauge('applied_ballot', lambda: self.applied, group=gid)
     
     def sentMsgs(self, type_, bal):
         pass
@@ -61,92 +251,536 @@ class BPConProtocol:
         pass
 
     @asyncio.coroutine
-    def request(self, proposal, future):
+    def request(self, proposal, future, batch=False):
         """
         makes phase 1a proposal
         manages successful ballots
          state updates
-        returns succeed/fail boolean
+        proposal is one "t,k,v" op, or a newline separated batch of
+        them if batch is set (see BPCon.batching)
+        returns dict with result code (and per-op codes on commit)
+
+        up to pipeline_window requests run concurrently, each in its own
+        ballot slot, commits are applied in slot order
         """
         # bmsgs := bmsgs U ("1a", bal)
-        #if self.Q:
-        #    self.logger.error("Bad Client: prior quorum being managed for ballot {}".format(self.Q.N))
-        if not ',' in proposal:
+        ops = proposal.split('\n') if batch else [proposal]
+        if not all(valid_op(op) for op in ops):
             self.logger.error("db commit proposal not in key,value format")
             return {'code': 1} # invalid request failcase
 
-        self.pending = future
-        self.maxBal = self.maxVBal + 1
-        recipients = self.peers.get_all()
+        ref = None
+        if len(proposal) > self.blob_threshold:
+            # only a reference to the value is voted on, see BPCon.blobs
+            data = proposal.encode()
+            proposal = yield from self.pool.submit(CODEC, write_blob, self.blobs.directory, data)
+            ref = parse_ref(proposal)
+            self.blobs.hold(ref[0]) # until the ballot is decided, the log holds it from then on
+            if not self.blobs.has(ref[0]): # its last holder let go while it was written
+                yield from self.pool.submit(CODEC, write_blob, self.blobs.directory, data)
+
+        try:
+            with (yield from self.window):
+                N = self.next_ballot()
+                self.m_ballots['started'].inc()
+                with self.m_request.time(), REGISTRY.span('request', group=self.gid, ballot=N):
+                    res = yield from self.run_ballot(N, proposal)
+                    if res['code'] == 0:
+                        try:
+                            yield from self.persist(N, proposal)
+                            with self.m_phase['apply'].time():
+                                res['results'] = yield from self.commit_slot(N, proposal)
+                        except Exception as e:
+                            self.logger.info("update failed!")
+                            res = {'code': 1}
+                    else:
+                        # peers that voted for the proposal keep it in the running
+                        accepted = res.pop('accepted', False)
+                        fill = asyncio.ensure_future(self.fill_slot(N, proposal if accepted else None))
+                        if ref and accepted: # held until the fill has decided the slot
+                            digest, ref = ref[0], None
+                            fill.add_done_callback(lambda f: self.blobs.release(digest))
+                self.m_ballots[{0: 'committed', 2: 'rejected'}.get(res['code'], 'failed')].inc()
+        finally:
+            if ref:
+                self.blobs.release(ref[0])
 
+        if not future.done():
+            future.set_result(res)
+        return res 
+
+    def next_ballot(self):
+        N = max(self.next_bal, self.maxVBal + 1, self.applied + 1)
+        self.next_bal = N + 1
+        self.maxBal = max(self.maxBal, N)
+        return N
+
+    @asyncio.coroutine
+    def run_ballot(self, N, proposal):
+        """
+        consensus instance for ballot slot N
+        """
+        recipients = self.peers.get_all()
+        res = {'code': 1} # failcase unless a branch below succeeds
         if not len(recipients): # no localgroup peers
-            self.maxVBal += 1
-            self.bmsgs.append(proposal)
-            self.state.update(proposal,self.maxBal) # necessary to avoid including self in every round
-            res = {'code': 0} # success case
+            self.maxVBal = max(self.maxVBal, N)
+            return {'code': 0} # success case, necessary to avoid including self in every round
+
+        Q = Quorum(N, self.peers.num_peers, self.binary)
+        self.instances[N] = Q
+        try:
+            if self.holds_lease(N):
+                # stable leader: phase 1 of the lease ballot still covers this one
+                self.logger.debug("ballot %s covered by lease %s, skipping phase 1", N, self.lease)
+                res = yield from self.accept_phase(Q, proposal, recipients, self.lease_proofs)
 
-        else:
-            self.Q = Quorum(self.maxBal, self.peers.num_peers)
-            self.logger.debug("creating Quorum object with N={}, num_peers={}".format(self.maxBal, self.peers.num_peers))
-            self.logger.debug("sending 1a -> {}: {}".format(self.maxBal, proposal))
-            msg_1a = "1a&{}&{}".format(str(time.time()),self.maxBal)
-            yield from asyncio.async(self.send_msg(msg_1a, recipients, self.handle_msg)) # collect stats here
-        
-            if self.pending.done():
-                # Error case (possibly unneccessary)
-                self.logger.error("future done before voting complete")
             else:
-                if self.Q.quorum_1b():
-                    if self.Q.got_majority_accept():
-                        self.logger.info("1: quorum of {} accepts".format(self.Q.quorum))
-                        val_bytes = proposal.encode()
-                        length = len(val_bytes)
-                        prepped_val = str(length)+"<>"+str(int.from_bytes(val_bytes, byteorder='little'))
-                        yield from self.send_msg(self.phase1c(prepped_val), recipients, self.handle_msg) # send 1c
-                        self.maxVBal = self.Q.N
-                        self.maxVVal = proposal
-                        if self.Q.quorum_2b():
-                            # Quorum Accepts and Commit succeeds case
-                            self.logger.info("2: quorum accepts")
-                            #self.logger.info("Quorum Accepted Value {} at Ballot {}".format(proposal,self.Q.N))
-                            try:
-                                self.state.update(proposal, self.Q.N)
-                                res = {'code': 0} # succeeded
-                            except Exception as e:
-                                self.logger.info("update failed!")
-                                res = {'code': 1}
-                        else:
-                            # Quorum Accepts then Commit fails case
-                            self.logger.info("2b failure: quorum1 accepts but quorum2 failed")
+                self.logger.debug("creating Quorum object with N=%s, num_peers=%s", N, self.peers.num_peers)
+                self.logger.debug("sending 1a -> %s: %s", N, proposal)
+                started = asyncio.get_event_loop().time()
+                with self.m_phase['1'].time(), REGISTRY.span('phase1', group=self.gid, ballot=N):
+                    yield from self.send_msg(self.phase1a(N), recipients, self.handle_msg, Q.quorum_1b)
+        
+                if Q.quorum_1b():
+                    if Q.got_majority_accept():
+                        self.logger.info("1: quorum of %s accepts", Q.quorum)
+                        self.leader = self.wss
+                        proofs = Q.get_proofs() if self.binary else Q.get_msgs()
+                        if self.lease_ballots:
+                            self.lease = (N, N + self.lease_ballots)
+                            self.lease_proofs = proofs
+                        if self.read_lease:
+                            self.read_lease_until = started + self.read_lease
+                            self.lease_index = Q.max_vbal
+                            self.lease_grant = (self.wss, self.read_lease_until) # our own acceptor honours it too
+                        res = yield from self.accept_phase(Q, proposal, recipients, proofs)
                     else:
                         # Quorum Rejects case -> reconfigure!
-                        self.logger.info("failure: quorum1 rejects {} for ballot {}".format(proposal, self.Q.N))
-                        good_peer = self.Q.rejecting_quorum_member()
+                        self.logger.info("failure: quorum1 rejects %s for ballot %s", proposal, N)
+                        good_peer = Q.rejecting_quorum_member()
+                        if good_peer:
+                            self.transfer.start(good_peer)
                         res = {'code': 2, 'value': good_peer} # corrupt state failcase, wss of an up-to-date peer
                 else:
                     self.logger.info("failure: quorum1 not acquired")
+        finally:
+            self.instances.pop(N, None)
+        return res
 
-        if not self.pending.done():
-            self.pending.set_result(res)
-        return res 
-        
-    def phase1b(self, N):
+    @asyncio.coroutine
+    def accept_phase(self, Q, proposal, recipients, proofs):
+        """
+        sends 1c for Q.N backed by proofs, collects 2b votes
+        """
+        res = {'code': 1}
+        timeout = None
+        ref = parse_ref(proposal)
+        if ref:
+            # acceptors fetch the value before they vote
+            timeout = self.phase_timeout * (1 + ref[1] // self.blobs.chunk_bytes)
+        with self.m_phase['2'].time(), REGISTRY.span('phase2', group=self.gid, ballot=Q.N):
+            msg_1c = yield from self.phase1c(Q.N, proposal, proofs)
+            yield from self.send_msg(msg_1c, recipients, self.handle_msg, Q.resolved_2b, timeout) # send 1c
+        if Q.N > self.maxVBal:
+            self.maxVBal = Q.N
+            # as acceptors hold it, text 1b proofs cannot carry the raw value's commas
+            self.maxVVal = proposal if self.binary else msg_1c.split('&', 4)[3]
+        if Q.quorum_2b():
+            # Quorum Accepts and Commit succeeds case
+            self.logger.info("2: quorum accepts")
+            res = {'code': 0}
+        else:
+            # Quorum Accepts then Commit fails case
+            self.logger.info("2b failure: quorum1 accepts but quorum2 failed")
+            self.lease = None # a higher ballot may have been promised
+            self.read_lease_until = 0
+            res['accepted'] = Q.commits > 0
+        return res
+
+    def commit_slot(self, N, value):
+        """
+        queues a decided value, returns future for its per-op results
+        resolved once every lower slot has been applied
+        """
+        future = asyncio.Future()
+        self.ready[N] = (value, future)
+        self.apply_ready()
+        return future
+
+    def apply_ready(self):
+        # apply decided slots in order, stopping at the first gap or a running keyspace change
+        while self.applied + 1 in self.ready and self.state.pending is None:
+            self.applied += 1
+            value, future = self.ready.pop(self.applied)
+            self.bmsgs.append(self.applied, value) # saving state update values for bringing peers up-to-date
+            try:
+                results = self.state.update(value, self.applied)
+            except Exception as e:
+                self.logger.error("update for ballot {} failed: {}".format(self.applied, e))
+                if future and not future.done():
+                    future.set_exception(e)
+                continue
+            if self.state.pending is not None:
+                self.state.pending.add_done_callback(functools.partial(self.change_done, results, future))
+                continue
+            if future and not future.done():
+                future.set_result(results)
+        self.promised = set(n for n in self.promised if n > self.applied)
+        if self.fill_rounds or self.vote_rounds:
+            self.fill_rounds = {n: r for n, r in self.fill_rounds.items() if n > self.applied}
+            self.vote_rounds = {n: r for n, r in self.vote_rounds.items() if n > self.applied}
+        if self.ready:
+            self.watch_gap()
+        if self.apply_waiters:
+            waiting = []
+            for b, future in self.apply_waiters:
+                if b <= self.applied and not future.done():
+                    future.set_result(self.applied)
+                elif not future.done():
+                    waiting.append((b, future))
+            self.apply_waiters = waiting
+        if not self.checkpointing and self.applied - self.checkpointed >= self.snapshot_interval:
+            self.checkpoint()
+
+    def change_done(self, results, future, job):
+        # a keyspace change finished, the slots behind it can apply
+        self.state.pending = None
+        try:
+            results[0] = job.result()
+        except Exception as e:
+            self.logger.error("keyspace change at ballot {} failed: {}".format(self.applied, e))
+            results[0] = 1
+        if future and not future.done():
+            future.set_result(results)
+        if self.checkpoint_pending and not self.checkpointing:
+            self.checkpoint_pending = False
+            self.checkpoint()
+        self.apply_ready()
+
+    @asyncio.coroutine
+    def persist(self, N, value):
+        # group-committed with other ballots syncing at the same time
+        self.track_blob(N, value)
+        self.wal.append(N, value)
+        with self.m_phase['wal'].time():
+            yield from self.wal.sync()
+
+    def checkpoint(self):
+        """
+        snapshots state on the pool's background thread, the log
+        entries it covers are dropped once it is written
+        """
+        if self.checkpointing or self.state.pending is not None: # an image now would miss part of the change
+            self.checkpoint_pending = True
+            return
+        self.checkpointing = True
+        try:
+            job = self.pool.submit(BACKGROUND, self.state.image_job())
+        except Exception as e:
+            self.checkpointing = False
+            self.logger.error("checkpoint at ballot {} failed: {}".format(self.applied, e))
+            return
+        job.add_done_callback(functools.partial(self.checkpoint_done, self.applied))
+
+    def checkpoint_done(self, applied, job):
+        self.checkpointing = False
+        try:
+            if job.result(): # False if a newer image was written meanwhile
+                self.wal.truncate(applied)
+                self.bmsgs.truncate(applied)
+                self.checkpointed = max(self.checkpointed, applied)
+                for b in [b for b in self.blob_refs if b <= applied]:
+                    self.blobs.release(self.blob_refs.pop(b))
+        except Exception as e:
+            self.logger.error("checkpoint at ballot {} failed: {}".format(applied, e))
+        if self.checkpoint_pending:
+            self.checkpoint_pending = False
+            self.checkpoint()
+
+    def recover(self):
+        """
+        replays the write-ahead log on top of the last state snapshot
+        """
+        self.applied = self.state.ballot
+        self.checkpointed = self.applied
+        self.bmsgs.reset(self.applied)
+        votes = {}
+        for ballot, value in self.wal.replay():
+            if ballot > self.applied:
+                votes[ballot] = value # a later vote for a ballot replaces an earlier one
+        for ballot, value in votes.items():
+            self.track_blob(ballot, value)
+            self.ready[ballot] = (value, None)
+            self.maxVBal = max(self.maxVBal, ballot)
+        self.maxVBal = max(self.maxVBal, self.applied)
+        self.apply_ready()
+        if votes:
+            self.logger.info("recovered {} ballots from wal, applied up to {}".format(len(votes), self.applied))
+
+    def track_blob(self, N, value):
+        # keeps the blob a logged value refers to until a checkpoint covers ballot N
+        ref = parse_ref(value)
+        if ref:
+            self.blobs.hold(ref[0])
+        old = self.blob_refs.pop(N, None)
+        if ref:
+            self.blob_refs[N] = ref[0]
+        if old:
+            self.blobs.release(old)
+
+    @asyncio.coroutine
+    def fetch_blob(self, value, sources=None):
+        """
+        True unless value refers to a blob that could not be fetched,
+        tried from the leader first, then the other peers
+        """
+        ref = parse_ref(value)
+        if ref is None:
+            return True
+        if sources is None:
+            sources = [self.leader] if self.leader and self.leader != self.wss else []
+            sources += [p for p in self.peers.get_all() if p not in sources]
+        return (yield from self.blobs.fetch(ref[0], ref[1], sources, self.peers.connections))
+
+    @asyncio.coroutine
+    def fill_slot(self, N, value=None):
+        """
+        decides slot N after its ballot failed so later slots can apply
+
+        runs fill rounds above any the slot has seen, each adopting the
+        latest vote a promising peer reports, else value (the failed
+        proposal, if a peer voted for it) or a no-op. A peer that has
+        applied the slot already hands it over by state transfer.
+        """
+        if N in self.filling:
+            return
+        self.filling.add(N)
+        delay = self.phase_timeout
+        round_ = 0
+        try:
+            while N > self.applied and N not in self.ready:
+                round_ = max(round_, self.fill_rounds.get(N, (0, ''))[0]) + 1
+                res = yield from self.fill_round(N, round_, value)
+                if res['code'] == 0:
+                    continue
+                if res['code'] == 2:
+                    self.logger.info("ballot %s applied at %s, catching up", N, res['value'])
+                    self.transfer.start(res['value'])
+                    yield from asyncio.shield(self.transfer.running)
+                    if N <= self.applied or N in self.ready:
+                        break
+                round_ = max(round_, res.get('round', 0))
+                self.logger.info("fill round %s of ballot %s failed, retrying in %ss", round_, N, delay)
+                yield from asyncio.sleep(delay)
+                delay = min(delay * 2, 8 * self.phase_timeout)
+        finally:
+            self.filling.discard(N)
+
+    @asyncio.coroutine
+    def fill_round(self, N, round_, value):
+        """
+        one fill round for slot N, returns dict with result code, the
+        wss of a peer that applied the slot (code 2) or the highest
+        round a refusing peer promised
+        """
+        if self.lease_held_by_other(self.wss):
+            return {'code': 1} # retried once the lease has run out
+        recipients = self.peers.get_all()
+        self.fill_rounds[N] = (round_, self.wss) # our own promise
+        F = FillQuorum(N, round_, self.peers.num_peers)
+        self.instances[N] = F
+        try:
+            if recipients:
+                msg_fa = wire.encode("fa", [time.time(), N, round_, self.wss])
+                yield from self.send_msg(msg_fa, recipients, self.handle_msg,
+                                         lambda: F.resolved_fb(len(recipients)))
+                if F.applied_by:
+                    return {'code': 2, 'value': F.applied_by}
+                if not F.prepared():
+                    return {'code': 1, 'round': F.max_promised}
+            if F.vote is not None:
+                value = bytes(F.vote)
+            elif value is None:
+                value = NOOP
+            if not (yield from self.fetch_blob(value)):
+                return {'code': 1}
+            if recipients:
+                count, packed = F.get_proofs()
+                msg_fc = wire.encode("fc", [time.time(), N, round_, self.wss, value], count=5 + 2 * count) + packed
+                yield from self.send_msg(msg_fc, recipients, self.handle_msg, F.resolved_2b)
+                if not F.quorum_2b():
+                    return {'code': 1, 'round': F.max_promised}
+        finally:
+            self.instances.pop(N, None)
+        yield from self.persist(N, value)
+        if N > self.applied:
+            self.commit_slot(N, value)
+        self.logger.info("filled ballot %s in round %s", N, round_)
+        return {'code': 0}
+
+    def watch_gap(self):
+        if self.gap_timer is None:
+            self.gap_timer = asyncio.get_event_loop().call_later(2 * self.phase_timeout, self.check_gap, self.applied)
+
+    def check_gap(self, applied):
+        """
+        fills the slot holding back decided ones if no progress was
+        made since watch_gap, whoever ran its ballot
+        """
+        self.gap_timer = None
+        if not self.ready:
+            return
+        gap = self.applied + 1
+        if self.applied == applied and gap not in self.instances:
+            self.logger.info("ballot %s still missing, filling it", gap)
+            asyncio.ensure_future(self.fill_slot(gap))
+        self.watch_gap()
+
+    def holds_lease(self, b):
+        return self.lease is not None and self.lease[0] <= b < self.lease[1]
+
+    def holds_read_lease(self):
+        return asyncio.get_event_loop().time() < self.read_lease_until
+
+    @asyncio.coroutine
+    def read(self, key, mode='lease', max_lag=0):
+        """
+        reads key without running a ballot
+          lease -- served locally while this node holds the read lease,
+                   otherwise falls back to a read-index round
+          index -- one round to learn the highest ballot a quorum voted
+                   in, served once this node has applied up to it
+          stale -- served locally if at most max_lag ballots behind
+        returns dict with result code and value (None if unset)
+        """
+        if mode == 'stale':
+            if max(self.maxBal, self.maxVBal) - self.applied > max_lag:
+                return {'code': 1} # too far behind
+            return {'code': 0, 'value': self.state.read(key)}
+
+        if mode == 'lease' and self.holds_read_lease():
+            index = max(self.maxVBal, self.lease_index)
+        else:
+            index = yield from self.read_index()
+            if index is None:
+                return {'code': 1}
+        try:
+            yield from asyncio.wait_for(self.wait_applied(index), self.phase_timeout)
+        except asyncio.TimeoutError:
+            self.logger.info("read timed out waiting for ballot %s", index)
+            return {'code': 1}
+        return {'code': 0, 'value': self.state.read(key)}
+
+    @asyncio.coroutine
+    def read_index(self):
+        """
+        highest ballot voted in by a quorum including this node,
+        covers every value committed before the read started
+        """
+        rid = next(self.read_ids)
+        votes = [self.maxVBal]
+        self.read_rounds[rid] = votes
+        quorum = self.peers.quorum_size() + 1 # our own vote is in already
+        try:
+            if len(votes) < quorum:
+                yield from self.send_msg(self.read_query(rid), self.peers.get_all(), self.handle_msg,
+                                         lambda: len(votes) >= quorum)
+        finally:
+            self.read_rounds.pop(rid, None)
+        if len(votes) < quorum:
+            self.logger.info("read-index round %s got %s/%s replies", rid, len(votes), quorum)
+            return None
+        return max(votes)
+
+    def read_query(self, rid):
+        if self.binary:
+            return wire.encode("ri", [time.time(), rid])
+        return "ri&{}&{}".format(str(time.time()), rid)
+
+    def read_reply(self, rid, binary=False):
+        if binary:
+            return wire.encode("rr", [time.time(), rid, self.maxVBal])
+        return "rr&{}&{}&{}".format(str(time.time()), rid, self.maxVBal)
+
+    @asyncio.coroutine
+    def wait_applied(self, b):
+        if self.applied >= b:
+            return self.applied
+        future = asyncio.Future()
+        self.apply_waiters.append((b, future))
+        return (yield from future)
+
+    def phase1a(self, N):
+        # bmsgs := bmsgs U ("1a", bal)
+        if self.binary:
+            return wire.encode("1a", [time.time(), N, self.wss])
+        return "1a&{}&{}&{}".format(str(time.time()),N,self.wss)
+
+    def grant_read_lease(self, leader):
+        """
+        False while another leader's read lease is running
+        """
+        if not self.read_lease or leader is None:
+            return True
+        if self.lease_held_by_other(leader):
+            return False
+        self.lease_grant = (leader, asyncio.get_event_loop().time() + self.read_lease)
+        return True
+
+    def lease_held_by_other(self, leader):
+        # a slot decided now could be missed by the holder's lease reads
+        holder, until = self.lease_grant
+        return bool(self.read_lease) and holder != leader and asyncio.get_event_loop().time() < until
+
+    @asyncio.coroutine
+    def phase1b(self, N, binary=False, leader=None):
         # bmsgs := bmsgs U ("1b", bal, acceptor, self.avs, self.maxVBal, self.maxVVal)
         
+        if not self.grant_read_lease(leader):
+            self.logger.info("ignoring 1a for ballot %s from %s, read lease held by %s", N, leader, self.lease_grant[0])
+            return None
         if (int(N) > int(self.maxBal)): #maxbal type undefined behavior sometimes 
             self.maxBal = N
+            if leader:
+                self.leader = leader
+        if N > self.applied:
+            self.promised.add(N)
+        if self.lease:
+            self.logger.info("another leader is running phase 1 at ballot %s, dropping lease", N)
+            self.lease = None
+        self.read_lease_until = 0
+
+        if binary:
+            msg_1b = wire.encode("1b", [time.time(), N, self.maxVBal, self.maxVVal, str(self.avs)], count=6)
+            sig = yield from self.sign(msg_1b)
+            return msg_1b + wire.pack_fields([sig])
+
         msg_1b = "1b&{}&{}&{}&{}&{}".format(str(time.time()),N,self.maxVBal,self.maxVVal,self.avs)
-        msg_hash = SHA.new(msg_1b.encode())
-        sig = self.signer.sign(msg_hash)
+        sig = yield from self.sign(msg_1b.encode())
         
         tosend = msg_1b + ";" + str(int.from_bytes(sig, byteorder='little'))
-        self.logger.debug("sending 1b -> {}".format(tosend))
+        self.logger.debug("sending 1b -> %s", tosend)
         return tosend
-            
-    def phase1c(self, val):
+
+    @asyncio.coroutine
+    def sign(self, msg):
+        # off the event loop, signing is the costliest step of a 1b
+        with self.m_sign.time():
+            return (yield from self.pool.call(CONSENSUS, self.signer, 'sign', msg))
+
+    @asyncio.coroutine
+    def phase1c(self, N, proposal, proofs):
         # bmsgs := bmsgs U ("1c", bal, val)
-        self.logger.debug("sending 1c -> {}: {}".format(self.Q.N, val))
-        tosend = "1c&{}&{}&{}&;{}".format(str(time.time()),self.Q.N, val, self.Q.get_msgs())
+        self.logger.debug("sending 1c -> %s: %s", N, proposal)
+        if self.binary:
+            count, packed = proofs # pre-encoded by Quorum.get_proofs
+            return wire.encode("1c", [time.time(), N, proposal], count=3 + 2 * count) + packed
+
+        if len(proposal) > self.offload_bytes: # bigint conversion grows quadratically
+            prepped_val = yield from self.pool.submit(CODEC, wire.encode_text_value, proposal)
+        else:
+            prepped_val = wire.encode_text_value(proposal)
+        tosend = "1c&{}&{}&{}&;{}".format(str(time.time()),N, prepped_val, proofs)
         return tosend
 
     @asyncio.coroutine
@@ -157,132 +791,313 @@ class BPConProtocol:
             # remove r from avs where r.val == m.val
             self.maxBal = b
 
-    def phase2b(self, b, v):
+    @asyncio.coroutine
+    def phase2b(self, b, v, binary=False, decoded=None):
         # bmsgs := bmsgs U ("2b", m.bal, m.val, acceptor)
-        if int(self.maxBal) <= int(b): 
+        # b is acceptable if promised to its 1a, or covered by the
+        # current leader's phase 1 (no higher ballot promised since)
+        if b > self.applied and b not in self.fill_rounds and (b in self.promised or int(self.maxBal) <= int(b)): 
             # exists (2av, b) pairing in sentMsgs that quorum of acceptors agree upon
             
-            self.maxVVal = v
-            self.maxBal = b
-            self.maxVBal = b
-
-            self.bmsgs.append(m.val) # saving state update values for bringing peers up-to-date
+            if b > self.maxVBal:
+                self.maxVVal = v
+                self.maxVBal = b
 
-            self.logger.info(self.bmsgs)
-            self.state.update(v, b)
+            yield from self.persist(b, v)
+            if b > self.applied: # may have been applied while syncing
+                self.ready[b] = (v if decoded is None else decoded, None)
+                self.apply_ready()
+            if binary:
+                return wire.encode("2b", [time.time(), b])
             tosend = "2b&{}&{}&{}".format(str(time.time()), b, v)
             return tosend
+        else:
+            # promised a higher ballot, a fill or already applied, tell the (possibly leased) leader
+            if binary:
+                return wire.encode("2n", [time.time(), b, self.maxBal])
+            return "2n&{}&{}&{}".format(str(time.time()), b, self.maxBal)
 
     @asyncio.coroutine
     def main_loop(self, websocket, path):
         """
         server socket
+
+        serves every message a peer sends over its persistent connection,
+        tagged ones each in their own task so pipelined ballots waiting
+        on the wal share its fsyncs instead of queueing behind each other
         """ 
         self.logger.debug("main loop")
+        sending = asyncio.Lock() # one reply frame at a time
+        inflight = asyncio.Semaphore(PEER_INFLIGHT)
         # idle until receives network input
         try:
-            input_msg = yield from websocket.recv()
-            self.logger.debug("< {}".format(input_msg))
-            output_msg = self.handle_msg(input_msg)
-            if output_msg:
-                yield from websocket.send(output_msg)
-                self.bmsgs.append(output_msg)
-                #print(self.bmsgs)
-            else:
-                self.logger.error("got bad input from peer")
+            while True:
+                raw = yield from websocket.recv()
+                if raw is None: # closed
+                    break
+                if not tagged(raw): # single-shot, answered in order
+                    yield from self.answer(websocket, raw, sending)
+                    continue
+                yield from inflight.acquire() # stop reading while the peer has too many in flight
+                task = asyncio.ensure_future(self.answer(websocket, raw, sending))
+                task.add_done_callback(lambda t: inflight.release())
+        except websockets.exceptions.ConnectionClosed:
+            self.logger.debug("peer closed connection")
         except Exception as e:
             self.logger.error("mainloop exception: {}".format(e))
-        self.logger.debug("Pending tasks after mainloop: %i" % len(asyncio.Task.all_tasks(asyncio.get_event_loop())))    
+        if self.logger.isEnabledFor(logging.DEBUG): # counting tasks walks all of them
+            self.logger.debug("Pending tasks after mainloop: %i", len(asyncio.Task.all_tasks(asyncio.get_event_loop())))
 
+    @asyncio.coroutine
+    def answer(self, websocket, raw, sending):
+        try:
+            reply = yield from self.serve_msg(raw)
+            if reply:
+                with (yield from sending):
+                    yield from websocket.send(reply)
+        except websockets.exceptions.ConnectionClosed:
+            self.logger.debug("peer closed connection before the reply")
+        except Exception as e:
+            self.logger.error("serving peer message failed: {}".format(e))
 
-    def preprocess_msg(self, msg): # TODO verification
-        return msg.split('&')
+    @asyncio.coroutine
+    def serve_msg(self, raw):
+        """
+        answers one frame a peer sent, as received from its socket or
+        relayed by a front end (see BPCon.frontends), None for no reply
+        """
+        self.logger.debug("< %s", raw)
+        self.m_received.inc(len(raw))
+        cid, input_msg = unwrap(raw)
+        output_msg = yield from self.handle_msg(input_msg)
+        if output_msg:
+            self.m_sent.inc(len(output_msg))
+            return wrap(cid, output_msg) if cid is not None else output_msg
+        self.logger.error("got bad input from peer")
 
-    def handle_msg(self, msg, peer_wss=None):    
-        msg_type = msg[:2]
-        if msg_type == "1c":
-            msg,proofs = msg.split('&;')
-        parts = self.preprocess_msg(msg)
-        num_parts = len(parts)
-        timestamp = parts[1]
-        N = int(parts[2])
+    def preprocess_msg(self, msg, binary=None): # TODO verification
+        """
+        parse_msg, None for malformed messages
+        """
+        try:
+            return parse_msg(msg, binary)
+        except (ValueError, IndexError, KeyError) as e:
+            self.logger.debug("malformed message: %s", e)
+            return None
 
-        
-        if msg_type == "1a" and num_parts == 3:
-            # a peer is leader for a ballot, requesting votes
-            output_msg = self.phase1b(N)
-            return output_msg
-            
-        elif msg_type == "1b" and num_parts == 6:
-            # implies is leader for ballot, has quorum object
-            self.logger.debug("got 1b!!!")
-            [mb,mv,avs] = parts[3:6]
-            # do stuff with v and 2avs
-            # update avs structure here for newest ballot number for value
-            if N == self.Q.N:
-                self.Q.add_1b(int(mb), msg, peer_wss)
-            else:
-                self.logger.error("got bad 1b msg")
-                 
-        elif msg_type == "1c" and num_parts == 4:
-            self.logger.debug("got 1c")
-            v = parts[3]
-            signed_msgs = proofs.split(',') # 1b proofs in wss;msg;sig format
-            if len(signed_msgs) <= self.peers.num_peers:
-                # test against pubkey
-                self.logger.debug("testing sig here...")
-                num_verified = self.peers.verify_sigs(signed_msgs)
-                
-                if num_verified >= self.peers.quorum_size():
-                    self.logger.debug("signature verification succeeded")
-                    output_msg = self.phase2b(N,v)
-                    return output_msg
-                else:
-                    self.logger.error("signature verification failed")
-            else:
-                self.logger.error("too many signatures")
- 
-        elif msg_type == "2b" and num_parts == 4:
-            self.logger.debug("got 2b")
-            self.Q.add_2b(N)
-        else:
+    @asyncio.coroutine
+    def handle_msg(self, msg, peer_wss=None):
+        binary = wire.is_binary(msg)
+        parsed = self.preprocess_msg(msg, binary)
+        if parsed is None:
             self.logger.info("non-paxos msg received")
+            return
+        msg_type, N, args = parsed
+        return (yield from self.handlers[msg_type](N, args, binary, peer_wss))
+
+    @asyncio.coroutine
+    def on_1a(self, N, args, binary, peer_wss):
+        # a peer is leader for a ballot, requesting votes
+        with REGISTRY.span('phase1b', group=self.gid, ballot=N):
+            return (yield from self.phase1b(N, binary, args[0]))
+
+    @asyncio.coroutine
+    def on_1b(self, N, args, binary, peer_wss):
+        # implies is leader for ballot, has quorum object
+        mb, proof = args
+        Q = self.instances.get(N)
+        if Q is not None:
+            Q.add_1b(mb, bytes(proof) if binary else proof, peer_wss)
+        else:
+            self.logger.error("got bad 1b msg")
+
+    @asyncio.coroutine
+    def on_1c(self, N, args, binary, peer_wss):
+        v, signed_msgs = args
+        if len(signed_msgs) > self.peers.num_peers:
+            self.logger.error("too many signatures")
+            return
+        needed = self.peers.quorum_size()
+        with self.m_verify.time(), REGISTRY.span('verify_sigs', group=self.gid, ballot=N):
+            num_verified = yield from self.peers.verify_sigs(signed_msgs, needed)
+        if num_verified < needed:
+            self.logger.error("signature verification failed")
+            return
+        if not (yield from self.fetch_blob(v)):
+            self.logger.error("value of ballot {} could not be fetched".format(N))
+            return
+        decoded = None
+        if binary:
+            v = bytes(v)
+        elif len(v) > self.offload_bytes and not ',' in v:
+            # votes and the wal keep the encoded form, state gets it decoded
+            decoded = yield from self.pool.submit(CODEC, wire.decode_text_value, v)
+        with REGISTRY.span('phase2b', group=self.gid, ballot=N):
+            return (yield from self.phase2b(N, v, binary, decoded))
+
+    @asyncio.coroutine
+    def on_2b(self, N, args, binary, peer_wss):
+        Q = self.instances.get(N)
+        if Q is not None:
+            Q.add_2b(N)
+
+    @asyncio.coroutine
+    def on_2n(self, N, args, binary, peer_wss):
+        Q = self.instances.get(N)
+        if Q is not None:
+            Q.add_2n(N, args[0])
+
+    @asyncio.coroutine
+    def on_st(self, N, args, binary, peer_wss):
+        # a lagging peer pulling state
+        return self.transfer.serve(N, *args)
+
+    @asyncio.coroutine
+    def on_bf(self, N, args, binary, peer_wss):
+        # a peer fetching a chunk of a large value
+        return self.blobs.serve(N, args[0])
+
+    @asyncio.coroutine
+    def on_fa(self, N, args, binary, peer_wss):
+        # a peer filling slot N, promises its round and reports our vote
+        ballot = tuple(args)
+        if N <= self.applied:
+            return wire.encode("fb", [time.time(), N, ballot[0], APPLIED, -1, b'', b''])
+        promised = self.fill_rounds.get(N, (0, ''))
+        if ballot <= promised or self.lease_held_by_other(ballot[1]):
+            return wire.encode("fb", [time.time(), N, ballot[0], REFUSED, promised[0], b'', b''])
+        self.fill_rounds[N] = ballot
+        vote_round, vote = -1, b''
+        if N in self.ready:
+            vote_round, vote = self.vote_rounds.get(N, 0), self.ready[N][0]
+        msg_fb = wire.encode("fb", [time.time(), N, ballot[0], PROMISED, vote_round, vote], count=7)
+        sig = yield from self.sign(msg_fb)
+        return msg_fb + wire.pack_fields([sig])
+
+    @asyncio.coroutine
+    def on_fb(self, N, args, binary, peer_wss):
+        round_, status, vote_round, vote, proof = args
+        F = self.instances.get(N)
+        if isinstance(F, FillQuorum) and F.round == round_:
+            F.add_fb(status, vote_round, vote, bytes(proof), peer_wss)
+        else:
+            self.logger.error("got bad fb msg")
+
+    @asyncio.coroutine
+    def on_fc(self, N, args, binary, peer_wss):
+        round_, leader, v, signed_msgs = args
+        needed = self.peers.quorum_size()
+        num_verified = yield from self.peers.verify_sigs(signed_msgs, needed)
+        if num_verified < needed:
+            self.logger.error("signature verification failed")
+            return
+        if not (yield from self.fetch_blob(v)):
+            self.logger.error("value of ballot {} could not be fetched".format(N))
+            return
+        v = bytes(v)
+        if N > self.applied and (round_, leader) >= self.fill_rounds.get(N, (0, '')) and not self.lease_held_by_other(leader):
+            self.fill_rounds[N] = (round_, leader)
+            self.vote_rounds[N] = round_
+            yield from self.persist(N, v)
+            if N > self.applied: # may have been applied while syncing
+                self.ready[N] = (v, None)
+                self.apply_ready()
+            return wire.encode("2b", [time.time(), N])
+        return wire.encode("2n", [time.time(), N, self.fill_rounds.get(N, (0, ''))[0]])
 
     @asyncio.coroutine
-    def send_msg(self, to_send, recipient_list, handler_function=None):
+    def on_ri(self, N, args, binary, peer_wss):
+        return self.read_reply(N, binary)
+
+    @asyncio.coroutine
+    def on_rr(self, N, args, binary, peer_wss):
+        votes = self.read_rounds.get(N)
+        if votes is not None:
+            votes.append(args[0])
+
+    @asyncio.coroutine
+    def send_msg(self, to_send, recipient_list, handler_function=None, done_test=None, timeout=None):
         """
         client socket 
 
-        returns list of latencies
+        contacts all peers concurrently, handling replies as they arrive
+        returns once done_test() is satisfied or the phase deadline passes,
+        cancelling any peers that have not answered yet, timeout
+        replaces the adaptive deadline
+
+        peers suspected dead are left out and the deadline adapts to
+        the measured latency of the peers needed for a quorum
         """
         good_peers = 0
         peer_latencies = {}
         input_msg = None
+        tasks = {}
+        needed = self.peers.quorum_size() # Quorum counts peer replies only
+        recipient_list = self.peers.fanout(recipient_list, needed)
         for ws in recipient_list:
-            send_start = time.time()
-            try:
-                #self.logger.debug("sending {} to {}".format(to_send, ws))
-                client_socket = yield from websockets.connect(ws, ssl=self.ctx)
-                self.logger.debug("to_send: {}".format(to_send))
-                yield from client_socket.send(to_send)
-               
-                input_msg = yield from client_socket.recv()
-                peer_latencies[ws] = time.time() - send_start
-                self.logger.debug("input_msg: {}".format(input_msg))
-                if handler_function:
-                    handler_function(input_msg, ws)
-                good_peers += 1
-            except Exception as e: # custom error handling
-                self.logger.debug("send to peer {} failed: {}".format(ws,e))
-                peer_latencies[ws] = -1
-            finally:
-                try:
-                    yield from client_socket.close()
-                except Exception as e:
-                    self.logger.debug("no socket to close")
-
-        self.logger.info("Peers: {}/{}".format(good_peers, len(recipient_list)))     
-        self.logger.info("Peer Latencies: {}".format(peer_latencies))
+            tasks[asyncio.ensure_future(self.send_one(to_send, ws))] = ws
+
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        if timeout is None:
+            timeout = self.peers.phase_deadline(recipient_list, needed, self.phase_timeout)
+        deadline = started + timeout
+        pending = set(tasks)
+        answered = False
+        while pending:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                self.logger.debug("phase deadline passed")
+                break
+            done, pending = yield from asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                ws = tasks[task]
+                reply, latency = task.result()
+                peer_latencies[ws] = latency
+                if latency >= 0:
+                    self.peers.record_reply(ws, latency)
+                else:
+                    self.peers.record_failure(ws, loop.time() - started)
+                if reply is not None:
+                    input_msg = reply
+                    self.logger.debug("input_msg: %s", input_msg)
+                    if handler_function:
+                        yield from handler_function(input_msg, ws)
+                    good_peers += 1
+            if done_test and done_test():
+                answered = True
+                break
+
+        for task in pending: # stragglers
+            task.cancel()
+            peer_latencies[tasks[task]] = -1
+            if not answered: # cut off by a quorum says nothing about the peer
+                self.peers.record_failure(tasks[task], loop.time() - started)
+
+        # formatted only if debug logging is on, this runs for every phase
+        self.logger.debug("Peers: %d/%d", good_peers, len(recipient_list))
+        self.logger.debug("Peer Latencies: %s", peer_latencies)
         
         if not handler_function: # TODO what is this for?
             return input_msg
+
+    @asyncio.coroutine
+    def send_one(self, to_send, ws):
+        """
+        single request/response exchange with one peer
+        over its pooled connection
+
+        returns (reply, latency), reply is None on failure
+        """
+        send_start = time.time()
+        try:
+            self.logger.debug("to_send: %s", to_send)
+            self.m_sent.inc(len(to_send))
+            input_msg = yield from self.peers.connections.request(ws, to_send)
+            self.m_received.inc(len(input_msg))
+            return input_msg, time.time() - send_start
+        except asyncio.CancelledError:
+            raise
+        except Exception as e: # custom error handling
+            self.logger.debug("send to peer %s failed: %s", ws, e)
+            return None, -1
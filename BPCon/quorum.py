@@ -1,52 +1,145 @@
 import random
+from BPCon import wire
 
 class Quorum(object):
     """
     manages ballots
 
+    tallies are kept as replies arrive so every check is O(1), and each
+    1b is encoded into the 1c proof payload when it is added
     """
-    def __init__(self, ballot_num, num_peers):
+    __slots__ = ('N', 'num_peers', 'quorum', 'binary', 'acceptors', 'rejectors',
+                 'peer_msgs', 'proof_parts', 'proofs', 'commits', 'nacks', 'max_promised',
+                 'ballot_counts', 'top_count', 'top_ballot', 'top_peers', 'max_vbal')
+
+    def __init__(self, ballot_num, num_peers, binary=False):
         self.N = ballot_num
         self.num_peers = num_peers
-        self.quorum = int(num_peers / 2) #+ (num_peers % 2))
+        self.quorum = num_peers // 2 # peer replies, the leader's own vote completes the majority
+        self.binary = binary      # format of the 1c the proofs go into
         self.acceptors = 0
         self.rejectors = 0
-        self.peer_msgs = {} 
+        self.peer_msgs = {}       # wss -> 1b, one per peer
+        self.proof_parts = []     # encoded (wss, 1b) proofs in arrival order
+        self.proofs = None        # proof payload, built once from proof_parts
         self.commits = 0
-        self.current_ballots = {} # list of seen maxBallots from peers
+        self.nacks = 0
+        self.max_promised = -1    # highest ballot reported by 2b refusals
+        self.ballot_counts = {}   # maxBallot -> rejecting peers that reported it
+        self.top_count = 0        # largest count in ballot_counts
+        self.top_ballot = -1      # highest maxBallot of a rejecting peer
+        self.top_peers = []       # rejecting peers reporting top_ballot
+        self.max_vbal = -1        # highest maxVBal reported in any 1b
 
     def add_1b(self, mb, msg, peer_wss):
-        if peer_wss not in self.peer_msgs.keys():
-            self.peer_msgs[peer_wss] = msg
-            if mb < self.N:
-                self.acceptors += 1
-            else:
-                self.rejectors += 1
-                # keep track of maxBallots seen
-                if mb in self.current_ballots:
-                    self.current_ballots[mb] += 1
-                else:
-                    self.current_ballots[mb] = 1
-                
+        if peer_wss in self.peer_msgs:
+            return
+        self.peer_msgs[peer_wss] = msg
+        if self.binary:
+            self.proof_parts.append(wire.pack_fields([peer_wss, msg]))
+        else:
+            self.proof_parts.append(peer_wss + ";" + msg)
+        self.proofs = None
+        if mb > self.max_vbal:
+            self.max_vbal = mb
+        if mb < self.N:
+            self.acceptors += 1
+        else:
+            self.rejectors += 1
+            # keep track of maxBallots seen
+            count = self.ballot_counts.get(mb, 0) + 1
+            self.ballot_counts[mb] = count
+            if count > self.top_count:
+                self.top_count = count
+            if mb > self.top_ballot:
+                self.top_ballot = mb
+                self.top_peers = [peer_wss]
+            elif mb == self.top_ballot:
+                self.top_peers.append(peer_wss)
+
     def rejecting_quorum_member(self):
-        if max(self.current_ballots.values()) >= self.quorum:
-            return random.choice(self.peer_msgs.keys()) # random wss from quorum that has seen a higher ballot
+        if self.top_count >= self.quorum:
+            return random.choice(self.top_peers) # random wss from quorum that has seen the highest ballot
 
     def add_2b(self, N):
         if N == self.N:
             self.commits += 1
 
+    def add_2n(self, N, promised):
+        if N == self.N:
+            self.nacks += 1
+            if promised > self.max_promised:
+                self.max_promised = promised
+
     def quorum_2b(self):
         return self.commits >= self.quorum
 
+    def resolved_2b(self):
+        # True once the 2b outcome is known either way, a commit is
+        # out of reach once more peers refused than can be spared
+        return self.commits >= self.quorum or self.nacks > self.num_peers - 1 - self.quorum
+
     def quorum_1b(self):
         # returns True if majority vote achieved
-        return ((self.acceptors >= self.quorum) or (self.rejectors >= self.quorum))
+        return self.acceptors >= self.quorum or self.rejectors >= self.quorum
 
     def got_majority_accept(self):
         # returns True for accepted, False for rejected
         return self.acceptors >= self.rejectors
-    
+
     def get_msgs(self):
-        return ",".join(k+";"+v for (k,v) in self.peer_msgs.items())
+        # text 1c proofs, "wss;1b,wss;1b,..."
+        if self.proofs is None:
+            self.proofs = ",".join(self.proof_parts)
+        return self.proofs
+
+    def get_proofs(self):
+        # (number of proofs, packed wss and 1b fields) closing a binary 1c
+        if self.proofs is None:
+            self.proofs = (len(self.proof_parts), b''.join(self.proof_parts))
+        return self.proofs
+
+
+PROMISED, APPLIED, REFUSED = 0, 1, 2 # fb status
+
+class FillQuorum(Quorum):
+    """
+    manages a fill round for a slot whose ballot failed, see
+    BPConProtocol.fill_slot
+
+    promises count as accepting 1b replies and become the proofs of
+    the fill's 1c, 2b and 2n replies are tallied as for a ballot
+    """
+    __slots__ = ('round', 'vote_round', 'vote', 'applied_by')
+
+    def __init__(self, slot, round_, num_peers):
+        Quorum.__init__(self, slot, num_peers, binary=True)
+        self.round = round_
+        self.vote_round = -1      # highest round a promising peer voted in
+        self.vote = None          # value voted in vote_round
+        self.applied_by = None    # a peer that applied the slot already
+
+    def add_fb(self, status, vote_round, value, msg, peer_wss):
+        if peer_wss in self.peer_msgs:
+            return
+        self.peer_msgs[peer_wss] = msg
+        if status == PROMISED:
+            self.acceptors += 1
+            self.proof_parts.append(wire.pack_fields([peer_wss, msg]))
+            self.proofs = None
+            if vote_round > self.vote_round:
+                self.vote_round = vote_round
+                self.vote = value
+        elif status == APPLIED:
+            self.applied_by = peer_wss
+        else:
+            self.rejectors += 1
+            if vote_round > self.max_promised: # refusals report the round they promised
+                self.max_promised = vote_round
+
+    def prepared(self):
+        return self.acceptors >= self.quorum
 
+    def resolved_fb(self, asked):
+        # every peer asked has answered, or one can hand the slot over
+        return self.applied_by is not None or len(self.peer_msgs) >= asked
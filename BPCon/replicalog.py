@@ -0,0 +1,93 @@
+from array import array
+
+"""
+Bounded log of decided values, in ballot order
+
+Replaces the ever-growing bmsgs list. Ballots live in an array('q')
+ring next to a list holding each value once as bytes. When the ring is
+full the oldest entry is dropped; entries at or before a stable
+checkpoint are dropped by truncate(). Peers that fall behind the
+oldest entry need a snapshot instead (see BPCon.transfer).
+"""
+
+class ReplicaLog(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ballots = array('q', [0]) * capacity
+        self.values = [None] * capacity
+        self.start = 0          # ring slot of the oldest entry
+        self.size = 0
+        self.floor = -1         # highest ballot no longer held
+
+    def __len__(self):
+        return self.size
+
+    def slot(self, i):
+        return (self.start + i) % self.capacity
+
+    def last(self):
+        if not self.size:
+            return self.floor
+        return self.ballots[self.slot(self.size - 1)]
+
+    def append(self, ballot, value):
+        if ballot <= self.last():
+            raise ValueError("ballot {} not after {}".format(ballot, self.last()))
+        if isinstance(value, str):
+            value = value.encode()
+        elif not isinstance(value, bytes):
+            value = bytes(value)
+        if self.size == self.capacity:
+            self.drop(1)
+        i = self.slot(self.size)
+        self.ballots[i] = ballot
+        self.values[i] = value
+        self.size += 1
+
+    def drop(self, n):
+        # forgets the n oldest entries
+        for _ in range(n):
+            self.floor = self.ballots[self.start]
+            self.values[self.start] = None
+            self.start = (self.start + 1) % self.capacity
+            self.size -= 1
+
+    def search(self, ballot):
+        # number of entries with ballot <= given ballot
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.ballots[self.slot(mid)] <= ballot:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def truncate(self, upto):
+        """
+        drops entries for ballots <= upto
+        """
+        self.drop(self.search(upto))
+        self.floor = max(self.floor, upto)
+
+    def reset(self, ballot):
+        # everything up to ballot now comes from a snapshot
+        self.drop(self.size)
+        self.floor = ballot
+
+    def range(self, after, upto=None):
+        """
+        yields (ballot, value) for after < ballot <= upto,
+        None if entries after `after` have already been dropped
+        """
+        if after < self.floor:
+            return None
+        return self.iter_range(self.search(after), upto)
+
+    def iter_range(self, i, upto):
+        while i < self.size:
+            ballot = self.ballots[self.slot(i)]
+            if upto is not None and ballot > upto:
+                break
+            yield ballot, self.values[self.slot(i)]
+            i += 1
@@ -1,9 +1,13 @@
+import asyncio
 import hashlib
 import os
-from Crypto.Signature import PKCS1_v1_5
-from Crypto.Hash import SHA
-from Crypto.PublicKey import RSA
-from BPCon.utils import save_state, load_state
+import shutil
+from BPCon.signing import load_verifier, KeyFile
+from BPCon.snapshot import write_snapshot, read_snapshot
+from BPCon.utils import get_ssl_context
+from BPCon.connections import ConnectionManager
+from BPCon.latency import LatencyTracker
+from BPCon.workers import worker_pool, CONSENSUS
 from collections import OrderedDict
 
 class GroupManager(object):
@@ -20,31 +24,51 @@ class GroupManager(object):
         self.keyspace = (0.0,0.0)
         self.peers = OrderedDict() # group members
         self.num_peers = 0
+        self.gid = conf['gid']
+        path = "/" + self.gid if self.gid else ""
+        self.connections = ConnectionManager(get_ssl_context(conf['peer_certs']), conf['log'], path)
+        self.verified = OrderedDict() # LRU of verified (wss, msg+sig digest)
+        self.cache_size = conf['verify_cache_size']
+        self.pool = worker_pool(conf)
+        self.latency = {}       # wss -> LatencyTracker
+        self.phi_threshold = conf['phi_threshold'] # suspicion above which a peer is skipped
+        self.probe_interval = conf['probe_interval'] # seconds between messages to a suspect
+        self.min_timeout = conf['min_phase_timeout']
 
     def init_local_group(self):    
         self.keyspace = (0.0,1.0)
 
-        # add self
-        with open(self.conf['keyfile'], 'r') as fh:
-            key = fh.read()
-        with open(self.conf['certfile'], 'r') as fh:
-            cert = fh.read()
-
-        self.add_peer(self.conf['p_wss'], key + "<>" + cert)
+        # add self, the key and cert copies are refreshed only when the originals change
+        wss = self.conf['p_wss']
+        ID = self.get_ID(wss)
+        for src, dst in ((self.conf['keyfile'], self.conf['peer_keys'] + ID + ".pubkey"),
+                         (self.conf['certfile'], "{}{}.crt".format(self.conf['peer_certs'], ID))):
+            try:
+                if not os.path.isfile(dst) or os.path.getmtime(dst) < os.path.getmtime(src):
+                    shutil.copyfile(src, dst)
+            except OSError as e:
+                self.conf['log'].debug(e)
+        self.peers[wss] = KeyFile(self.conf, self.conf['keyfile'])
 
         for wss in self.conf['peerlist']:
-            fname = self.conf['peer_keys'] + self.get_ID(wss)+".pubkey"
-            if os.path.isfile(fname):
-                #read key and add pair to self.peers
-                with open(fname, 'r') as fh:
-                    self.peers[wss] = RSA.importKey(fh.read()) 
-            else:
-                self.conf['log'].info("missing key file for {}".format(wss))
+            verifier = self.load_peer(wss)
+            if verifier:
+                self.peers[wss] = verifier
         
         self.num_peers = len(self.peers)
 
+    def load_peer(self, wss):
+        # verifier from the key file add_peer wrote, None if missing
+        fname = self.conf['peer_keys'] + self.get_ID(wss)+".pubkey"
+        if not os.path.isfile(fname):
+            self.conf['log'].info("missing key file for {}".format(wss))
+            return None
+        return KeyFile(self.conf, fname) # imported on first use
+
     def quorum_size(self):
-        return int((self.num_peers / 2) + (self.num_peers % 2))
+        # peer replies needed, num_peers counts this node whose own
+        # vote makes them a majority
+        return self.num_peers // 2
 
     def get_ID(self, sock_str):
         encoded =  hashlib.sha1(sock_str.encode())
@@ -57,7 +81,7 @@ class GroupManager(object):
             ID = self.get_ID(sock_str)
             if not sock_str in self.peers.keys():
                 key = str(key)
-                self.peers[sock_str] = RSA.importKey(key) 
+                self.peers[sock_str] = load_verifier(self.conf, key)
                 self.conf['log'].debug("add peer: key imported")
                 # write key to file
                 with open(self.conf['peer_keys']+ID+".pubkey", 'w') as fh:
@@ -73,6 +97,7 @@ class GroupManager(object):
     def remove_peer(self, wss):
         if self.peers[wss]:
             self.peers.pop(wss, None)
+            asyncio.ensure_future(self.connections.close(wss))
             self.num_peers -= 1
             return True
         else:
@@ -86,30 +111,130 @@ class GroupManager(object):
         return sockets
 
         
-    def verify_sigs(self, msglist):
+    def tracker(self, wss):
+        if wss not in self.latency:
+            self.latency[wss] = LatencyTracker()
+        return self.latency[wss]
+
+    def record_reply(self, wss, latency):
+        self.tracker(wss).record(latency)
+
+    def record_failure(self, wss, elapsed):
+        self.tracker(wss).record_failure(elapsed)
+
+    def suspected(self, wss):
+        return self.tracker(wss).phi() > self.phi_threshold
+
+    def fanout(self, recipients, needed):
+        """
+        recipients without the peers suspected dead, keeping at least
+        needed of them and letting a suspect through every
+        probe_interval to find out whether it is back
+        """
+        now = asyncio.get_event_loop().time()
+        chosen = []
+        suspects = []
+        for wss in recipients:
+            tracker = self.tracker(wss)
+            if tracker.phi() <= self.phi_threshold:
+                chosen.append(wss)
+            elif now - tracker.last_probe >= self.probe_interval:
+                tracker.last_probe = now
+                chosen.append(wss)
+            else:
+                suspects.append(wss)
+        suspects.sort(key=lambda wss: self.tracker(wss).phi())
+        while len(chosen) < needed and suspects:
+            chosen.append(suspects.pop(0))
+        if suspects:
+            self.conf['log'].debug("skipping suspected peers %s", suspects)
+        return chosen
+
+    def phase_deadline(self, recipients, needed, cap):
+        """
+        seconds to wait for needed replies: twice the p99 latency of the
+        needed-th fastest recipient, within [min_phase_timeout, cap]
+        """
+        p99s = []
+        for wss in recipients:
+            tracker = self.tracker(wss)
+            if tracker.samples >= 20 and not tracker.silent_for:
+                p99s.append(tracker.percentile(99))
+        if needed <= 0 or len(p99s) < needed:
+            return cap # not enough history yet
+        p99s.sort()
+        return min(cap, max(self.min_timeout, 2 * p99s[needed - 1]))
+
+    @asyncio.coroutine
+    def verify_sigs(self, msglist, needed=None):
+        """
+        msglist -- (wss, signed msg bytes, signature) triples, text
+                   messages carry the signature as an int
+        needed  -- stop once this many signatures check out
+
+        counts distinct peers with a valid signature, checking
+        signatures in the worker pool with each peer's prebuilt
+        verifier and skipping ones seen before
+        """
         num_verified = 0
-        
-        for item in msglist:
-            wss, msg, sig = item.split(';')
-            if wss in self.peers:
-                
-                rsakey = self.peers[wss]
-                h = SHA.new(msg.encode())
-
-                sigmsg = int(sig).to_bytes(256, byteorder='little')
-                verifier = PKCS1_v1_5.new(rsakey)
-                if verifier.verify(h, sigmsg):
-                    num_verified += 1
-            else:        
+        counted = set() # peers whose signature checked out
+        checks = {}
+        queued = set()
+
+        for wss, msg, sig in msglist:
+            if wss in counted:
+                continue # one vote per peer
+            if wss not in self.peers:
                 self.conf['log'].info("missing a key for {}".format(wss))
-
+                continue
+
+            verifier = self.peers[wss]
+            if isinstance(sig, int):
+                sig = sig.to_bytes(verifier.sig_size, byteorder='little')
+            digest = hashlib.sha1(msg)
+            digest.update(sig)
+            cache_key = (wss, digest.digest())
+            if cache_key in self.verified:
+                self.verified.move_to_end(cache_key)
+                counted.add(wss)
+                num_verified += 1
+            elif cache_key not in queued: # same proof twice
+                check = self.pool.call(CONSENSUS, verifier, 'verify', msg, sig)
+                checks[check] = cache_key
+                queued.add(cache_key)
+
+        pending = set(checks)
+        while pending and (needed is None or num_verified < needed):
+            done, pending = yield from asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for check in done:
+                if check.result():
+                    cache_key = checks[check]
+                    self.verified[cache_key] = True
+                    if cache_key[0] not in counted:
+                        counted.add(cache_key[0])
+                        num_verified += 1
+                    if len(self.verified) > self.cache_size:
+                        self.verified.popitem(last=False)
+
+        for check in pending: # short-circuited
+            check.cancel()
         return num_verified
 
     def save(self,gid):
-        fname = "data/bpcon_routing_{}.pkl".format(gid)
-        tosave = [self.peers, self.keyspace]
-        save_state(fname,tosave)
+        fname = "data/bpcon_routing_{}.snap".format(gid)
+        tosave = [('keyspace', "{!r},{!r}".format(*self.keyspace))]
+        tosave.extend(('peer', wss) for wss in self.peers)
+        write_snapshot(fname, tosave)
     
     def load(self,gid):
-        (self.peers, self.keyspace) = load_state('data/bpcon_routing_{}.pkl'.format(gid))
-
+        # peers are listed by wss, verifiers are rebuilt from their key files
+        self.peers = OrderedDict()
+        for name, value in read_snapshot('data/bpcon_routing_{}.snap'.format(gid)):
+            if name == 'keyspace':
+                lo, hi = value.split(',')
+                self.keyspace = (float(lo), float(hi))
+            elif name == 'peer':
+                verifier = self.load_peer(value)
+                if verifier:
+                    self.peers[value] = verifier
+        self.num_peers = len(self.peers)
@@ -0,0 +1,358 @@
+import asyncio
+import bisect
+import functools
+import hashlib
+import heapq
+import itertools
+import os
+
+from BPCon.protocol import BPConProtocol, valid_op
+from BPCon.batching import ProposalBatcher
+from BPCon.metrics import REGISTRY
+from BPCon.snapshot import write_snapshot, read_snapshot
+from BPCon.utils import group_path
+from BPCon.wal import segment_files
+from BPCon.workers import BACKGROUND, worker_pool
+
+"""
+Key-range sharding over independent consensus groups
+
+Keys hash to a point in [0.0, 1.0). The keyspace is cut into ranges,
+each owned by its own BPConProtocol/GroupManager with its own ballots,
+wal and state files, so groups commit in parallel. Every node hosts a
+replica of every group, peers reach a group at wss/<gid>.
+
+Ranges change through single-op ballots (see StateManager.update):
+ - split: "S,at,gid" in the owning group moves keys from `at` up into
+   a new group on every replica
+ - merge: "F,," freezes the right-hand group, then "M,gid,b" in its
+   left neighbour takes over the frozen keys and range, on each replica
+   once it has applied the right-hand group up to the freeze. The
+   merged group keeps answering peers for RETIRE_SECONDS so replicas
+   still behind can catch it up from there
+The keys are read and the images written on the worker pool's
+background thread, the group's later ballots wait meanwhile.
+Groups are named after their lower bound so every node derives the
+same names, the group starting at 0.0 is the default group "".
+"""
+
+LAYOUT_FILE = 'data/shards.snap'
+GROUP_FILES = ('data/db_copy.snap', 'data/state_meta.snap')
+SQLITE_SUFFIXES = ('', '-wal', '-shm')
+RETIRE_SECONDS = 300
+
+def key_point(key):
+    # position of key in the keyspace
+    digest = hashlib.sha1(key.encode()).digest()
+    return int.from_bytes(digest[:8], byteorder='big') / 2**64
+
+def shard_name(lo):
+    if lo == 0.0:
+        return ''
+    return "g{:08x}".format(int(lo * 2**32))
+
+def keys_from(items, at):
+    # (k, v) of items hashing at or above at, read on a worker thread
+    return [(k, v) for k, v in items if key_point(k) >= at]
+
+def initial_layout(shards):
+    """
+    [(gid, lo, hi)] cutting the keyspace into equal ranges
+    """
+    bounds = [i / shards for i in range(shards)] + [1.0]
+    return [(shard_name(bounds[i]), bounds[i], bounds[i+1]) for i in range(shards)]
+
+
+class ShardRouter(object):
+    def __init__(self, conf, state):
+        """
+        conf  -- dictionary with configuration variables
+        state -- state of the default group, others are created alongside it
+        """
+        self.conf = conf
+        self.log = conf['log']
+        self.pool = worker_pool(conf)
+        self.state_class = type(state)
+        self.ranges = {}        # gid -> (lo, hi)
+        self.states = {}        # gid -> state object
+        self.groups = {}        # gid -> BPConProtocol
+        self.batchers = {}      # gid -> ProposalBatcher
+        self.retired = {}       # gid -> BPConProtocol of a merged group still answering peers
+        self.bounds = []        # sorted lower bounds of the ranges
+        self.owners = []        # gid owning the range starting at bounds[i]
+
+        try:
+            layout = self.load_layout()
+        except Exception:
+            layout = initial_layout(conf['shards'])
+        # every state is loaded before any wal is replayed, replayed
+        # split and merge ops need to see the groups that already exist
+        for gid, lo, hi in layout:
+            self.ranges[gid] = (lo, hi)
+            if gid == '':
+                state.reconfig = functools.partial(self.apply_reconfig, gid)
+                self.states[gid] = state
+            else:
+                self.states[gid] = self.new_state(gid)
+                self.states[gid].load_state()
+        for gid in list(self.ranges):
+            if gid in self.states and gid not in self.groups: # may be merged away or split off during replay
+                self.start_group(gid)
+        self.index()
+
+    def new_state(self, gid):
+        state = self.state_class(dict(self.conf, gid=gid))
+        state.reconfig = functools.partial(self.apply_reconfig, gid)
+        return state
+
+    def start_group(self, gid):
+        conf = dict(self.conf, gid=gid)
+        bpcon = BPConProtocol(conf, self.states[gid])
+        self.groups[gid] = bpcon
+        self.batchers[gid] = ProposalBatcher(bpcon, conf)
+
+    def stop_group(self, gid):
+        # gid is merged away, it is closed once its peers had time to catch up
+        state = self.states.pop(gid)
+        self.batchers.pop(gid, None)
+        bpcon = self.groups.pop(gid, None)
+        REGISTRY.drop(group=gid)
+        if bpcon is None:
+            state.db.close()
+            self.remove_files(gid)
+            return
+        self.retired[gid] = bpcon
+        asyncio.get_event_loop().call_later(RETIRE_SECONDS, self.close_retired, gid, bpcon)
+
+    def close_retired(self, gid, bpcon):
+        if self.retired.get(gid) is bpcon:
+            self.retired.pop(gid)
+        bpcon.state.db.close()
+        bpcon.wal.close()
+        asyncio.ensure_future(bpcon.peers.connections.close_all())
+        if gid not in self.states: # not split off again meanwhile
+            self.remove_files(gid)
+
+    def peer_group(self, gid):
+        # group answering peers at gid, None if there is none
+        return self.groups.get(gid) or self.retired.get(gid)
+
+    def remove_files(self, gid):
+        # leftovers of an earlier group with the same name
+        db_files = tuple(self.conf['db_file'] + suffix for suffix in SQLITE_SUFFIXES)
+        paths = [group_path(fname, gid) for fname in GROUP_FILES + db_files]
+        paths.extend(name for _, name in segment_files(group_path(self.conf['wal_file'], gid)))
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def index(self):
+        self.bounds = sorted(lo for lo,_ in self.ranges.values())
+        by_lo = dict((lo, gid) for gid,(lo,_) in self.ranges.items())
+        self.owners = [by_lo[lo] for lo in self.bounds]
+        for gid, bpcon in self.groups.items():
+            bpcon.peers.keyspace = self.ranges[gid]
+
+    def save_layout(self):
+        write_snapshot(LAYOUT_FILE, sorted((gid, "{!r},{!r}".format(lo, hi)) for gid,(lo,hi) in self.ranges.items()))
+
+    def load_layout(self):
+        layout = []
+        for gid, bounds in read_snapshot(LAYOUT_FILE):
+            lo, hi = bounds.split(',')
+            layout.append((gid, float(lo), float(hi)))
+        return layout
+
+    def owner(self, key):
+        return self.owners[bisect.bisect_right(self.bounds, key_point(key)) - 1]
+
+    def route(self, proposal):
+        # owning group of a single "t,k,v" op, None if it is malformed
+        if not valid_op(proposal):
+            return None
+        return self.owner(proposal.split(',')[1])
+
+    ### client side ###
+
+    def submit(self, proposal):
+        """
+        queues proposal with the batcher of its group, returns its future
+        """
+        gid = self.route(proposal)
+        if gid is None:
+            gid = '' # batcher reports the format error
+        elif self.states[gid].frozen is not None:
+            future = asyncio.Future()
+            future.set_result({'code': 3}) # range is being merged, retry
+            return future
+        return self.batchers[gid].submit(proposal)
+
+    @asyncio.coroutine
+    def request(self, proposal, future):
+        """
+        unbatched commit of one op in its group
+        """
+        gid = self.route(proposal)
+        if gid is None:
+            self.log.error("db commit proposal not in key,value format")
+            return {'code': 1}
+        return (yield from self.groups[gid].request(proposal, future))
+
+    @asyncio.coroutine
+    def read(self, key, mode='lease', max_lag=0):
+        """
+        reads key from its group, see BPConProtocol.read
+        """
+        return (yield from self.groups[self.owner(key)].read(key, mode, max_lag))
+
+    def scan(self, start=None, end=None, limit=None):
+        """
+        key ordered scan over every group, served from this replica
+        like a stale read, keys hash across groups so all are merged
+        """
+        merged = heapq.merge(*[state.scan(start, end, limit) for state in self.states.values()])
+        return itertools.islice(merged, limit) if limit is not None else merged
+
+    def prefix(self, p, limit=None):
+        merged = heapq.merge(*[state.prefix(p, limit) for state in self.states.values()])
+        return itertools.islice(merged, limit) if limit is not None else merged
+
+    @asyncio.coroutine
+    def split(self, gid, at=None):
+        """
+        splits the range of gid at `at`, by default in the middle
+        """
+        lo, hi = self.ranges[gid]
+        if at is None:
+            at = (lo + hi) / 2
+        if not lo < at < hi:
+            return {'code': 1}
+        self.log.info("splitting group '{}' at {}".format(gid, at))
+        return (yield from self.groups[gid].request("S,{!r},{}".format(at, shard_name(at)), asyncio.Future()))
+
+    @asyncio.coroutine
+    def merge(self, gid):
+        """
+        merges the range to the right of gid into gid
+        """
+        hi = self.ranges[gid][1]
+        if hi not in self.bounds:
+            return {'code': 1} # rightmost range
+        right = self.owners[self.bounds.index(hi)]
+        self.log.info("merging group '{}' into '{}'".format(right, gid))
+        if self.states[right].frozen is None:
+            res = yield from self.groups[right].request("F,,", asyncio.Future())
+            if res['code'] != 0 or res['results'] != [0]:
+                return res
+        frozen = self.states[right].frozen
+        return (yield from self.groups[gid].request("M,{},{}".format(right, frozen), asyncio.Future()))
+
+    ### replicated keyspace changes ###
+
+    def apply_reconfig(self, gid, t, k, v):
+        # StateManager callback for committed S/M ops, returns the op code or its future
+        try:
+            if t == 'S':
+                return self.apply_split(gid, float(k), v)
+            elif t == 'M':
+                return self.apply_merge(gid, k, int(v))
+        except (ValueError, KeyError) as e:
+            self.log.error("keyspace change {} in group '{}' failed: {}".format(t, gid, e))
+        return 1
+
+    def apply_split(self, gid, at, child):
+        lo, hi = self.ranges[gid]
+        if child in self.states:
+            # replayed after a restart, the child already has its keys
+            self.drop_foreign(gid)
+            return 0
+        if not lo < at < hi or child != shard_name(at):
+            self.log.error("bad split of group '{}' at {}".format(gid, at))
+            return 1
+        return asyncio.ensure_future(self.split_off(gid, at, child))
+
+    @asyncio.coroutine
+    def split_off(self, gid, at, child):
+        """
+        moves the keys of gid from at up into the new group child
+        """
+        state = self.states[gid]
+        lo, hi = self.ranges[gid]
+        # gid applies nothing until this is done, its snapshot is read on a worker
+        moved = yield from self.pool.submit(BACKGROUND, keys_from, state.db.snapshot(), at)
+        self.remove_files(child)
+        cstate = self.new_state(child)
+        cstate.db.apply_batch([('P', k, v) for k, v in moved])
+        state.db.apply_batch([('D', k, None) for k, _ in moved])
+        # child first, a replay of the split recreates it until the layout lists it
+        yield from self.pool.submit(BACKGROUND, cstate.image_job())
+        self.states[child] = cstate
+        self.ranges[gid] = (lo, at)
+        self.ranges[child] = (at, hi)
+        self.save_layout()
+        self.start_group(child)
+        self.index()
+        self.groups[gid].checkpoint() # taken once the split is done, see BPConProtocol.change_done
+        self.log.info("split group '{}' at {}, moved {} keys to '{}'".format(gid, at, len(moved), child))
+        return 0
+
+    def drop_foreign(self, gid):
+        lo, hi = self.ranges[gid]
+        state = self.states[gid]
+        foreign = [k for k, _ in state.db.scan() if not lo <= key_point(k) < hi]
+        state.db.apply_batch([('D', k, None) for k in foreign])
+
+    def apply_merge(self, gid, right, frozen):
+        lo, mid = self.ranges[gid]
+        if self.ranges[right][0] != mid:
+            self.log.error("group '{}' is not next to '{}'".format(right, gid))
+            return 1
+        return asyncio.ensure_future(self.merge_in(gid, right, frozen))
+
+    @asyncio.coroutine
+    def merge_in(self, gid, right, frozen):
+        """
+        takes over the keys and range of right once this replica has
+        applied its ballots up to the freeze, a stale copy would lose
+        writes the other replicas merged. Later ballots of gid wait
+        """
+        rstate = self.states[right]
+        bpcon = self.groups[right]
+        if bpcon.applied < frozen:
+            self.log.info("group '{}' waits for '{}' to catch up to its freeze at {}".format(gid, right, frozen))
+            asyncio.ensure_future(bpcon.fill_slot(frozen)) # pulled from a peer that applied it
+            yield from bpcon.wait_applied(frozen)
+
+        state = self.states[gid]
+        # right is frozen, its snapshot is read on a worker
+        items = yield from self.pool.submit(BACKGROUND, list, rstate.db.snapshot())
+        state.db.apply_batch([('P', k, v) for k, v in items])
+        # the merged state must be on disk before the right group's files go
+        yield from self.pool.submit(BACKGROUND, state.image_job())
+        lo = self.ranges[gid][0]
+        self.ranges[gid] = (lo, self.ranges.pop(right)[1])
+        self.save_layout()
+        self.stop_group(right)
+        self.index()
+        self.log.info("merged group '{}' into '{}'".format(right, gid))
+        return 0
+
+    ### peer side ###
+
+    @asyncio.coroutine
+    def main_loop(self, websocket, path):
+        """
+        server socket, hands the connection to the group named by its path
+        """
+        gid = path.strip('/')
+        bpcon = self.peer_group(gid)
+        if bpcon is None:
+            self.log.info("connection for unknown group '{}'".format(gid))
+            yield from websocket.close()
+            return
+        yield from bpcon.main_loop(websocket, path)
+
+    @asyncio.coroutine
+    def close(self):
+        for bpcon in list(self.groups.values()) + list(self.retired.values()):
+            yield from bpcon.peers.connections.close_all()
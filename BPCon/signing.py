@@ -0,0 +1,201 @@
+import hashlib
+import hmac
+import os
+
+from Crypto.Signature import PKCS1_v1_5
+from Crypto.Hash import SHA
+from Crypto.PublicKey import RSA
+
+try: # Ed25519 needs pycryptodome >= 3.15
+    from Crypto.PublicKey import ECC
+    from Crypto.Signature import eddsa
+except ImportError:
+    ECC = None
+    eddsa = None
+
+"""
+Signature schemes for signed 1b messages
+
+Signers and verifiers share a small interface so BPConProtocol and
+GroupManager do not care which scheme a group runs:
+    signer.sign(msg) -> sig bytes
+    verifier.verify(msg, sig) -> bool
+    .sig_size -- signature length in bytes
+    .spec     -- (kind, key material) it was built from, see from_spec
+
+rsa      RSA PKCS#1 v1.5 over SHA-1, the default
+ed25519  much cheaper to sign and verify, picked when the key files
+         hold Ed25519 keys
+hmac     HMAC-SHA256 over a group-wide secret (sig_scheme = hmac),
+         any member can forge proofs so only for trusted LANs
+
+Key files are parsed once per version of the file (see read_key) and
+only on first use (KeyFile), so a node starts without importing its
+own key or any key of its group.
+"""
+
+class RSASigner(object):
+    def __init__(self, key):
+        self.signer = PKCS1_v1_5.new(key)
+        self.sig_size = (key.n.bit_length() + 7) // 8
+
+    def sign(self, msg):
+        return self.signer.sign(SHA.new(msg))
+
+class RSAVerifier(object):
+    def __init__(self, key):
+        self.key = key
+        self.verifier = PKCS1_v1_5.new(key)
+        self.sig_size = (key.n.bit_length() + 7) // 8
+
+    def verify(self, msg, sig):
+        return bool(self.verifier.verify(SHA.new(msg), sig))
+
+class Ed25519Signer(object):
+    sig_size = 64
+
+    def __init__(self, key):
+        self.signer = eddsa.new(key, 'rfc8032')
+
+    def sign(self, msg):
+        return self.signer.sign(bytes(msg))
+
+class Ed25519Verifier(object):
+    sig_size = 64
+
+    def __init__(self, key):
+        self.key = key
+        self.verifier = eddsa.new(key.public_key(), 'rfc8032')
+
+    def verify(self, msg, sig):
+        try:
+            self.verifier.verify(bytes(msg), bytes(sig))
+            return True
+        except ValueError:
+            return False
+
+class HMACScheme(object):
+    sig_size = 32
+
+    def __init__(self, secret):
+        self.secret = secret
+
+    def sign(self, msg):
+        return hmac.new(self.secret, msg, hashlib.sha256).digest()
+
+    def verify(self, msg, sig):
+        return hmac.compare_digest(self.sign(msg), bytes(sig))
+
+
+def read_secret(conf):
+    with open(conf['hmac_keyfile'], 'rb') as fh:
+        return fh.read().strip()
+
+def import_key(pem):
+    """
+    returns (scheme name, key object) for a PEM public or private key
+    """
+    try:
+        return 'rsa', RSA.importKey(pem)
+    except (ValueError, IndexError, TypeError):
+        if ECC is None:
+            raise ValueError("unsupported key type, Ed25519 needs pycryptodome")
+    key = ECC.import_key(pem)
+    if key.curve.lower() != 'ed25519':
+        raise ValueError("unsupported curve {}".format(key.curve))
+    return 'ed25519', key
+
+_keys = {} # path -> ((mtime, size), pem, scheme, key)
+
+def read_key(path):
+    """
+    returns (pem, scheme name, key object) for a key file, parsed again
+    only once the file has changed
+    """
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _keys.get(path)
+    if cached is None or cached[0] != stamp:
+        with open(path, 'r') as fh:
+            pem = fh.read()
+        cached = _keys[path] = (stamp, pem) + import_key(pem)
+    return cached[1:]
+
+def build(kind, pem, scheme, key):
+    if kind == 'sign':
+        obj = Ed25519Signer(key) if scheme == 'ed25519' else RSASigner(key)
+    else:
+        obj = Ed25519Verifier(key) if scheme == 'ed25519' else RSAVerifier(key)
+    obj.spec = (kind, pem)
+    return obj
+
+def from_spec(spec):
+    """
+    builds a signer or verifier from (kind, key material), kind is
+    sign, verify or hmac, the result keeps its spec as .spec so worker
+    processes can rebuild it
+    """
+    kind, material = spec
+    if kind == 'hmac':
+        obj = HMACScheme(material)
+        obj.spec = spec
+        return obj
+    return build(kind, material, *import_key(material))
+
+def load_signer(conf, pem=None):
+    """
+    signer for this node's keyfile (or pem if given)
+    """
+    if conf['sig_scheme'] == 'hmac':
+        return from_spec(('hmac', read_secret(conf)))
+    if pem is None:
+        return KeyFile(conf, conf['keyfile'], 'sign')
+    return from_spec(('sign', pem))
+
+def load_verifier(conf, pem):
+    """
+    verifier for a peer, the scheme is learned from its key
+    """
+    if conf['sig_scheme'] == 'hmac':
+        return from_spec(('hmac', read_secret(conf)))
+    return from_spec(('verify', pem))
+
+
+class KeyFile(object):
+    """
+    signer (kind sign) or verifier (kind verify) for a key file, built
+    on first use, typically in a worker thread, and again once the
+    file has changed
+    """
+    def __init__(self, conf, path, kind='verify'):
+        self.conf = conf
+        self.path = path
+        self.kind = kind
+        self.scheme = None
+        self.stamp = None       # (mtime, size) of the file scheme was built from
+
+    def get(self):
+        hmac_scheme = self.conf['sig_scheme'] == 'hmac'
+        st = os.stat(self.conf['hmac_keyfile'] if hmac_scheme else self.path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if self.scheme is None or stamp != self.stamp:
+            if hmac_scheme:
+                self.scheme = from_spec(('hmac', read_secret(self.conf)))
+            else:
+                self.scheme = build(self.kind, *read_key(self.path))
+            self.stamp = stamp
+        return self.scheme
+
+    def sign(self, msg):
+        return self.get().sign(msg)
+
+    def verify(self, msg, sig):
+        return self.get().verify(msg, sig)
+
+    @property
+    def sig_size(self):
+        return self.get().sig_size
+
+    @property
+    def spec(self):
+        return self.get().spec
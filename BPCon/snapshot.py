@@ -0,0 +1,151 @@
+import mmap
+import os
+import struct
+import zlib
+
+"""
+Streaming snapshot files
+
+Replaces whole-object pickles for the key-value store and routing
+state. A snapshot is a stream of (key, value) string records packed
+into checksummed chunks, written to a temp file and renamed into place
+so a crash never leaves a half-written snapshot. Reading maps the file
+and decodes one chunk at a time, nothing is unpickled.
+
+######### File Layout ##########
+header:  magic(4) version(1) flags(1)        flags: 1 = zlib chunks
+chunk:   raw length(4) stored length(4) crc32 of stored bytes(4) stored bytes
+record:  key length(4) key value length(4) value     (UTF-8, inside chunks)
+trailer: chunk header of zeros, record count(8)
+"""
+
+MAGIC = b'BPSN'
+VERSION = 1
+FLAG_ZLIB = 1
+
+_header = struct.Struct('!4sBB')
+_chunk = struct.Struct('!III')
+_len = struct.Struct('!I')
+_count = struct.Struct('!Q')
+
+
+class SnapshotWriter(object):
+    """
+    with SnapshotWriter(path) as snap:
+        snap.add(key, value)
+    the snapshot replaces path only if the block completes
+    """
+    def __init__(self, path, compress=False, chunk_bytes=1 << 20):
+        self.path = path
+        self.tmp = path + ".tmp"
+        self.compress = compress
+        self.chunk_bytes = chunk_bytes
+        self.parts = []
+        self.size = 0
+        self.count = 0
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.fh = open(self.tmp, 'wb')
+        self.fh.write(_header.pack(MAGIC, VERSION, FLAG_ZLIB if compress else 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def add(self, key, value):
+        k, v = key.encode(), value.encode()
+        self.parts.extend((_len.pack(len(k)), k, _len.pack(len(v)), v))
+        self.size += 2 * _len.size + len(k) + len(v)
+        self.count += 1
+        if self.size >= self.chunk_bytes:
+            self.write_chunk()
+
+    def write_chunk(self):
+        raw = b''.join(self.parts)
+        stored = zlib.compress(raw) if self.compress else raw
+        self.fh.write(_chunk.pack(len(raw), len(stored), zlib.crc32(stored) & 0xffffffff))
+        self.fh.write(stored)
+        self.parts = []
+        self.size = 0
+
+    def commit(self):
+        if self.parts:
+            self.write_chunk()
+        self.fh.write(_chunk.pack(0, 0, 0) + _count.pack(self.count))
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.fh.close()
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        self.fh.close()
+        os.remove(self.tmp)
+
+
+def write_snapshot(path, items, compress=False):
+    """
+    writes (key, value) pairs, returns the number written
+    """
+    with SnapshotWriter(path, compress) as snap:
+        for key, value in items:
+            snap.add(key, value)
+    return snap.count
+
+def read_snapshot(path):
+    """
+    yields (key, value) pairs chunk by chunk, raises ValueError on a
+    corrupt or truncated file
+    """
+    with open(path, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size < _header.size:
+            raise ValueError("{} is not a snapshot".format(path))
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version, flags = _header.unpack_from(mm, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a snapshot".format(path))
+        if version != VERSION:
+            raise ValueError("snapshot version {} not supported".format(version))
+        pos = _header.size
+        count = 0
+        while True:
+            if pos + _chunk.size > size:
+                raise ValueError("snapshot {} is truncated".format(path))
+            raw_len, stored_len, crc = _chunk.unpack_from(mm, pos)
+            pos += _chunk.size
+            if stored_len == 0: # trailer
+                if pos + _count.size > size or _count.unpack_from(mm, pos)[0] != count:
+                    raise ValueError("snapshot {} is truncated".format(path))
+                return
+            stored = mm[pos:pos + stored_len]
+            pos += stored_len
+            if len(stored) != stored_len or zlib.crc32(stored) & 0xffffffff != crc:
+                raise ValueError("snapshot {} failed checksum at offset {}".format(path, pos - stored_len))
+            raw = zlib.decompress(stored) if flags & FLAG_ZLIB else stored
+            if len(raw) != raw_len:
+                raise ValueError("snapshot {} chunk length mismatch".format(path))
+            for key, value in records(raw):
+                count += 1
+                yield key, value
+    finally:
+        mm.close()
+
+def records(raw):
+    pos = 0
+    while pos < len(raw):
+        klen = _len.unpack_from(raw, pos)[0]
+        pos += _len.size
+        key = raw[pos:pos + klen].decode()
+        pos += klen
+        vlen = _len.unpack_from(raw, pos)[0]
+        pos += _len.size
+        value = raw[pos:pos + vlen].decode()
+        pos += vlen
+        yield key, value
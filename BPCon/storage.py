@@ -1,18 +1,352 @@
+import functools
+import itertools
+import os
 import pickle
-from BPCon.utils import save_state, load_state
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+from BPCon.ordered import SortedKeys
+from BPCon.snapshot import write_snapshot, read_snapshot
+from BPCon.utils import load_state, group_path
+
+"""
+Storage engines behind StateManager
+
+Engines share one interface so the state does not care where keys live:
+    get(k) -> v, KeyError if unset
+    put(k, v), delete(k) -> old value or None
+    scan(start=None, end=None, limit=None) -> (k, v) in key order,
+        start <= k < end, streamed rather than built as a list, writes
+        made while a scan is suspended may or may not show up in it
+    snapshot() -> (k, v) as of the call, unaffected by later writes,
+        streamed rather than copied up front, may be read on another
+        thread while the store is written
+    apply_batch(ops) -> applies [(t, k, v)] P/D ops all or nothing
+    replace(items) -> swaps in a whole new store
+    staging() -> empty store of the same engine to fill with apply_batch,
+        replaces any earlier staging store
+    swap(staged) -> takes over the contents of a staging store
+    save(), load(), close()
+    saver() -> function doing the work of save() for the data as of
+        the call, safe to run on another thread
+
+memory  plain dict plus a SortedKeys index for scans, written whole
+        as a snapshot file on save, the default. Snapshots are copy on
+        write: a key's old value is kept for each open snapshot that
+        has not read it yet before it changes. While one is open writes
+        take a lock it is read under, saver() writes one
+sqlite  sqlite3 table in WAL mode, memory bounded by an LRU of hot
+        keys, a ballot is written in one transaction and save only
+        checkpoints. The staging store is a second table renamed over
+        the live one on swap
+"""
+
+_missing = object()
+
+class MemorySnapshot(object):
+    """
+    (k, v) of an InMemoryStorage as of its creation
+
+    keys are read from the live index in order, the store calls
+    preserve(k) before changing a key so its old value is read from
+    here instead, keys deleted before the walk got to them come last.
+    Each step holds the store's lock, writes hold it too
+    """
+    def __init__(self, kvstore, index, lock):
+        self.kvstore = kvstore
+        self.lock = lock
+        self.keys = index.irange()
+        self.last = None        # last key read from the index
+        self.saved = {}         # key -> value as of the snapshot, _missing if unset
+        self.walked = False
+
+    def preserve(self, k):
+        if not self.walked and (self.last is None or k > self.last) and k not in self.saved:
+            self.saved[k] = self.kvstore.get(k, _missing)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            while not self.walked:
+                k = next(self.keys, _missing)
+                if k is _missing:
+                    self.walked = True
+                    break
+                self.last = k
+                v = self.saved.pop(k) if k in self.saved else self.kvstore.get(k, _missing)
+                if v is not _missing:
+                    return k, v
+            while self.saved:
+                k, v = self.saved.popitem()
+                if v is not _missing:
+                    return k, v
+        raise StopIteration
+
 
 class InMemoryStorage(object):
-    def __init__(self):
+    def __init__(self, path='data/db_copy.snap', compress=False):
+        self.path = path
+        self.compress = compress
         self.kvstore = {}
+        self.index = SortedKeys()
+        self.snapshots = weakref.WeakSet() # open MemorySnapshots of kvstore
+        self.lock = threading.Lock() # taken by writes while a snapshot is open
     def get(self, k):
         return self.kvstore[k]
     def put(self, k, v):
+        if self.snapshots:
+            with self.lock: # a snapshot may be read on another thread
+                self.preserve(k)
+                self.set(k, v)
+        else:
+            self.set(k, v)
+    def set(self, k, v):
+        if k not in self.kvstore:
+            self.index.add(k)
         self.kvstore[k] = v
     def delete(self,k):
-        return self.kvstore.pop(k,None)
-    
+        if self.snapshots:
+            with self.lock:
+                self.preserve(k)
+                return self.remove(k)
+        return self.remove(k)
+    def remove(self, k):
+        old = self.kvstore.pop(k,_missing)
+        if old is _missing:
+            return None
+        self.index.discard(k)
+        return old
+
+    def __len__(self):
+        return len(self.kvstore)
+
+    def scan(self, start=None, end=None, limit=None):
+        items = self.range_items(start, end)
+        return itertools.islice(items, limit) if limit is not None else items
+
+    def range_items(self, start, end):
+        for k in self.index.irange(start, end):
+            v = self.kvstore.get(k, _missing)
+            if v is not _missing: # deleted since the index chunk was read
+                yield k, v
+
+    def preserve(self, k):
+        for snap in list(self.snapshots):
+            snap.preserve(k)
+
+    def snapshot(self):
+        snap = MemorySnapshot(self.kvstore, self.index, self.lock)
+        self.snapshots.add(snap)
+        return snap
+
+    def apply_batch(self, ops):
+        # rolled back if any op fails
+        undo = []
+        try:
+            for t,k,v in ops:
+                undo.append((k, self.kvstore.get(k, _missing)))
+                if t == 'P':
+                    self.put(k,v)
+                elif t == 'D':
+                    self.delete(k)
+        except Exception:
+            for k,old in reversed(undo):
+                if old is _missing:
+                    self.delete(k)
+                else:
+                    self.put(k,old)
+            raise
+
+    def replace(self, items):
+        # open snapshots keep reading the old dict, nothing changes it any more
+        self.kvstore = dict(items)
+        self.index = SortedKeys(self.kvstore)
+        self.snapshots = weakref.WeakSet()
+
+    def staging(self):
+        return InMemoryStorage(self.path, self.compress)
+
+    def swap(self, staged):
+        self.kvstore, self.index = staged.kvstore, staged.index
+        self.snapshots = weakref.WeakSet()
+
     def save(self): # need metadata here
-        save_state('data/db_copy.pkl', self.kvstore)
-    
+        write_snapshot(self.path, self.kvstore.items(), self.compress)
+
+    def saver(self):
+        # copy on write, keys are only copied if they change before the writer reads them
+        return functools.partial(write_snapshot, self.path, self.snapshot(), self.compress)
+
+    def load(self):
+        legacy = os.path.splitext(self.path)[0] + ".pkl"
+        if not os.path.exists(self.path) and os.path.exists(legacy):
+            self.kvstore = load_state(legacy) # local pickle from an older clone
+        else:
+            self.kvstore = dict(read_snapshot(self.path))
+        self.index = SortedKeys(self.kvstore)
+        self.snapshots = weakref.WeakSet()
+
+    def close(self):
+        pass
+
+
+class SQLiteStorage(object):
+    def __init__(self, path, cache_size=10000, table='kv'):
+        self.path = path
+        self.table = table
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.conn = sqlite3.connect(path, isolation_level=None) # transactions are explicit
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL") # BPCon's own wal covers a crash until save()
+        self.conn.execute("CREATE TABLE IF NOT EXISTS {} (k TEXT PRIMARY KEY, v TEXT) WITHOUT ROWID".format(table))
+        self.reader = sqlite3.connect(path, isolation_level=None) # scans run while ballots apply
+        self.cache = OrderedDict() # LRU of hot keys
+        self.cache_size = cache_size
+
+    def remember(self, k, v):
+        self.cache[k] = v
+        self.cache.move_to_end(k)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def get(self, k):
+        if k in self.cache:
+            self.cache.move_to_end(k)
+            return self.cache[k]
+        row = self.conn.execute("SELECT v FROM {} WHERE k = ?".format(self.table), (k,)).fetchone()
+        if row is None:
+            raise KeyError(k)
+        self.remember(k, row[0])
+        return row[0]
+
+    def put(self, k, v):
+        self.apply_batch([('P', k, v)])
+
+    def delete(self, k):
+        try:
+            old = self.get(k)
+        except KeyError:
+            return None
+        self.apply_batch([('D', k, None)])
+        return old
+
+    def __len__(self):
+        return self.conn.execute("SELECT count(*) FROM {}".format(self.table)).fetchone()[0]
+
+    def scan(self, start=None, end=None, limit=None):
+        query, args = "SELECT k, v FROM {}".format(self.table), []
+        bounds = []
+        if start is not None:
+            bounds.append("k >= ?")
+            args.append(start)
+        if end is not None:
+            bounds.append("k < ?")
+            args.append(end)
+        if bounds:
+            query += " WHERE " + " AND ".join(bounds)
+        query += " ORDER BY k"
+        if limit is not None:
+            query += " LIMIT ?"
+            args.append(limit)
+        for row in self.reader.execute(query, args):
+            yield row
+
+    def snapshot(self):
+        # own connection, its read transaction pins the rows as of now
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute("BEGIN")
+        rows = conn.execute("SELECT k, v FROM {} ORDER BY k".format(self.table))
+        return self.stream(conn, rows)
+
+    def stream(self, conn, rows):
+        try:
+            for row in rows:
+                yield row
+        finally:
+            conn.close()
+
+    def apply_batch(self, ops):
+        cur = self.conn.cursor()
+        cur.execute("BEGIN")
+        try:
+            for t,k,v in ops:
+                if t == 'P':
+                    cur.execute("INSERT OR REPLACE INTO {} VALUES (?, ?)".format(self.table), (k, v))
+                elif t == 'D':
+                    cur.execute("DELETE FROM {} WHERE k = ?".format(self.table), (k,))
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+        for t,k,v in ops:
+            if t == 'P':
+                self.remember(k, v)
+            else:
+                self.cache.pop(k, None)
+
+    def replace(self, items):
+        cur = self.conn.cursor()
+        cur.execute("BEGIN")
+        try:
+            cur.execute("DELETE FROM {}".format(self.table))
+            cur.executemany("INSERT OR REPLACE INTO {} VALUES (?, ?)".format(self.table), items)
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+        self.cache.clear()
+
+    def staging(self):
+        table = self.table + "_staging"
+        self.conn.execute("DROP TABLE IF EXISTS {}".format(table))
+        return SQLiteStorage(self.path, self.cache_size, table)
+
+    def swap(self, staged):
+        staged.close()
+        cur = self.conn.cursor()
+        cur.execute("BEGIN")
+        try:
+            cur.execute("DROP TABLE {}".format(self.table))
+            cur.execute("ALTER TABLE {} RENAME TO {}".format(staged.table, self.table))
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+        self.cache.clear()
+
+    def save(self):
+        # rows are already on disk, make them durable before the ballot log is cut
+        self.conn.execute("PRAGMA wal_checkpoint(FULL)")
+
+    def saver(self):
+        # sqlite connections stay on their thread, the worker opens its own
+        return functools.partial(checkpoint_file, self.path)
+
     def load(self):
-        self.kvstore = load_state('data/db_copy.pkl')
+        pass
+
+    def close(self):
+        self.reader.close()
+        self.conn.close()
+
+
+def checkpoint_file(path):
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(FULL)")
+    finally:
+        conn.close()
+
+
+def open_storage(conf):
+    """
+    storage engine for conf['storage_engine'], files are per group
+    """
+    if conf['storage_engine'] == 'sqlite':
+        return SQLiteStorage(group_path(conf['db_file'], conf['gid']), conf['storage_cache_size'])
+    return InMemoryStorage(group_path('data/db_copy.snap', conf['gid']), conf['snapshot_compress'])
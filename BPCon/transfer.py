@@ -0,0 +1,192 @@
+import asyncio
+import itertools
+import time
+import zlib
+
+from BPCon import wire
+
+"""
+State transfer for lagging and new replicas
+
+A node that finds a quorum ahead of it pulls the missing state from an
+up-to-date peer over its pooled connection, one bounded chunk per
+request, so neither side holds the event loop for long:
+
+ - log suffix: decided (ballot, value) entries after the node's last
+   applied ballot, while the peer still has them in its log
+ - snapshot: otherwise a frozen copy of the peer's store in checksummed
+   chunks, followed by the log suffix after the snapshot ballot. The
+   peer streams it from its store as of the freeze, the node writes
+   each chunk to a staging store and swaps it in once complete. A
+   transfer cut off midway resumes from the next chunk, a peer that
+   no longer has the snapshot starts a new one at chunk 0
+
+######### Message Formats ##########
+st [ts, from ballot, snapshot id (-1 for log), chunk]
+sl [ts, more, (ballot, value)*]
+ss [ts, snapshot id, snapshot ballot, chunk, more, crc32, (key, value)*]
+"""
+
+class StateTransfer(object):
+    def __init__(self, bpcon, conf):
+        self.bpcon = bpcon
+        self.log = conf['log']
+        self.chunk_bytes = conf['transfer_chunk_bytes']
+        self.snapshots = {}     # snapshot id -> [ballot, items iterator, next chunk, last reply]
+        self.snapshot_ids = itertools.count()
+        self.running = None     # catch_up task, one at a time
+        self.staged = None      # [peer, snapshot id, next chunk, staging store] of a partial snapshot
+
+    ### serving side ###
+
+    def serve(self, from_b, snap_id, chunk):
+        if snap_id < 0:
+            entries = self.log_suffix(from_b)
+            if entries is not None:
+                return self.log_chunk(entries)
+            snap_id = self.freeze()
+            chunk = 0
+        elif snap_id not in self.snapshots:
+            self.log.info("transfer: unknown snapshot {}, freezing a new one".format(snap_id))
+            snap_id = self.freeze()
+            chunk = 0
+        return self.snapshot_chunk(snap_id, chunk)
+
+    def log_suffix(self, from_b):
+        """
+        decided entries after from_b, None when the log no longer reaches back that far
+        """
+        return self.bpcon.bmsgs.range(from_b, self.bpcon.applied)
+
+    def log_chunk(self, entries):
+        fields = [time.time(), 0]
+        size = 0
+        for ballot, value in entries:
+            if size and size + len(value) > self.chunk_bytes:
+                fields[1] = 1 # more
+                break
+            fields.extend((ballot, value))
+            size += len(value)
+        return wire.encode("sl", fields)
+
+    def freeze(self):
+        snap_id = next(self.snapshot_ids)
+        items = self.bpcon.state.db.snapshot()
+        self.snapshots[snap_id] = [self.bpcon.applied, items, 0, None]
+        asyncio.get_event_loop().call_later(300, self.snapshots.pop, snap_id, None) # abandoned transfers
+        self.log.info("transfer: froze snapshot {} at ballot {}".format(snap_id, self.bpcon.applied))
+        return snap_id
+
+    def snapshot_chunk(self, snap_id, chunk):
+        snap = self.snapshots[snap_id]
+        ballot, items, next_chunk, last_reply = snap
+        if chunk + 1 == next_chunk:
+            return last_reply # the reply got lost, send it again
+        if chunk != next_chunk:
+            self.log.info("transfer: chunk {} requested out of order".format(chunk))
+            return None
+        fields = []
+        size = 0
+        for k, v in items:
+            fields.extend((k, v))
+            size += len(k) + len(v)
+            if size >= self.chunk_bytes:
+                break
+        peek = next(items, None)
+        more = int(peek is not None)
+        if more:
+            snap[1] = itertools.chain([peek], items)
+        payload = wire.pack_fields(fields)
+        reply = wire.encode("ss", [time.time(), snap_id, ballot, chunk, more,
+                                   zlib.crc32(payload) & 0xffffffff], count=6 + len(fields)) + payload
+        snap[2], snap[3] = chunk + 1, reply
+        return reply
+
+    ### requesting side ###
+
+    def start(self, peer):
+        if self.running is None or self.running.done():
+            self.running = asyncio.ensure_future(self.catch_up(peer))
+
+    @asyncio.coroutine
+    def catch_up(self, peer):
+        """
+        pulls state from peer until its reported log is exhausted
+        """
+        self.log.info("transfer: catching up from {} after ballot {}".format(peer, self.bpcon.applied))
+        snap_id, chunk = -1, 0
+        if self.staged is not None and self.staged[0] == peer:
+            snap_id, chunk = self.staged[1:3]
+            self.log.info("transfer: resuming snapshot {} at chunk {}".format(snap_id, chunk))
+        try:
+            while True:
+                request = wire.encode("st", [time.time(), self.bpcon.applied, snap_id, chunk])
+                reply = yield from self.bpcon.peers.connections.request(peer, request)
+                msg_type, fields = wire.decode(reply)
+                if msg_type == "sl":
+                    before = self.bpcon.applied
+                    more = yield from self.apply_log(fields, peer)
+                    if not more or self.bpcon.applied == before:
+                        break
+                elif msg_type == "ss":
+                    snap_id, ballot, chunk, more, crc = [wire.to_int(f) for f in fields[1:6]]
+                    payload = wire.pack_fields(fields[6:])
+                    if zlib.crc32(payload) & 0xffffffff != crc:
+                        raise ValueError("snapshot chunk {} failed checksum".format(chunk))
+                    if chunk == 0: # a new snapshot
+                        if self.staged is not None:
+                            self.staged[3].close()
+                        self.staged = [peer, snap_id, 0, self.bpcon.state.db.staging()]
+                    staging = self.staged[3]
+                    staging.apply_batch([('P', wire.to_str(fields[i]), wire.to_str(fields[i+1]))
+                                         for i in range(6, len(fields), 2)])
+                    if more:
+                        chunk += 1
+                        self.staged[2] = chunk
+                    else:
+                        self.staged = None
+                        self.install(staging, ballot)
+                        snap_id, chunk = -1, 0
+                else:
+                    raise ValueError("unexpected reply {}".format(msg_type))
+                yield from asyncio.sleep(0) # let other work run between chunks
+        except Exception as e:
+            self.log.error("transfer from {} failed: {}".format(peer, e))
+        self.log.info("transfer: applied up to ballot {}".format(self.bpcon.applied))
+
+    @asyncio.coroutine
+    def apply_log(self, fields, peer):
+        more = wire.to_int(fields[1])
+        for i in range(2, len(fields), 2):
+            ballot, value = wire.to_int(fields[i]), bytes(fields[i+1])
+            if ballot > self.bpcon.applied:
+                if not (yield from self.bpcon.fetch_blob(value, [peer])):
+                    raise ValueError("value of ballot {} could not be fetched".format(ballot))
+                self.bpcon.track_blob(ballot, value)
+                self.bpcon.wal.append(ballot, value)
+                waiting = self.bpcon.ready.get(ballot, (None, None))[1] # a local request for the slot
+                self.bpcon.ready[ballot] = (value, waiting)
+        yield from self.bpcon.wal.sync()
+        self.bpcon.apply_ready()
+        return more
+
+    def install(self, staging, ballot):
+        """
+        swaps in a fully received snapshot
+        """
+        bpcon = self.bpcon
+        if ballot <= bpcon.applied: # caught up from the log meanwhile
+            staging.close()
+            self.log.info("transfer: snapshot at ballot {} is behind, dropped".format(ballot))
+            return
+        state = bpcon.state
+        state.db.swap(staging)
+        state.ballot = ballot
+        bpcon.applied = ballot
+        bpcon.maxVBal = max(bpcon.maxVBal, ballot)
+        bpcon.bmsgs.reset(ballot)
+        for b in [b for b in bpcon.ready if b <= ballot]:
+            bpcon.ready.pop(b)
+        bpcon.checkpoint()
+        bpcon.apply_ready()
+        self.log.info("transfer: installed snapshot at ballot {}".format(ballot))
@@ -1,14 +1,26 @@
+import os
 import ssl
 import subprocess
 import pickle 
 def save_state(fname, tosave):
+    dirname = os.path.dirname(fname)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
     with open(fname, 'wb') as fh:
         pickle.dump(tosave, fh)
 
 def load_state(fname):
+    # trusted local files only, see BPCon.snapshot for everything else
     with open(fname, 'rb') as fh:
         return pickle.load(fh)
 
+def group_path(fname, gid):
+    # per-group copy of a data file, the default group keeps the plain name
+    if not gid:
+        return fname
+    head, tail = os.path.split(fname)
+    return os.path.join(head, gid, tail)
+
 def get_ssl_context(path):
     cctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
     cctx.check_hostname = False
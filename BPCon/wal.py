@@ -0,0 +1,193 @@
+import asyncio
+import os
+import struct
+import zlib
+
+"""
+Write-ahead log of accepted ballots
+
+Records are appended as ballots are accepted and made durable by
+sync(). Callers that sync within sync_delay of each other share one
+fsync (group commit). On startup replay() returns every intact record,
+a torn tail left by a crash is cut off.
+
+The log is a series of segment files, path then path.1, path.2, ...
+truncate() moves appends to a new segment and deletes the older ones
+holding only ballots a snapshot covers, nothing is read or rewritten.
+A segment may outlive some of its ballots until a later truncate.
+
+######### Record Layout ##########
+crc32(4) length(4) ballot(8) value(length)
+crc covers ballot and value
+"""
+
+_head = struct.Struct('!IIq')
+
+def segment_name(path, seq):
+    return path if seq == 0 else "{}.{}".format(path, seq)
+
+def segment_files(path):
+    """
+    [(seq, file name)] of the log's segments on disk, oldest first
+    """
+    head, tail = os.path.split(path)
+    if not os.path.isdir(head or '.'):
+        return []
+    found = []
+    for name in os.listdir(head or '.'):
+        prefix, _, seq = name.rpartition('.')
+        if name == tail:
+            found.append((0, path))
+        elif prefix == tail and seq.isdigit():
+            found.append((int(seq), os.path.join(head, name)))
+    return sorted(found)
+
+def fsync_all(fds):
+    for fd in fds:
+        os.fsync(fd)
+
+class WriteAheadLog(object):
+    def __init__(self, path, logger, sync_delay=0.002):
+        self.path = path
+        self.log = logger
+        self.sync_delay = sync_delay
+        self.waiters = []       # futures waiting for the next fsync
+        self.flusher = None
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        seqs = [seq for seq, _ in segment_files(path)] or [0]
+        self.segments = [[seq, None] for seq in seqs[:-1]] # [seq, highest ballot] of closed segments, None until replayed
+        self.seq = seqs[-1]     # segment appended to
+        self.top = None         # its highest ballot
+        self.unsynced = {}      # seq -> descriptor of a closed segment the next flush syncs
+        self.fh = open(segment_name(path, self.seq), 'ab')
+
+    def append(self, ballot, value):
+        if isinstance(value, str):
+            value = value.encode()
+        body = struct.pack('!q', ballot) + value
+        self.fh.write(_head.pack(zlib.crc32(body) & 0xffffffff, len(value), ballot) + value)
+        if self.top is None or ballot > self.top:
+            self.top = ballot
+
+    @asyncio.coroutine
+    def sync(self):
+        """
+        returns once every record appended so far is on disk
+        """
+        future = asyncio.Future()
+        self.waiters.append(future)
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.flush())
+        yield from future
+
+    @asyncio.coroutine
+    def flush(self):
+        yield from asyncio.sleep(self.sync_delay) # let concurrent ballots join
+        waiters, self.waiters = self.waiters, []
+        self.flusher = None
+        fds = list(self.unsynced.values())
+        self.unsynced = {}
+        try:
+            self.fh.flush()
+            # own descriptors, truncate() may move appends to a new segment while this runs
+            fds.append(os.dup(self.fh.fileno()))
+            yield from asyncio.get_event_loop().run_in_executor(None, fsync_all, fds)
+        except Exception as e:
+            self.log.error("wal sync failed: {}".format(e))
+            for future in waiters:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            for fd in fds:
+                os.close(fd)
+        for future in waiters:
+            if not future.done():
+                future.set_result(True)
+
+    def records(self, data):
+        # (offset, ballot, value) of intact records, stops at the first bad one
+        pos = 0
+        while pos + _head.size <= len(data):
+            crc, length, ballot = _head.unpack_from(data, pos)
+            end = pos + _head.size + length
+            if end > len(data):
+                break
+            value = data[pos + _head.size:end]
+            if zlib.crc32(data[pos + 8:end]) & 0xffffffff != crc:
+                break
+            yield pos, ballot, value
+            pos = end
+
+    def read_segment(self, seq):
+        if seq == self.seq:
+            self.fh.flush()
+        with open(segment_name(self.path, seq), 'rb') as fh:
+            return fh.read()
+
+    def replay(self):
+        """
+        returns [(ballot, value bytes)] in log order, truncating torn tails
+        """
+        entries = []
+        for seq in [seq for seq, _ in self.segments] + [self.seq]:
+            data = self.read_segment(seq)
+            top = None
+            valid_end = 0
+            for pos, ballot, value in self.records(data):
+                entries.append((ballot, value))
+                top = ballot if top is None else max(top, ballot)
+                valid_end = pos + _head.size + len(value)
+            if valid_end < len(data):
+                self.cut(seq, valid_end)
+            if seq == self.seq:
+                self.top = top
+            else:
+                self.segments[[s for s, _ in self.segments].index(seq)][1] = top
+        return entries
+
+    def cut(self, seq, size):
+        name = segment_name(self.path, seq)
+        self.log.info("wal: dropping torn tail of {} at offset {}".format(name, size))
+        if seq == self.seq:
+            self.fh.close()
+        with open(name, 'r+b') as fh:
+            fh.truncate(size)
+        if seq == self.seq:
+            self.fh = open(name, 'ab')
+
+    def truncate(self, upto):
+        """
+        drops the segments holding only ballots <= upto, covered by a snapshot
+        """
+        if self.top is not None:
+            self.rotate()
+        kept = []
+        for seq, top in self.segments:
+            if top is not None and top <= upto:
+                fd = self.unsynced.pop(seq, None)
+                if fd is not None:
+                    os.close(fd)
+                os.remove(segment_name(self.path, seq))
+            else:
+                kept.append([seq, top])
+        self.segments = kept
+
+    def rotate(self):
+        # appends go to a new segment, the next flush syncs the old one
+        self.fh.flush()
+        self.unsynced[self.seq] = os.dup(self.fh.fileno())
+        self.fh.close()
+        self.segments.append([self.seq, self.top])
+        self.seq += 1
+        self.top = None
+        self.fh = open(segment_name(self.path, self.seq), 'ab')
+
+    def close(self):
+        for fd in self.unsynced.values():
+            os.close(fd)
+        self.unsynced = {}
+        self.fh.close()
+
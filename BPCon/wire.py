@@ -0,0 +1,120 @@
+import struct
+
+"""
+Binary wire format for BPCon messages
+
+Fields are length-prefixed raw bytes, so values and signatures travel
+as-is instead of as decimal bigints. Decoding returns memoryview slices
+of the received frame, nothing is copied until a field is interpreted.
+
+######### Frame Layout ##########
+magic(1) version(1) type(2) count(2) {len(4) field}*count
+
+ints are 8 byte signed, floats 8 byte doubles, strings UTF-8,
+all big-endian
+"""
+
+MAGIC = 0xbc
+VERSION = 1
+
+_header = struct.Struct('!BB2sH')
+_len = struct.Struct('!I')
+_int = struct.Struct('!q')
+_float = struct.Struct('!d')
+
+
+def is_binary(msg):
+    return (isinstance(msg, (bytes, bytearray, memoryview))
+            and len(msg) >= _header.size and msg[0] == MAGIC)
+
+def pack_field(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return value
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return _int.pack(value)
+    if isinstance(value, float):
+        return _float.pack(value)
+    return str(value).encode()
+
+def pack_fields(fields):
+    """
+    encodes fields without a frame header, used to finish a frame
+    whose header was written with a larger count (see encode)
+    """
+    parts = []
+    for value in fields:
+        data = pack_field(value)
+        parts.append(_len.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+def encode(msg_type, fields, count=None):
+    """
+    count -- total fields in the finished frame when more will be
+             appended with pack_fields, e.g. a signature over this prefix
+    """
+    if count is None:
+        count = len(fields)
+    return _header.pack(MAGIC, VERSION, msg_type.encode(), count) + pack_fields(fields)
+
+def scan(data):
+    """
+    returns (msg_type, [(header offset, field view)])
+    raises ValueError on malformed frames
+    """
+    view = memoryview(data)
+    if len(view) < _header.size:
+        raise ValueError("short frame")
+    magic, version, msg_type, count = _header.unpack_from(view)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("unsupported frame version {}".format(version))
+
+    fields = []
+    pos = _header.size
+    for _ in range(count):
+        if pos + _len.size > len(view):
+            raise ValueError("truncated frame")
+        (length,) = _len.unpack_from(view, pos)
+        start = pos + _len.size
+        if start + length > len(view):
+            raise ValueError("truncated field")
+        fields.append((pos, view[start:start+length]))
+        pos = start + length
+    if pos != len(view):
+        raise ValueError("trailing bytes in frame")
+    return msg_type.decode(), fields
+
+def decode(data):
+    msg_type, fields = scan(data)
+    return msg_type, [f for _,f in fields]
+
+def split_signed(data):
+    """
+    returns (signed prefix, signature) of a frame whose last field
+    signs everything before it
+    """
+    _, fields = scan(data)
+    if not fields:
+        raise ValueError("unsigned frame")
+    offset, sig = fields[-1]
+    return memoryview(data)[:offset], sig
+
+def to_int(field):
+    return _int.unpack(field)[0]
+
+def to_float(field):
+    return _float.unpack(field)[0]
+
+def to_str(field):
+    return str(field, 'utf-8')
+
+def encode_text_value(value):
+    # values in text 1c messages travel as "length<>decimal int of the UTF-8 bytes"
+    data = value.encode()
+    return str(len(data)) + "<>" + str(int.from_bytes(data, byteorder='little'))
+
+def decode_text_value(encoded):
+    length, data = encoded.split('<>')
+    return int(data).to_bytes(int(length), byteorder='little').decode()
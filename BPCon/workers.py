@@ -0,0 +1,116 @@
+import asyncio
+import functools
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from BPCon.signing import from_spec
+
+"""
+Worker pool for CPU-heavy protocol work
+
+Signing, signature checks and encoding of large text values run off
+the event loop so one slow job does not stall every socket. A node
+has one pool shared by all its groups, workers (threads by default,
+processes with worker_pool = process so RSA keeps several cores busy)
+are sized by the workers setting.
+
+Jobs wait in a priority queue and at most `workers` run at once:
+    CONSENSUS   signing 1b replies and checking 1c proofs
+    CODEC       encoding and decoding text values
+so a burst of value decoding never delays a vote. BACKGROUND jobs,
+state snapshots, run on a thread of their own outside that queue.
+
+Process workers get their jobs by pickle, signers and verifiers are
+sent as their spec (see BPCon.signing.from_spec) and rebuilt once per
+worker process.
+"""
+
+CONSENSUS = 0
+CODEC = 1
+BACKGROUND = 2
+
+_built = {} # spec -> signer/verifier, per worker process
+
+def call_spec(spec, method, *args):
+    obj = _built.get(spec)
+    if obj is None:
+        obj = _built[spec] = from_spec(spec)
+    return getattr(obj, method)(*args)
+
+
+class WorkerPool(object):
+    def __init__(self, workers=2, kind='thread'):
+        self.workers = workers
+        self.processes = kind == 'process'
+        if self.processes:
+            self.executor = ProcessPoolExecutor(workers)
+        else:
+            self.executor = ThreadPoolExecutor(workers)
+        self.background = ThreadPoolExecutor(1)
+        self.queue = []         # heap of (priority, seq, fn, args, future)
+        self.seq = itertools.count()
+        self.running = 0
+
+    def submit(self, priority, fn, *args):
+        """
+        runs fn(*args) in a worker, returns an asyncio future for its result
+        fn and args must pickle if the pool runs processes, BACKGROUND
+        jobs always run on a thread
+        """
+        if priority == BACKGROUND:
+            return asyncio.get_event_loop().run_in_executor(self.background, fn, *args)
+        future = asyncio.Future()
+        heapq.heappush(self.queue, (priority, next(self.seq), fn, args, future))
+        self.dispatch()
+        return future
+
+    def call(self, priority, obj, method, *args):
+        """
+        obj.method(*args) in a worker, obj is a signer or verifier
+        """
+        if self.processes:
+            args = [bytes(a) if isinstance(a, memoryview) else a for a in args]
+            return self.submit(priority, call_spec, obj.spec, method, *args)
+        return self.submit(priority, getattr(obj, method), *args)
+
+    def dispatch(self):
+        loop = asyncio.get_event_loop()
+        while self.queue and self.running < self.workers:
+            _, _, fn, args, future = heapq.heappop(self.queue)
+            if future.done(): # cancelled while queued
+                continue
+            self.running += 1
+            job = loop.run_in_executor(self.executor, fn, *args)
+            job.add_done_callback(functools.partial(self.finished, future))
+
+    def finished(self, future, job):
+        self.running -= 1
+        if not future.done():
+            if job.cancelled():
+                future.cancel()
+            elif job.exception() is not None:
+                future.set_exception(job.exception())
+            else:
+                future.set_result(job.result())
+        self.dispatch()
+
+    def shutdown(self):
+        for _, _, _, _, future in self.queue:
+            future.cancel()
+        self.queue = []
+        self.executor.shutdown(wait=False)
+        self.background.shutdown(wait=False)
+
+
+_pools = {}
+
+def worker_pool(conf):
+    """
+    the node's pool for conf['worker_pool'] and conf['workers'], shared
+    by every group built from the same settings
+    """
+    key = (conf['worker_pool'], conf['workers'])
+    if key not in _pools:
+        _pools[key] = WorkerPool(conf['workers'], conf['worker_pool'])
+    return _pools[key]
@@ -0,0 +1,442 @@
+"""
+Benchmarks a BPCon cluster on localhost
+
+Starts N nodes with throwaway keys and certificates, either all in this
+process or one subprocess each, drives a workload against the first
+node and prints the results as JSON:
+
+    python benchmark.py --nodes 3 --workload mixed --requests 2000
+    python benchmark.py --mode subprocess --nodes 5 --value-size 1024
+    python benchmark.py --compare baseline.json   # exit 1 on regression
+
+Workloads: write (puts only), mixed (--write-ratio puts, the rest lease
+reads) and read (lease reads of keys written during warm-up).
+
+In-process nodes share this process's cpu, each is built and closed
+in its own directory so their data/ files and blob stores stay apart.
+They never checkpoint during a run, which would write relative to
+whichever directory is current. Subprocess nodes each run in their own
+directory, which is closer to a real deployment.
+"""
+
+import argparse
+import asyncio
+import configparser
+import contextlib
+import hashlib
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from Crypto.PublicKey import RSA
+
+from configManager import ConfigManager, log
+from BPCon.clients import ClientServer, client_wss
+from BPCon.connections import ConnectionManager
+from BPCon.metrics import REGISTRY
+from BPCon.sharding import ShardRouter
+from BPCon.utils import get_ssl_context
+from state import StateManager
+import websockets
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PORT_STRIDE = 10 # ports per node: peers, clients (+1), metrics (+2)
+
+
+class Node(object):
+    """
+    one replica serving peers and clients, as demo.py runs it
+    """
+    def __init__(self, conf):
+        self.conf = conf
+        self.dir = os.path.dirname(conf['config_file'])
+        with node_dir(self.dir): # state files are opened relative to the working directory
+            self.state = StateManager(conf)
+            self.state.load_state()
+            self.router = ShardRouter(conf, self.state)
+            self.clients = ClientServer(self.router, conf)
+        self.servers = []
+
+    @asyncio.coroutine
+    def start(self):
+        ip, port = self.conf['ip_addr'], self.conf['port']
+        self.servers.append((yield from websockets.serve(self.router.main_loop, ip, port, ssl=self.conf['ssl'])))
+        self.servers.append((yield from websockets.serve(self.clients.main_loop, ip, port + 1, ssl=self.conf['ssl'])))
+
+    @asyncio.coroutine
+    def close(self):
+        for server in self.servers:
+            server.close()
+        with node_dir(self.dir):
+            yield from self.router.close()
+            yield from self.clients.close()
+
+
+def make_cluster(root, args):
+    """
+    writes a config.ini, keys and certificates for each node under
+    root, returns (node dirs, peer wss list)
+    """
+    ports = [args.port + PORT_STRIDE * i for i in range(args.nodes)]
+    wss = ["wss://127.0.0.1:{}".format(port) for port in ports]
+    dirs = [os.path.join(root, "node{}".format(i)) for i in range(args.nodes)]
+    pubkeys, certs = [], []
+    for d in dirs:
+        for sub in ('creds/local', 'creds/peers/certs', 'creds/peers/pubkeys', 'data'):
+            os.makedirs(os.path.join(d, sub))
+        key = RSA.generate(2048)
+        keyfile = os.path.join(d, 'creds/local/server.key')
+        with open(keyfile, 'wb') as fh:
+            fh.write(key.exportKey())
+        certfile = os.path.join(d, 'creds/local/server.crt')
+        subprocess.check_call(['openssl', 'req', '-new', '-x509', '-days', '1', '-subj', '/CN=localhost',
+                               '-key', keyfile, '-out', certfile], stderr=subprocess.DEVNULL)
+        pubkeys.append(key.publickey().exportKey().decode())
+        with open(certfile) as fh:
+            certs.append(fh.read())
+        shutil.copy(os.path.join(HERE, 'logging_config.ini'), d)
+
+    for i, d in enumerate(dirs):
+        for j, peer in enumerate(wss):
+            ID = hashlib.sha1(peer.encode()).hexdigest() # GroupManager.get_ID
+            if j != i:
+                with open(os.path.join(d, 'creds/peers/pubkeys', ID + '.pubkey'), 'w') as fh:
+                    fh.write(pubkeys[j])
+            with open(os.path.join(d, 'creds/peers/certs', ID + '.crt'), 'w') as fh:
+                fh.write(certs[j])
+        write_config(d, ports[i], args)
+    return dirs, wss
+
+def write_config(d, port, args):
+    # the repo's config.ini with this node's ports, files and the run's settings
+    config = configparser.ConfigParser()
+    config.read(os.path.join(HERE, 'config.ini'))
+    config['network']['port'] = str(port)
+    config['testing']['is_client'] = '0'
+    for name in ('certfile', 'keyfile'):
+        config['creds'][name] = os.path.join(d, 'creds/local', os.path.basename(config['creds'][name]))
+    config['creds']['peer_certs'] = os.path.join(d, 'creds/peers/certs/')
+    config['creds']['peer_keys'] = os.path.join(d, 'creds/peers/pubkeys/')
+    config['state']['config_file'] = os.path.join(d, 'config.ini')
+    config['state']['wal_file'] = os.path.join(d, 'data/bpcon.wal')
+    config['state']['db_file'] = os.path.join(d, 'data/kv.sqlite')
+    config['state']['blob_dir'] = os.path.join(d, 'data/blobs/') # blob stores are shared per directory
+    config['state']['frontend_socket'] = os.path.join(d, 'data/frontends.sock')
+    config['state']['storage_engine'] = args.storage_engine
+    config['vars']['wire_format'] = args.wire_format
+    config['vars']['pipeline_window'] = str(args.pipeline_window)
+    config['vars']['batch_max_ops'] = str(args.batch_max_ops)
+    config['vars']['shards'] = str(args.shards)
+    config['vars']['metrics'] = '1' if args.metrics else '0'
+    config['vars']['metrics_http'] = '0'
+    config['vars']['snapshot_interval'] = str(10 ** 9) # no checkpoints mid-run
+    with open(os.path.join(d, 'config.ini'), 'w') as fh:
+        config.write(fh)
+
+@contextlib.contextmanager
+def node_dir(d):
+    cwd = os.getcwd()
+    os.chdir(d)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+def load_node_conf(d, wss):
+    # ConfigManager checks for credentials relative to the working directory
+    with node_dir(d):
+        conf = ConfigManager().load_config('config.ini')
+    conf['peerlist'] = [peer for peer in wss if peer != conf['p_wss']]
+    return conf
+
+
+class InProcessCluster(object):
+    def __init__(self, dirs, wss):
+        self.confs = [load_node_conf(d, wss) for d in dirs]
+        self.nodes = []
+
+    @asyncio.coroutine
+    def start(self):
+        REGISTRY.configure(self.confs[0])
+        for conf in self.confs:
+            node = Node(conf)
+            yield from node.start()
+            self.nodes.append(node)
+        self.router = self.nodes[0].router
+        self.max_lag = self.confs[0]['read_max_lag']
+
+    @asyncio.coroutine
+    def write(self, op):
+        return (yield from self.router.submit(op))
+
+    @asyncio.coroutine
+    def read(self, key):
+        return (yield from self.router.read(key, 'lease', self.max_lag))
+
+    def cpu(self):
+        return time.process_time()
+
+    @asyncio.coroutine
+    def stop(self):
+        for node in self.nodes:
+            yield from node.close()
+
+
+class SubprocessCluster(object):
+    def __init__(self, dirs, wss):
+        self.dirs = dirs
+        self.wss = wss
+        self.procs = []
+        self.target = client_wss(wss[0])
+        self.conn = ConnectionManager(get_ssl_context(os.path.join(dirs[0], 'creds/peers/certs/')), log)
+
+    @asyncio.coroutine
+    def start(self, timeout=60.0):
+        for d in self.dirs:
+            cmd = [sys.executable, os.path.abspath(__file__), '--serve', d, '--peers', ",".join(self.wss)]
+            self.procs.append(subprocess.Popen(cmd, cwd=d))
+        deadline = time.time() + timeout
+        for wss in self.wss:
+            host, port = client_wss(wss)[len("wss://"):].rsplit(':', 1)
+            while not port_open(host, int(port)):
+                if time.time() > deadline or any(p.poll() is not None for p in self.procs):
+                    raise RuntimeError("node {} did not come up".format(wss))
+                yield from asyncio.sleep(0.1)
+
+    @asyncio.coroutine
+    def call(self, op):
+        reply = yield from self.conn.request(self.target, op)
+        if not isinstance(reply, str):
+            reply = bytes(reply).decode()
+        return json.loads(reply)
+
+    @asyncio.coroutine
+    def write(self, op):
+        return (yield from self.call(op))
+
+    @asyncio.coroutine
+    def read(self, key):
+        return (yield from self.call("G,{},lease".format(key)))
+
+    def cpu(self):
+        # node processes only, the driver is left out
+        used = [proc_cpu(p.pid) for p in self.procs]
+        return None if None in used else sum(used)
+
+    @asyncio.coroutine
+    def stop(self):
+        yield from self.conn.close_all()
+        for p in self.procs:
+            p.terminate()
+        for p in self.procs:
+            try:
+                p.wait(10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+
+def port_open(host, port):
+    try:
+        socket.create_connection((host, port), 0.5).close()
+        return True
+    except OSError:
+        return False
+
+def proc_cpu(pid):
+    # user + system seconds of a child from /proc, None where unavailable
+    try:
+        with open("/proc/{}/stat".format(pid)) as fh:
+            fields = fh.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+def serve_node(d, wss):
+    """
+    --serve entry point, runs one node until SIGTERM
+    """
+    os.chdir(d)
+    log.setLevel('WARNING')
+    conf = load_node_conf(d, wss)
+    REGISTRY.configure(conf)
+    loop = asyncio.get_event_loop()
+    node = Node(conf)
+    loop.run_until_complete(node.start())
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(node.close())
+
+
+@asyncio.coroutine
+def run_ops(cluster, ops, concurrency, timeout):
+    """
+    runs (kind, key, op) tuples with concurrency workers
+    returns {'write': [latency], 'read': [latency]} of successful ops and
+    the number that failed
+    """
+    latencies = {'write': [], 'read': []}
+    failed = [0]
+    ops = iter(ops)
+
+    @asyncio.coroutine
+    def worker():
+        for kind, key, op in ops:
+            started = time.perf_counter()
+            try:
+                call = cluster.write(op) if kind == 'write' else cluster.read(key)
+                res = yield from asyncio.wait_for(call, timeout)
+            except Exception:
+                res = {'code': 1}
+            if res.get('code') == 0:
+                latencies[kind].append(time.perf_counter() - started)
+            else:
+                failed[0] += 1
+
+    yield from asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, failed[0]
+
+def workload(args, count, rng, write_ratio):
+    value = "v" * args.value_size
+    for _ in range(count):
+        key = "k{}".format(rng.randrange(args.keys))
+        if rng.random() < write_ratio:
+            yield 'write', key, "P,{},{}".format(key, value)
+        else:
+            yield 'read', key, None
+
+def summarize(samples):
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+    return {'count': len(samples), 'mean': sum(samples) / len(samples),
+            'p50': pick(50), 'p99': pick(99), 'max': samples[-1]}
+
+@asyncio.coroutine
+def benchmark(cluster, args):
+    rng = random.Random(args.seed)
+    write_ratio = {'write': 1.0, 'mixed': args.write_ratio, 'read': 0.0}[args.workload]
+    warmup = [('write', "k{}".format(i), "P,k{},{}".format(i, "v" * args.value_size))
+              for i in range(args.keys if args.workload != 'write' else 0)]
+    warmup.extend(workload(args, args.warmup, rng, 1.0))
+    yield from run_ops(cluster, warmup, args.concurrency, args.timeout)
+
+    cpu = cluster.cpu()
+    started = time.perf_counter()
+    latencies, failed = yield from run_ops(cluster, workload(args, args.requests, rng, write_ratio),
+                                           args.concurrency, args.timeout)
+    elapsed = time.perf_counter() - started
+    cpu_used = cluster.cpu() - cpu if cpu is not None else None
+
+    commits = len(latencies['write'])
+    result = {
+        'config': vars(args),
+        'seconds': elapsed,
+        'commits': commits,
+        'reads': len(latencies['read']),
+        'failed': failed,
+        'commits_per_sec': commits / elapsed,
+        'ops_per_sec': (commits + len(latencies['read'])) / elapsed,
+        'write_latency': summarize(latencies['write']),
+        'read_latency': summarize(latencies['read']),
+        'cpu_seconds': cpu_used,
+        'cpu_per_commit': cpu_used / commits if cpu_used is not None and commits else None,
+    }
+    if args.metrics and args.mode == 'inprocess':
+        result['metrics'] = REGISTRY.snapshot()
+    return result
+
+def regressions(result, baseline, tolerance):
+    """
+    list of complaints about result against a baseline run
+    """
+    found = []
+    if result['commits_per_sec'] < baseline['commits_per_sec'] * (1 - tolerance):
+        found.append("commits/sec {:.1f} < baseline {:.1f}".format(result['commits_per_sec'], baseline['commits_per_sec']))
+    for kind in ('write_latency', 'read_latency'):
+        now, before = result[kind].get('p99'), baseline[kind].get('p99')
+        if now is not None and before is not None and now > before * (1 + tolerance):
+            found.append("{} p99 {:.4f}s > baseline {:.4f}s".format(kind, now, before))
+    now, before = result['cpu_per_commit'], baseline.get('cpu_per_commit')
+    if now is not None and before is not None and now > before * (1 + tolerance):
+        found.append("cpu/commit {:.6f}s > baseline {:.6f}s".format(now, before))
+    return found
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="BPCon cluster benchmark")
+    p.add_argument('--nodes', type=int, default=3, help="replicas in the group")
+    p.add_argument('--mode', choices=('inprocess', 'subprocess'), default='inprocess')
+    p.add_argument('--workload', choices=('write', 'mixed', 'read'), default='write')
+    p.add_argument('--write-ratio', type=float, default=0.5, help="share of puts in the mixed workload")
+    p.add_argument('--requests', type=int, default=1000)
+    p.add_argument('--warmup', type=int, default=100, help="writes before measuring")
+    p.add_argument('--concurrency', type=int, default=32, help="outstanding requests")
+    p.add_argument('--value-size', type=int, default=16, help="bytes per value")
+    p.add_argument('--keys', type=int, default=1000, help="distinct keys")
+    p.add_argument('--shards', type=int, default=1)
+    p.add_argument('--wire-format', choices=('text', 'binary'), default='binary')
+    p.add_argument('--pipeline-window', type=int, default=8)
+    p.add_argument('--batch-max-ops', type=int, default=100)
+    p.add_argument('--storage-engine', choices=('memory', 'sqlite'), default='memory')
+    p.add_argument('--port', type=int, default=18000, help="first node's peer port")
+    p.add_argument('--timeout', type=float, default=10.0, help="seconds per request")
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--metrics', action='store_true', help="include the metrics snapshot (inprocess)")
+    p.add_argument('--out', help="also write the JSON result here")
+    p.add_argument('--compare', help="baseline JSON, exit 1 on regression")
+    p.add_argument('--tolerance', type=float, default=0.1, help="allowed relative regression")
+    p.add_argument('--keep', action='store_true', help="keep the cluster directory")
+    p.add_argument('--serve', help=argparse.SUPPRESS)
+    p.add_argument('--peers', help=argparse.SUPPRESS)
+    return p.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.serve:
+        serve_node(args.serve, args.peers.split(','))
+        return 0
+
+    log.setLevel('WARNING') # per-ballot logging would dominate the numbers
+    root = tempfile.mkdtemp(prefix='bpcon-bench-')
+    cwd = os.getcwd()
+    loop = asyncio.get_event_loop()
+    try:
+        dirs, wss = make_cluster(root, args)
+        if args.mode == 'inprocess':
+            cluster = InProcessCluster(dirs, wss)
+        else:
+            cluster = SubprocessCluster(dirs, wss)
+        loop.run_until_complete(cluster.start())
+        try:
+            result = loop.run_until_complete(benchmark(cluster, args))
+        finally:
+            loop.run_until_complete(cluster.stop())
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    print(output)
+    if args.out:
+        with open(args.out, 'w') as fh:
+            fh.write(output + "\n")
+    if args.compare:
+        with open(args.compare) as fh:
+            found = regressions(result, json.load(fh), args.tolerance)
+        for complaint in found:
+            print("regression: " + complaint, file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
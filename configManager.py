@@ -48,29 +48,70 @@ class ConfigManager:
 
         # Logging
         log.info("verifying credentials")
-        # verify credential file tree
-        if not os.path.exists('creds'):
-            shell("mkdir creds")
-        if not os.path.exists('creds/peers'):
-            shell("mkdir -p creds/peers/certs")
-            shell("mkdir -p creds/peers/pubkeys")
-        if not os.path.exists('creds/local'):
-            shell("mkdir creds/local")
+        # verify credential file tree, generated in-process when missing
+        for dirname in ('creds/peers/certs', 'creds/peers/pubkeys', 'creds/local'):
+            os.makedirs(dirname, exist_ok=True)
         if not os.path.isfile('creds/local/server.key'):
             log.info("Generating private key")
-            shell("openssl genrsa -passout pass:x -out server.pass.key 2048")
-            shell("openssl rsa -passin pass:x -in server.pass.key -out creds/local/server.key")
-            shell("rm server.pass.key")
-            shell("openssl rsa -in creds/local/server.key -pubout > creds/local/server.pub")
+            key = RSA.generate(2048)
+            with open('creds/local/server.key', 'wb') as fh:
+                fh.write(key.exportKey())
+            os.chmod('creds/local/server.key', 0o600)
+            with open('creds/local/server.pub', 'wb') as fh:
+                fh.write(key.publickey().exportKey())
         if not os.path.isfile('creds/local/server.crt'):
             log.info("Signing certificate")
-            shell("openssl req -new -subj '/C=SE/ST=XX/L=XX/O=XX/CN=localhost' -key creds/local/server.key -out creds/local/server.csr")
-            shell("openssl x509 -req -days 365 -in creds/local/server.csr -signkey creds/local/server.key -out creds/local/server.crt")
+            # pycrypto has no X.509 support, one self-signed openssl request
+            shell("openssl req -new -x509 -days 365 -subj '/C=SE/ST=XX/L=XX/O=XX/CN=localhost' -key creds/local/server.key -out creds/local/server.crt")
             
         conf['use_single_port'] = bool(self.config['system']['use_single_port'])
         conf['config_file'] = self.config['state']['config_file']
         conf['backup_file'] = self.config['state']['backup_file']
         conf['MAX_GROUP_SIZE'] = int(self.config['vars']['MAX_GROUP_SIZE'])
+        conf['phase_timeout'] = float(self.config['vars'].get('phase_timeout', 3.0))
+        conf['min_phase_timeout'] = float(self.config['vars'].get('min_phase_timeout', 0.05))
+        conf['phi_threshold'] = float(self.config['vars'].get('phi_threshold', 8.0))
+        conf['probe_interval'] = float(self.config['vars'].get('probe_interval', 1.0))
+        conf['request_timeout'] = float(self.config['vars'].get('request_timeout', 10.0))
+        conf['lease_ballots'] = int(self.config['vars'].get('lease_ballots', 0))
+        conf['read_lease'] = float(self.config['vars'].get('read_lease', 0))
+        # ballots a stale read may trail the newest one seen, 0 by default as in config.ini
+        conf['read_max_lag'] = int(self.config['vars'].get('read_max_lag', 0))
+        conf['sig_scheme'] = self.config['vars'].get('sig_scheme', 'auto')
+        conf['hmac_keyfile'] = self.config['creds'].get('hmac_keyfile', 'creds/local/group.secret')
+        conf['verify_workers'] = int(self.config['vars'].get('verify_workers', 2))
+        conf['workers'] = int(self.config['vars'].get('workers', conf['verify_workers']))
+        conf['worker_pool'] = self.config['vars'].get('worker_pool', 'thread')
+        conf['offload_bytes'] = int(self.config['vars'].get('offload_bytes', 4096))
+        conf['frontends'] = int(self.config['vars'].get('frontends', 0)) # 0 serves the ports from the core itself
+        conf['frontend_socket'] = self.config['state'].get('frontend_socket', 'data/frontends.sock')
+        conf['frontend_inflight'] = int(self.config['vars'].get('frontend_inflight', 256)) # client requests each front end relays at once
+        conf['verify_cache_size'] = int(self.config['vars'].get('verify_cache_size', 1024))
+        conf['wire_format'] = self.config['vars'].get('wire_format', 'text')
+        conf['wal_file'] = self.config['state'].get('wal_file', 'data/bpcon.wal')
+        conf['storage_engine'] = self.config['state'].get('storage_engine', 'memory')
+        conf['snapshot_compress'] = self.config['state'].get('snapshot_compress', '0') == '1'
+        conf['db_file'] = self.config['state'].get('db_file', 'data/kv.sqlite')
+        conf['storage_cache_size'] = int(self.config['vars'].get('storage_cache_size', 10000))
+        conf['wal_sync_delay'] = float(self.config['vars'].get('wal_sync_delay', 0.002))
+        conf['snapshot_interval'] = int(self.config['vars'].get('snapshot_interval', 10000))
+        conf['transfer_chunk_bytes'] = int(self.config['vars'].get('transfer_chunk_bytes', 262144))
+        conf['blob_threshold'] = int(self.config['vars'].get('blob_threshold', 65536))
+        conf['blob_chunk_bytes'] = int(self.config['vars'].get('blob_chunk_bytes', 262144))
+        conf['blob_dir'] = self.config['state'].get('blob_dir', 'data/blobs/')
+        conf['log_capacity'] = int(self.config['vars'].get('log_capacity', 20000))
+        conf['pipeline_window'] = int(self.config['vars'].get('pipeline_window', 1))
+        conf['batch_max_ops'] = int(self.config['vars'].get('batch_max_ops', 100))
+        conf['batch_max_delay'] = float(self.config['vars'].get('batch_max_delay', 0.005))
+        conf['shards'] = int(self.config['vars'].get('shards', 1))
+        conf['client_queue_size'] = int(self.config['vars'].get('client_queue_size', 1024))
+        conf['gid'] = '' # default group, ShardRouter sets it per group
+        conf['metrics'] = self.config['vars'].get('metrics', '0') == '1'
+        conf['tracing'] = self.config['vars'].get('tracing', '0') == '1'
+        conf['span_capacity'] = int(self.config['vars'].get('span_capacity', 10000))
+        # local HTTP endpoint two ports above the peer port, 0 when off
+        metrics_http = self.config['vars'].get('metrics_http', '0') == '1'
+        conf['metrics_port'] = conf['port'] + 2 if conf['metrics'] and metrics_http else 0
 
 
         ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
@@ -10,9 +10,16 @@ import asyncio
 import websockets
 import sys
 import hashlib
+import os
+import shutil
+import tarfile
 import time
 
-from BPCon.protocol import BPConProtocol
+from BPCon.sharding import ShardRouter
+from BPCon.clients import ClientServer
+from BPCon.frontends import CoreServer
+from BPCon.metrics import REGISTRY
+from BPCon.workers import worker_pool
 from configManager import ConfigManager, log
 from BPCon.utils import shell
 from state import StateManager
@@ -22,16 +29,46 @@ if len(sys.argv) == 2:
 else:
     configFile = "config.ini"
 
+CLONE = "clone.tar.gz"
+CLONE_STAMP = ".clone_extracted" # mtime of the clone last extracted
+
+def clone_members(tar):
+    # plain files and directories inside the working directory, for
+    # tarfile versions without extraction filters
+    root = os.path.realpath('.')
+    for member in tar.getmembers():
+        path = os.path.realpath(os.path.join(root, member.name))
+        if not (member.isfile() or member.isdir()) or not path.startswith(root + os.sep):
+            raise ValueError("refusing to extract {} from {}".format(member.name, CLONE))
+        yield member
+
 class BPConDemo:
     def __init__(self):
         try:
-            self.startup() 
-            self.state = StateManager(self.conf)
+            self.startup() # loads self.state
             self.loop = asyncio.get_event_loop()
-            self.bpcon = BPConProtocol(self.conf, self.state)
-            self.paxos_server = websockets.serve(self.bpcon.main_loop, self.conf['ip_addr'], self.conf['port'], ssl=self.conf['ssl'])
-            self.loop.run_until_complete(self.paxos_server)
-            log.info("Started BPCon on port {}".format(self.conf['port']))
+            self.metrics_server = None
+            if self.conf['metrics_port']:
+                self.metrics_server = self.loop.run_until_complete(REGISTRY.serve('127.0.0.1', self.conf['metrics_port']))
+                log.info("Serving metrics on http://127.0.0.1:{}/metrics".format(self.conf['metrics_port']))
+            self.router = ShardRouter(self.conf, self.state)
+            self.bpcon = self.router.groups[''] # default group
+            self.clients = ClientServer(self.router, self.conf)
+            self.paxos_server = self.client_server = self.frontends = None
+            if self.conf['frontends']:
+                # front-end processes own the ports, see BPCon.frontends
+                self.frontends = CoreServer(self.router, self.clients, self.conf)
+                self.loop.run_until_complete(self.frontends.start(configFile))
+                log.info("Started BPCon with {} front ends on ports {} and {}".format(
+                    self.conf['frontends'], self.conf['port'], self.conf['port']+1))
+            else:
+                # the started servers, closed in shutdown
+                self.paxos_server = self.loop.run_until_complete(websockets.serve(
+                    self.router.main_loop, self.conf['ip_addr'], self.conf['port'], ssl=self.conf['ssl']))
+                log.info("Started BPCon on port {}".format(self.conf['port']))
+                self.client_server = self.loop.run_until_complete(websockets.serve(
+                    self.clients.main_loop, self.conf['ip_addr'], self.conf['port']+1, ssl=self.conf['ssl']))
+            log.info("Serving clients on {}".format(self.conf['c_wss']))
 
             if self.conf['is_client']:
                 log.debug("is client. making test requests")
@@ -42,6 +79,9 @@ class BPConDemo:
                     self.commit("P,test2,value2")
                     self.commit("P,test,value3")
                     self.commit("D,test2,")
+                self.commit_batch(["P,batch{},value{}".format(x,x) for x in range(10)])
+                for mode in ('lease', 'index', 'stale'):
+                    log.info("{} read of test: {}".format(mode, self.read("test", mode)))
 
                 log.debug("requests complete")     
 
@@ -51,14 +91,23 @@ class BPConDemo:
     def commit(self,msg):
         self.loop.run_until_complete(self.bpcon_request(msg))
 
+    def read(self, key, mode='lease'):
+        return self.loop.run_until_complete(self.router.read(key, mode))
+
+    def commit_batch(self, msgs):
+        # submitted together so ops owned by the same group share one ballot
+        futures = [self.router.submit(msg) for msg in msgs]
+        results = self.loop.run_until_complete(asyncio.gather(*futures))
+        log.info("batch commit results: {}".format(results))
+
     def got_commit_result(self, future):
         if future.done():
             if not future.cancelled():
-                self.log.info("commit result: {}".format(future.result()))
+                log.info("commit result: {}".format(future.result()))
             else:
-                self.log.info("future cancelled")
+                log.info("future cancelled")
         else:
-            self.log.info("future not done")
+            log.info("future not done")
 
     @asyncio.coroutine
     def bpcon_request(self, msg):
@@ -66,8 +115,9 @@ class BPConDemo:
         bpcon_task = asyncio.Future()
         bpcon_task.add_done_callback(self.got_commit_result)
         try:
-            timer_result = asyncio.wait_for(bpcon_task, 3.0) # timer possibly unneccessary
-            commit_result = yield from self.bpcon.request(msg, bpcon_task) # returns boolean
+            # shielded, a timed out ballot keeps running so its slot is not left empty
+            request = asyncio.ensure_future(self.router.request(msg, bpcon_task))
+            commit_result = yield from asyncio.wait_for(asyncio.shield(request), self.conf['request_timeout'])
             log.info("bpcon request result: {}".format(commit_result))
             return commit_result
 
@@ -81,20 +131,16 @@ class BPConDemo:
     def startup(self):
         """
         startup routine
-        Loads from cloned state
+        Loads from cloned state, a restart with the same clone keeps
+        the node's own data and credentials
 
         """
-        # clean working dir and extract config, creds, and state
-        log.info("Cleaning working directory...")
-        command = "rm config.ini && rm -rf data && rm -rf creds"
-        shell(command)
-        log.info("Extracting cloned state...")
-        command = "tar xzf clone.tar.gz"
-        shell(command)
+        self.extract_clone()
         # load config
         log.info("Loading configuration...")
         self.cm = ConfigManager()
         self.conf = self.cm.load_config(configFile)
+        REGISTRY.configure(self.conf) # before any group binds its metrics
 
 
         # load state
@@ -102,6 +148,29 @@ class BPConDemo:
         self.state = StateManager(self.conf)
         self.state.load_state()
 
+    def extract_clone(self):
+        # clean working dir and extract config, creds, and state, once per clone
+        if not os.path.isfile(CLONE):
+            return
+        stamp = str(os.stat(CLONE).st_mtime_ns)
+        if os.path.isfile(CLONE_STAMP):
+            with open(CLONE_STAMP) as fh:
+                if fh.read() == stamp:
+                    return
+        log.info("Cleaning working directory...")
+        if os.path.isfile("config.ini"):
+            os.remove("config.ini")
+        shutil.rmtree("data", ignore_errors=True)
+        shutil.rmtree("creds", ignore_errors=True)
+        log.info("Extracting cloned state...")
+        with tarfile.open(CLONE) as tar:
+            if hasattr(tarfile, 'data_filter'):
+                tar.extractall(filter='data')
+            else:
+                tar.extractall(members=clone_members(tar))
+        with open(CLONE_STAMP, 'w') as fh:
+            fh.write(stamp)
+
     """
     def clone(self):
         
@@ -122,7 +191,7 @@ class BPConDemo:
             log.info("clone of state failed")
 
     def handle_reconfig_request(self, epoch=0):
-        toreturn = self.bpcon.bmsgs
+        toreturn = list(self.bpcon.bmsgs.range(-1))
         if epoch != 0:
             self.clone()
             with open('clone.tar.gz', 'r') as fh:
@@ -138,8 +207,18 @@ class BPConDemo:
 
     def shutdown(self):
         print("\nShutdown initiated...")
-        print("\nDatabase contents:\n{}".format(self.bpcon.state.db.kvstore)) # save state here
-        self.paxos_server.close()
+        for gid, state in sorted(self.router.states.items()):
+            print("\nDatabase contents of group '{}':\n{}".format(gid, dict(state.db.scan()))) # save state here
+        if self.frontends:
+            self.frontends.close()
+        for server in (self.paxos_server, self.client_server):
+            if server:
+                server.close()
+        if self.metrics_server:
+            self.metrics_server.close()
+        self.loop.run_until_complete(self.router.close())
+        self.loop.run_until_complete(self.clients.close())
+        worker_pool(self.conf).shutdown()
     
 
 def start():
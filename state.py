@@ -1,40 +1,149 @@
 from BPCon.routing import GroupManager
-from BPCon.storage import InMemoryStorage
+from BPCon.storage import open_storage
+from BPCon.ordered import prefix_end
+from BPCon.snapshot import write_snapshot, read_snapshot
+from BPCon.utils import group_path
+from BPCon.wire import decode_text_value
+from BPCon.blobs import blob_store, parse_ref
 from Crypto.Hash import SHA
+import asyncio
+import functools
 import pickle
+import threading
 import time
 
 class StateManager:
     def __init__(self, conf): # init_state=None):
         self.log = conf['log']
+        self.gid = conf['gid'] # consensus group owning this state
         
-        self.db = InMemoryStorage()
+        self.db = open_storage(conf)
+        self.blobs = blob_store(conf) # large values, see BPCon.blobs
+        self.ballot = -1 # last ballot applied
+        self.frozen = None # ballot after which writes are refused, the group is being merged away
+        self.reconfig = None # callback(t, k, v) -> code, or future of it, for S/M ops, set by a ShardRouter
+        self.pending = None  # future of a keyspace change still running, later ballots wait for it
+        self.image_lock = threading.Lock() # held while an image is written
+        self.image_seq = 0   # bumped per image, a background one overtaken by a newer one is dropped
 
     def update(self, val, ballot_num=-1):
-        self.log.debug("updating state: ballot #{}, op: {}".format(ballot_num, val))
+        """
+        applies a committed ballot value, either one "t,k,v" op or a
+        newline separated batch of them, all or nothing
+
+        returns list of per-op result codes (0 applied, 1 malformed or refused op),
+        a keyspace change still running leaves its code None and sets pending
+
+        keyspace changes travel as single-op ballots:
+          S,at,gid    split off [at, hi) into new group gid
+          F,,         freeze this group ahead of a merge
+          M,gid,b     merge in group gid, frozen at its ballot b
+        """
+        self.log.debug("updating state: ballot #%s, op: %s", ballot_num, val)
+        if not isinstance(val, str):
+            # raw UTF-8 from a binary frame or the wal
+            val = str(val, 'utf-8')
         if not ',' in val:
             # requires unpackaging
-            length, data = val.split('<>')
-            val = int(data).to_bytes(int(length), byteorder='little').decode()
+            val = decode_text_value(val)
+        ref = parse_ref(val)
+        if ref:
+            val = str(self.blobs.get(ref[0]), 'utf-8') # raises KeyError if missing
 
-        t,k,v = val.split(',')
-        
-        #DB requests
-        if t == 'P':
-            self.db.put(k,v)
-        elif t == 'D':
-            self.db.delete(k)
+        codes = []
+        staged = []
+        reconfig = None
+        ops = val.split('\n')
+        for op in ops:
+            try:
+                t,k,v = op.split(',')
+            except ValueError:
+                codes.append(1)
+                continue
+            if t in ('P', 'D') and self.frozen is None:
+                staged.append((t,k,v))
+                codes.append(0)
+            elif t == 'N': # no-op
+                codes.append(0)
+            elif t in ('S', 'F', 'M') and len(ops) == 1 and self.frozen is None:
+                reconfig = (t,k,v)
+                codes.append(0)
+            else:
+                codes.append(1)
+
+        self.apply_ops(staged)
+        self.ballot = max(self.ballot, ballot_num)
+        if reconfig:
+            # after the ballot is recorded so a snapshot taken by the callback covers it
+            if reconfig[0] == 'F':
+                self.frozen = ballot_num
+            elif self.reconfig:
+                code = self.reconfig(*reconfig)
+                if isinstance(code, asyncio.Future):
+                    # finishes in the background, see BPConProtocol.apply_ready
+                    self.pending, code = code, None
+                codes[0] = code
+            else:
+                codes[0] = 1
+        return codes
+
+    def read(self, k):
+        # None for unset keys
+        try:
+            return self.db.get(k)
+        except KeyError:
+            return None
+
+    def scan(self, start=None, end=None, limit=None):
+        # (k, v) for start <= k < end in key order
+        return self.db.scan(start, end, limit)
+
+    def prefix(self, p, limit=None):
+        # (k, v) for keys starting with p in key order
+        return self.db.scan(p, prefix_end(p), limit)
+
+    def apply_ops(self, ops):
+        # DB requests, one write for the whole ballot
+        if ops:
+            self.db.apply_batch(ops)
     
     def image_state(self):
         # create disc copy of system state 
         try:
             # These saved to data directory
-            self.db.save()
+            with self.image_lock:
+                self.image_seq += 1
+                self.db.save()
+                write_snapshot(group_path('data/state_meta.snap', self.gid), self.meta())
         except Exception as e:
             self.log.debug("save state failed: {}".format(e))
 
+    def image_job(self):
+        """
+        image_state for a background thread: captures the state now and
+        returns a function that writes it, True once written, False if
+        a newer image was written first
+        """
+        self.image_seq += 1
+        return functools.partial(self.write_image, self.image_seq, self.db.saver(), self.meta())
+
+    def write_image(self, seq, save_db, meta):
+        with self.image_lock:
+            if seq != self.image_seq:
+                return False
+            save_db()
+            write_snapshot(group_path('data/state_meta.snap', self.gid), meta)
+            return True
+
+    def meta(self):
+        frozen = '' if self.frozen is None else str(self.frozen)
+        return [('ballot', str(self.ballot)), ('frozen', frozen)]
+
     def load_state(self):
         try:
             self.db.load()
+            meta = dict(read_snapshot(group_path('data/state_meta.snap', self.gid)))
+            self.ballot = int(meta['ballot'])
+            self.frozen = int(meta['frozen']) if meta.get('frozen') else None
         except Exception as e:
             self.log.debug("load state failed: {}".format(e))
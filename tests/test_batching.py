@@ -0,0 +1,44 @@
+import asyncio
+import logging
+
+from BPCon.batching import ProposalBatcher
+from BPCon.protocol import valid_op
+from tests.test_protocol import cluster, propose, run, setup_function, teardown_function
+
+def batcher(bpcon, max_ops=100):
+    return ProposalBatcher(bpcon, {'log': logging.getLogger(), 'batch_max_ops': max_ops,
+                                   'batch_max_delay': 0.01, 'pipeline_window': 2})
+
+def test_per_op_codes():
+    nodes, down = cluster(1)
+    batch = batcher(nodes[0])
+    ops = ["P,a,1", "D,a,", "S,x,g1", "N,,", "P,b,2"] # a reconfig op is refused inside a batch
+    futures = [batch.submit(op) for op in ops]
+    codes = [res['code'] for res in run(asyncio.gather(*futures))]
+    assert codes == [0, 0, 1, 0, 0]
+    assert nodes[0].applied == 0 # one ballot
+    assert nodes[0].state.read('a') is None and nodes[0].state.read('b') == '2'
+
+def test_failed_ballot():
+    class Failing(object):
+        gid = ''
+        @asyncio.coroutine
+        def request(self, value, future, batch=False):
+            self.value = value
+            return {'code': 1}
+    bpcon = Failing()
+    batch = batcher(bpcon, max_ops=2)
+    futures = [batch.submit("P,k{},v".format(i)) for i in range(3)]
+    assert run(asyncio.gather(*futures)) == [{'code': 1}] * 3
+    assert bpcon.value == "P,k2,v" # two ballots of at most max_ops
+
+def test_rejects_malformed_ops():
+    for op in ("P,k", "P,k,v,w", "P,k,v\nP,j,w", "P,k&1c,v", "P,k,a&b"):
+        assert not valid_op(op)
+    assert valid_op("D,k,") and valid_op("P,ключ,värde")
+    nodes, down = cluster(1)
+    batch = batcher(nodes[0])
+    assert batch.submit("P,k,v\nD,j,").result() == {'code': 1}
+    assert propose(nodes[0], "P,k,v\nD,j,") == {'code': 1} # one op only outside a batch
+    assert propose(nodes[0], "P,k,a&b") == {'code': 1}
+    assert nodes[0].applied == -1
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import os
+import tempfile
+
+from BPCon import wire
+from BPCon.blobs import BlobStore, PULL_WINDOW, write_blob, parse_ref
+
+def store():
+    return BlobStore(tempfile.mkdtemp(), 1000, 1.0, logging.getLogger())
+
+def test_refs():
+    blobs = store()
+    data = ("värde&;," * 500).encode()
+    ref = write_blob(blobs.directory, data)
+    digest, length = parse_ref(ref)
+    assert length == len(data) and blobs.get(digest) == data
+    assert parse_ref(ref.encode()) == parse_ref(wire.encode_text_value(ref)) == (digest, length)
+    assert write_blob(blobs.directory, data) == ref
+    for value in ("P,k,v", "L,../../etc/passwd,5", "L,{},x".format(digest), "L" * 1000, b'\xff\xfe'):
+        assert parse_ref(value) is None
+
+def test_chunks_and_release():
+    blobs = store()
+    data = os.urandom(2500)
+    digest, _ = parse_ref(write_blob(blobs.directory, data))
+    received = b''
+    for chunk in range(3):
+        msg_type, fields = wire.decode(blobs.serve(chunk, digest))
+        assert msg_type == "bc" and wire.to_int(fields[1]) == chunk
+        assert wire.to_int(fields[2]) == int(chunk < 2)
+        received += bytes(fields[3])
+    assert received == data
+    for digest_ in ("0" * 64, "../x"):
+        msg_type, fields = wire.decode(blobs.serve(3, digest_))
+        assert msg_type == "bn" and wire.to_int(fields[1]) == 3
+    blobs.hold(digest)
+    blobs.hold(digest)
+    blobs.release(digest)
+    assert blobs.has(digest)
+    blobs.release(digest)
+    assert not blobs.has(digest)
+
+class Peers(object):
+    """
+    connections serving bf requests from in-process stores
+    """
+    def __init__(self, stores):
+        self.stores = stores
+        self.inflight = 0
+        self.most = 0
+        self.asked = []
+
+    @asyncio.coroutine
+    def request(self, peer, msg):
+        msg_type, fields = wire.decode(msg)
+        self.asked.append(peer)
+        self.inflight += 1
+        self.most = max(self.most, self.inflight)
+        yield from asyncio.sleep(0.001)
+        self.inflight -= 1
+        return self.stores[peer].serve(wire.to_int(fields[1]), wire.to_str(fields[2]))
+
+def test_pipelined_pull():
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    source, empty, blobs = store(), store(), store()
+    data = os.urandom(20500)
+    digest, length = parse_ref(write_blob(source.directory, data))
+    peers = Peers({'empty': empty, 'source': source})
+    fetched = asyncio.get_event_loop().run_until_complete(blobs.fetch(digest, length, ['empty', 'source'], peers))
+    assert fetched and blobs.get(digest) == data
+    assert peers.asked.count('empty') <= PULL_WINDOW # gave up on the first miss
+    assert peers.asked.count('source') == 21 and peers.most == PULL_WINDOW
+    assert not os.path.exists(blobs.path(digest) + ".part")
+
+def test_release_keeps_held_blob():
+    blobs = store()
+    digest, _ = parse_ref(write_blob(blobs.directory, b"x" * 3000))
+    blobs.hold(digest) # a request proposing it
+    blobs.hold(digest) # another request with the same value
+    blobs.release(digest) # the first one's ballot failed
+    assert blobs.has(digest)
+    blobs.release(digest)
+    assert not blobs.has(digest)
@@ -0,0 +1,99 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+
+from BPCon.clients import ClientServer, client_wss
+
+class Group(object):
+    leader = None
+
+class Router(object):
+    """
+    one group, writes wait for go, reads answer at once
+    """
+    def __init__(self):
+        self.groups = {'': Group()}
+        self.go = asyncio.Event()
+        self.writing = 0
+        self.ops = []
+
+    def owner(self, key):
+        return ''
+
+    @asyncio.coroutine
+    def submit(self, op):
+        self.ops.append(op)
+        self.writing += 1
+        yield from self.go.wait()
+        self.writing -= 1
+        return {'code': 0}
+
+    @asyncio.coroutine
+    def read(self, key, mode, max_lag):
+        return {'code': 0, 'value': mode}
+
+class FakeSocket(object):
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.sent = []
+
+    @asyncio.coroutine
+    def recv(self):
+        if self.frames:
+            return self.frames.pop(0)
+        yield from asyncio.Future() # stays connected
+
+    @asyncio.coroutine
+    def send(self, msg):
+        self.sent.append(msg)
+
+def server(router, queue_size):
+    d = tempfile.mkdtemp()
+    os.makedirs(os.path.join(d, "certs"))
+    conf = {'log': logging.getLogger(), 'p_wss': "wss://127.0.0.1:9000", 'read_max_lag': 0,
+            'client_queue_size': queue_size, 'peer_certs': os.path.join(d, "certs/")}
+    return ClientServer(router, conf)
+
+def replies(sock):
+    return dict((int(cid), json.loads(body)) for cid, body in (m.split('#', 1) for m in sock.sent))
+
+def test_admission():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    router = Router()
+    clients = server(router, 2)
+    sock = FakeSocket(["{}#P,k{},v".format(i, i) for i in range(4)] + ["4#G,k,", "5#bad"])
+    serving = asyncio.ensure_future(clients.main_loop(sock, '/'))
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert router.writing == clients.outstanding == 2 # stopped reading while full
+    assert sock.sent == []
+    router.go.set()
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert replies(sock) == {0: {'code': 0}, 1: {'code': 0}, 2: {'code': 0}, 3: {'code': 0},
+                             4: {'code': 0, 'value': 'lease'}, 5: {'code': 1}}
+    assert clients.outstanding == 0 and router.ops == ["P,k{},v".format(i) for i in range(4)]
+    serving.cancel()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+def test_forwarding():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    router = Router()
+    router.go.set()
+    router.groups[''].leader = "wss://127.0.0.1:9010"
+    clients = server(router, 4)
+    forwarded = []
+
+    @asyncio.coroutine
+    def request(wss, msg):
+        forwarded.append((wss, msg))
+        return json.dumps({'code': 0, 'via': wss})
+    clients.leaders.request = request
+    assert loop.run_until_complete(clients.handle("P,k,v")) == {'code': 0, 'via': "wss://127.0.0.1:9011"}
+    assert forwarded == [(client_wss("wss://127.0.0.1:9010"), "!P,k,v")]
+    assert loop.run_until_complete(clients.handle("!P,k,v")) == {'code': 0} # not forwarded twice
+    assert router.ops == ["P,k,v"] and len(forwarded) == 1
+    loop.close()
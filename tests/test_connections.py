@@ -0,0 +1,114 @@
+import asyncio
+import logging
+
+from BPCon import connections
+from BPCon.connections import ConnectionManager, tagged, unwrap, wrap
+
+def test_envelope():
+    assert wrap(7, "1b&1.0&3") == "7#1b&1.0&3"
+    assert unwrap("7#1b&1.0&3") == (7, "1b&1.0&3")
+    assert unwrap("1b&1.0&3#x") == (None, "1b&1.0&3#x") # untagged, '#' in the body
+    cid, msg = unwrap(wrap(2**64 - 1, b'\xbc\x01#frame'))
+    assert cid == 2**64 - 1 and bytes(msg) == b'\xbc\x01#frame'
+    assert unwrap(b'\xbc\x01frame') == (None, b'\xbc\x01frame')
+    for raw in ("7#x", wrap(3, b'frame')):
+        assert tagged(raw)
+    for raw in ("x#7", "#x", "1b&1.0", b'#short', b'\xbc\x01frame'):
+        assert not tagged(raw)
+
+class Peer(object):
+    """
+    websocket to a peer answering each request with "re:" + msg,
+    replies for cids in hold are kept back until release()
+    """
+    def __init__(self):
+        self.open = True
+        self.replies = asyncio.Queue()
+        self.held = []
+        self.hold = set()
+
+    @asyncio.coroutine
+    def send(self, raw):
+        cid, msg = unwrap(raw)
+        reply = wrap(cid, "re:" + msg)
+        if cid in self.hold:
+            self.held.append(reply)
+        else:
+            self.replies.put_nowait(reply)
+
+    def release(self):
+        for reply in self.held:
+            self.replies.put_nowait(reply)
+
+    @asyncio.coroutine
+    def recv(self):
+        reply = yield from self.replies.get()
+        if reply is None:
+            raise ConnectionError("connection dropped")
+        return reply
+
+    def drop(self):
+        self.open = False
+        self.replies.put_nowait(None)
+
+    @asyncio.coroutine
+    def close(self):
+        self.drop()
+
+def manager(monkeypatch, fail=False):
+    sockets = []
+    @asyncio.coroutine
+    def connect(uri, ssl=None):
+        if fail:
+            raise OSError("connection refused")
+        sockets.append(Peer())
+        return sockets[-1]
+    monkeypatch.setattr(connections.websockets, 'connect', connect, raising=False)
+    return ConnectionManager(None, logging.getLogger(), min_backoff=0.05), sockets
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(asyncio.wait_for(coro, 2))
+
+def setup_function(function):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+def test_shared_socket(monkeypatch):
+    conns, sockets = manager(monkeypatch)
+    run(conns.get("wss://a"))
+    sockets[0].hold.add(0)
+    first = asyncio.ensure_future(conns.request("wss://a", "slow"))
+    assert run(conns.request("wss://a", "fast")) == "re:fast" # answered past the held reply
+    sockets[0].release()
+    assert run(first) == "re:slow"
+    assert len(sockets) == 1 and not conns.waiting
+    run(conns.close_all())
+
+def test_reconnect(monkeypatch):
+    conns, sockets = manager(monkeypatch)
+    assert run(conns.request("wss://a", "1a")) == "re:1a"
+    sockets[0].hold.add(1)
+    waiting = asyncio.ensure_future(conns.request("wss://a", "1c"))
+    run(asyncio.sleep(0.01))
+    sockets[0].drop()
+    try:
+        run(waiting)
+        assert False, "request outlived its connection"
+    except ConnectionError:
+        pass
+    assert run(conns.request("wss://a", "2a")) == "re:2a"
+    assert len(sockets) == 2
+    run(conns.close_all())
+
+def test_backoff(monkeypatch):
+    conns, sockets = manager(monkeypatch, fail=True)
+    for expected in (OSError, ConnectionError): # refused, then failing fast in backoff
+        try:
+            run(conns.request("wss://a", "1a"))
+            assert False
+        except Exception as e:
+            assert type(e) is expected
+    run(asyncio.sleep(0.06))
+    manager(monkeypatch) # peer is back
+    assert run(conns.request("wss://a", "1a")) == "re:1a"
+    assert "wss://a" not in conns.backoff
+    run(conns.close_all())
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+
+from BPCon.frontends import CoreServer, FrontEnd, frame, read_frame, reply_frame
+
+def read_all(data):
+    loop = asyncio.new_event_loop()
+    try:
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data(data)
+        reader.feed_eof()
+        frames = []
+        while True:
+            try:
+                frames.append(loop.run_until_complete(read_frame(reader)))
+            except asyncio.IncompleteReadError:
+                return frames
+    finally:
+        loop.close()
+
+def test_frames_round_trip():
+    data = frame(1, b'P', b"\nri&1.0&5") + frame(2**32 - 1, b'c', b'#\x00\n\x00') + reply_frame(3, None)
+    assert read_all(data) == [(1, b'P', b"\nri&1.0&5"), (2**32 - 1, b'c', b'#\x00\n\x00'), (3, b'n', b'')]
+
+def test_reply_kinds():
+    assert read_all(reply_frame(4, "rr&1&5&0")) == [(4, b'R', b"rr&1&5&0")]
+    assert read_all(reply_frame(5, memoryview(b'\xbc\x01rr'))) == [(5, b'r', b'\xbc\x01rr')]
+
+def test_truncated_frame():
+    assert read_all(frame(6, b'C', b'1#G,a,')[:-1]) == []
+
+class FakeWriter(object):
+    def __init__(self):
+        self.frames = []
+        self.drains = 0
+
+    def write(self, data):
+        self.frames.append(data)
+
+    @asyncio.coroutine
+    def drain(self):
+        self.drains += 1
+
+    def close(self):
+        pass
+
+class FakeSocket(object):
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.sent = []
+
+    @asyncio.coroutine
+    def recv(self):
+        if self.frames:
+            return self.frames.pop(0)
+        yield from asyncio.Future() # stays connected
+
+    @asyncio.coroutine
+    def send(self, msg):
+        self.sent.append(msg)
+
+def conf(inflight):
+    return {'log': logging.getLogger(), 'frontends': 1, 'frontend_socket': '', 'frontend_inflight': inflight}
+
+def test_frontend_caps_client_requests():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    front = FrontEnd(conf(2))
+    front.writer = FakeWriter()
+    sock = FakeSocket(["{}#G,k,".format(i) for i in range(5)])
+    reading = asyncio.ensure_future(front.client_loop(sock, '/'))
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert len(front.writer.frames) == front.writer.drains == 2 # stopped reading
+    while front.waiting:
+        for tag, future in list(front.waiting.items()):
+            future.set_result("{}#done".format(tag))
+            front.waiting.pop(tag)
+        loop.run_until_complete(asyncio.sleep(0.01))
+    assert len(front.writer.frames) == front.writer.drains == 5
+    assert sorted(sock.sent) == ["{}#done".format(i) for i in range(5)]
+    reading.cancel()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+class Clients(object):
+    def __init__(self):
+        self.serving = 0
+        self.most = 0
+        self.go = asyncio.Event()
+
+    @asyncio.coroutine
+    def admit(self):
+        pass
+
+    @asyncio.coroutine
+    def answer(self, cid, msg):
+        self.serving += 1
+        self.most = max(self.most, self.serving)
+        yield from self.go.wait()
+        self.serving -= 1
+        return "{}#{}".format(cid, msg)
+
+def test_core_caps_link():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    clients = Clients()
+    core = CoreServer(None, clients, conf(2))
+    reader = asyncio.StreamReader(loop=loop)
+    for i in range(4):
+        reader.feed_data(frame(i, b'C', "{}#G,k,".format(i).encode()))
+    writer = FakeWriter()
+    link = asyncio.ensure_future(core.serve_link(reader, writer))
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert clients.serving == 2 and not writer.frames
+    clients.go.set()
+    loop.run_until_complete(asyncio.sleep(0.01))
+    reader.feed_eof()
+    loop.run_until_complete(link)
+    assert clients.most == 2 and writer.drains == 4
+    assert read_all(b''.join(writer.frames)) == [(i, b'R', "{}#G,k,".format(i).encode()) for i in range(4)]
+    loop.close()
+
+def test_frontend_relays_peer_messages_unparsed():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    front = FrontEnd(conf(2))
+    front.writer = FakeWriter()
+    sock = FakeSocket(["not paxos"])
+    reading = asyncio.ensure_future(front.peer_loop(sock, '/g'))
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert read_all(b''.join(front.writer.frames))[0][1:] == (b'P', b"g\nnot paxos") # the core drops it
+    for tag, future in list(front.waiting.items()):
+        future.set_result(None)
+        front.waiting.pop(tag)
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert sock.sent == []
+    reading.cancel()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
@@ -0,0 +1,20 @@
+from BPCon.latency import LatencyTracker
+
+def test_percentiles():
+    t = LatencyTracker()
+    for i in range(100):
+        t.record(0.001 if i < 95 else 0.1)
+    assert t.percentile(50) < 0.002
+    assert 0.1 <= t.percentile(99) < 0.15
+
+def test_phi_grows_with_silence():
+    t = LatencyTracker()
+    assert t.phi() == 0.0
+    for _ in range(50):
+        t.record(0.01)
+    t.record_failure(0.011)
+    low = t.phi()
+    t.record_failure(1.0)
+    assert low < 8.0 < t.phi()
+    t.record(0.01) # answered again
+    assert t.phi() == 0.0
@@ -0,0 +1,29 @@
+from BPCon.metrics import Registry, NULL
+
+def test_disabled_hands_out_noops():
+    r = Registry()
+    assert r.counter('ballots', group='') is NULL
+    with r.timer('phase_seconds').time(), r.span('request', ballot=1):
+        pass
+    r.gauge('queue', lambda: 1)
+    assert r.snapshot() == {} and not r.spans
+
+def test_snapshot_and_render():
+    r = Registry(enabled=True, tracing=True)
+    r.counter('ballots', group='', result='committed').inc(3)
+    t = r.timer('phase_seconds', group='', phase='1')
+    for _ in range(10):
+        t.observe(0.002)
+    r.gauge('queue', lambda: 7, group='')
+    with r.span('phase1b', group='', ballot=4):
+        pass
+    snap = r.snapshot()
+    assert snap['ballots'][0]['value'] == 3
+    assert snap['phase_seconds'][0]['count'] == 10
+    assert snap['queue'][0]['value'] == 7
+    text = r.render()
+    assert 'ballots{group="",result="committed"} 3' in text
+    assert 'phase_seconds_count{group="",phase="1"} 10' in text
+    assert r.spans[0]['name'] == 'phase1b' and r.spans[0]['ballot'] == 4
+    r.drop(group='')
+    assert r.snapshot() == {}
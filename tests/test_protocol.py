@@ -0,0 +1,261 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+
+from Crypto.PublicKey import RSA
+from BPCon import blobs, wire, workers
+from BPCon.protocol import BPConProtocol
+from state import StateManager
+
+def node_conf(d, wss, peerlist, **extra):
+    conf = {'log': logging.getLogger(), 'gid': '', 'p_wss': wss, 'peerlist': peerlist,
+            'keyfile': os.path.join(d, "server.key"), 'certfile': os.path.join(d, "server.crt"),
+            'peer_keys': os.path.join(d, "pubkeys/"), 'peer_certs': os.path.join(d, "certs/"),
+            'sig_scheme': 'rsa', 'verify_cache_size': 64, 'workers': 2, 'worker_pool': 'thread',
+            'phi_threshold': 8.0, 'probe_interval': 1.0, 'min_phase_timeout': 0.05,
+            'phase_timeout': 0.5, 'lease_ballots': 0, 'read_lease': 0, 'pipeline_window': 4,
+            'wire_format': 'text', 'offload_bytes': 4096, 'log_capacity': 100,
+            'wal_file': os.path.join(d, "data/bpcon.wal"), 'wal_sync_delay': 0.001,
+            'snapshot_interval': 10000, 'transfer_chunk_bytes': 4096,
+            'storage_engine': 'memory', 'snapshot_compress': False, 'storage_cache_size': 100,
+            'db_file': os.path.join(d, "data/kv.sqlite"), 'blob_threshold': 65536,
+            'blob_chunk_bytes': 4096, 'blob_dir': os.path.join(d, "data/blobs/")}
+    conf.update(extra)
+    return conf
+
+def node_dirs(n):
+    """
+    (dir, wss) of n nodes, each dir holding the node's key and its
+    peers' public keys
+    """
+    wss = ["wss://127.0.0.1:{}".format(9100 + 10 * i) for i in range(n)]
+    keys = [RSA.generate(1024) for _ in wss]
+    dirs = []
+    for i, own in enumerate(wss):
+        d = tempfile.mkdtemp()
+        for sub in ("pubkeys", "certs"):
+            os.makedirs(os.path.join(d, sub))
+        with open(os.path.join(d, "server.key"), 'wb') as fh:
+            fh.write(keys[i].exportKey())
+        with open(os.path.join(d, "server.crt"), 'w') as fh:
+            fh.write("cert")
+        for peer, key in zip(wss, keys):
+            if peer != own:
+                name = hashlib.sha1(peer.encode()).hexdigest() + ".pubkey"
+                with open(os.path.join(d, "pubkeys", name), 'wb') as fh:
+                    fh.write(key.publickey().exportKey())
+        dirs.append(d)
+    return list(zip(dirs, wss))
+
+def cluster(n, **extra):
+    """
+    n nodes whose peer connections call each other's handle_msg
+    in-process, requests to a wss added to the returned set fail like
+    a dead peer
+    """
+    nodes = []
+    members = node_dirs(n)
+    wss = [own for _, own in members]
+    for d, own in members:
+        conf = node_conf(d, own, [p for p in wss if p != own], **extra)
+        nodes.append(BPConProtocol(conf, StateManager(conf)))
+    down = set()
+    by_wss = dict(zip(wss, nodes))
+
+    @asyncio.coroutine
+    def request(peer, msg):
+        if peer in down:
+            raise ConnectionError("{} is down".format(peer))
+        # handled in full like a sent message, even if the sender stops waiting
+        reply = yield from asyncio.shield(asyncio.ensure_future(by_wss[peer].handle_msg(msg)))
+        yield from asyncio.sleep(0.001)
+        return reply
+
+    for node in nodes:
+        node.peers.connections.request = request
+    return nodes, down
+
+def run(coro, timeout=10):
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(asyncio.wait_for(coro, timeout))
+
+def propose(node, op):
+    return run(node.request(op, asyncio.Future()))
+
+def record(node):
+    """
+    types of the messages node sends to its peers, in order
+    """
+    sent = []
+    request = node.peers.connections.request
+
+    @asyncio.coroutine
+    def recording(peer, msg):
+        sent.append(wire.decode(msg)[0] if wire.is_binary(msg) else msg.split('&', 1)[0])
+        return (yield from request(peer, msg))
+    node.peers.connections.request = recording
+    return sent
+
+def setup_function(function):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    function.cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp()) # state images go to data/ under the working directory
+
+def teardown_function(function):
+    # node-wide pools and stores are per process, each test has its own nodes and loop
+    for pool in workers._pools.values():
+        pool.shutdown()
+    workers._pools.clear()
+    blobs._stores.clear()
+    asyncio.get_event_loop().close()
+    os.chdir(function.cwd)
+
+def test_minority_down():
+    for n in (3, 5):
+        nodes, down = cluster(n)
+        down.update(node.wss for node in nodes[n - n // 2:])
+        assert propose(nodes[0], "P,k,v")['code'] == 0
+        assert [node.state.read('k') for node in nodes] == ['v'] * (n - n // 2) + [None] * (n // 2)
+    nodes, down = cluster(3)
+    down.update(node.wss for node in nodes[1:])
+    assert propose(nodes[0], "P,k,v")['code'] == 1 # a majority is down
+
+def test_stragglers_not_suspected():
+    nodes, down = cluster(3)
+    request = nodes[0].peers.connections.request
+
+    @asyncio.coroutine
+    def slow(peer, msg):
+        if peer == nodes[2].wss:
+            yield from asyncio.sleep(0.2)
+        return (yield from request(peer, msg))
+    nodes[0].peers.connections.request = slow
+    assert propose(nodes[0], "P,k,v")['code'] == 0 # nodes[1] made the quorum
+    assert nodes[0].peers.tracker(nodes[2].wss).phi() == 0.0
+    down.add(nodes[1].wss)
+    assert propose(nodes[0], "P,k,w")['code'] == 0 # still asked, waited for
+
+def test_fill_after_failed_slot():
+    nodes, down = cluster(3, phase_timeout=0.5, phi_threshold=float('inf')) # no peer skipped as suspect
+    down.update(node.wss for node in nodes[1:])
+    assert propose(nodes[0], "P,a,0")['code'] == 1
+    down.clear()
+    for i in range(1, 4):
+        assert propose(nodes[0], "P,k{},v".format(i))['code'] == 0
+    run(asyncio.sleep(2.0)) # slot 0 is filled, the rest apply behind it
+    assert [node.applied for node in nodes] == [3, 3, 3]
+    assert [node.state.read('a') for node in nodes] == [None, None, None] # filled with a no-op
+    assert [node.state.read('k3') for node in nodes] == ['v', 'v', 'v']
+
+def test_fill_adopts_vote():
+    for fmt in ('text', 'binary'):
+        nodes, down = cluster(3, wire_format=fmt)
+        nodes[1].ready[0] = ("P,b,4", None) # voted for a ballot whose 2b was lost
+        run(nodes[0].fill_slot(0))
+        assert [node.state.read('b') for node in nodes] == ['4', '4', '4']
+        assert [node.applied for node in nodes] == [0, 0, 0]
+
+def test_fill_catches_up():
+    nodes, down = cluster(3)
+    down.add(nodes[2].wss)
+    for i in range(3):
+        assert propose(nodes[0], "P,k{},v".format(i))['code'] == 0
+    down.clear()
+    assert nodes[2].applied == -1
+    run(nodes[2].fill_slot(0)) # applied by its peers, pulled instead of filled
+    assert nodes[2].applied == 2 and nodes[2].state.read('k2') == 'v'
+
+class FakeSocket(object):
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.sent = []
+
+    @asyncio.coroutine
+    def recv(self):
+        if self.frames:
+            return self.frames.pop(0)
+        yield from asyncio.Future() # peer stays connected
+
+    @asyncio.coroutine
+    def send(self, msg):
+        self.sent.append(msg)
+
+def test_tagged_messages_concurrent():
+    nodes, down = cluster(1)
+    node = nodes[0]
+    served = asyncio.Event()
+
+    @asyncio.coroutine
+    def serve_msg(raw):
+        if raw == "0#slow":
+            yield from served.wait() # only answerable once a later message is served
+        elif raw == "1#fast":
+            served.set()
+        return raw
+    node.serve_msg = serve_msg
+
+    sock = FakeSocket(["0#slow", "1#fast", "once"])
+    loop = asyncio.ensure_future(node.main_loop(sock, '/'))
+    run(asyncio.sleep(0.05))
+    loop.cancel()
+    assert sock.sent == ["once", "1#fast", "0#slow"]
+
+def test_lease_skips_phase1():
+    for fmt in ('text', 'binary'):
+        nodes, down = cluster(3, lease_ballots=3, wire_format=fmt)
+        sent = record(nodes[0])
+        phase1 = []
+        for i in range(5):
+            del sent[:]
+            assert propose(nodes[0], "P,k{},v".format(i))['code'] == 0
+            phase1.append("1a" in sent)
+        assert phase1 == [True, False, False, True, False] # a lease covers 3 ballots
+        assert [node.state.read('k4') for node in nodes].count('v') >= 2 # a majority applied it
+
+def test_lease_dropped():
+    nodes, down = cluster(3, lease_ballots=10)
+    sent = record(nodes[0])
+    assert propose(nodes[0], "P,a,1")['code'] == 0
+    assert propose(nodes[1], "P,b,2")['code'] == 0 # another leader runs phase 1
+    assert nodes[0].lease is None
+    del sent[:]
+    assert propose(nodes[0], "P,c,3")['code'] == 0
+    assert "1a" in sent # phase 1 again after losing the lease
+    assert [node.state.read('c') for node in nodes].count('3') >= 2
+
+def test_read_modes():
+    nodes, down = cluster(3, read_lease=0.5)
+    assert propose(nodes[0], "P,k,v")['code'] == 0
+    sent = record(nodes[0])
+    assert run(nodes[0].read('k', 'lease')) == {'code': 0, 'value': 'v'}
+    assert sent == [] # served under the read lease
+    assert run(nodes[1].read('k', 'index')) == {'code': 0, 'value': 'v'}
+    assert run(nodes[0].read('k', 'index')) == {'code': 0, 'value': 'v'}
+    assert "ri" in sent
+    run(asyncio.sleep(0.5))
+    del sent[:]
+    assert run(nodes[0].read('k', 'lease')) == {'code': 0, 'value': 'v'}
+    assert "ri" in sent # lease ran out, read-index round instead
+
+    down.add(nodes[2].wss)
+    assert propose(nodes[0], "P,k,w")['code'] == 0
+    assert run(nodes[2].read('k', 'stale')) == {'code': 0, 'value': 'v'} # as far as it knows
+    nodes[2].maxBal = nodes[0].applied # heard of the newer ballot
+    assert run(nodes[2].read('k', 'stale', max_lag=0)) == {'code': 1}
+    assert run(nodes[2].read('k', 'stale', max_lag=1)) == {'code': 0, 'value': 'v'}
+    down.update(node.wss for node in nodes)
+    assert run(nodes[1].read('k', 'index')) == {'code': 1} # no quorum
+
+def test_fill_waits_out_read_lease():
+    nodes, down = cluster(3, read_lease=0.5)
+    assert propose(nodes[0], "P,k,v")['code'] == 0
+    N = nodes[1].applied + 1
+    assert run(nodes[1].fill_round(N, 1, None))['code'] == 1 # granted nodes[0] the lease
+    nodes[1].lease_grant = ('', 0)
+    down.add(nodes[0].wss)
+    assert run(nodes[1].fill_round(N, 1, None))['code'] == 1 # nodes[2] refuses the fa
+    run(asyncio.sleep(0.5))
+    assert run(nodes[1].fill_round(N, 2, None))['code'] == 0
+    assert nodes[1].applied == N
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import tempfile
+import threading
+
+from Crypto.PublicKey import RSA
+from BPCon.routing import GroupManager
+from BPCon.signing import from_spec
+from tests.test_protocol import node_conf, run, setup_function, teardown_function
+
+def group(peers, cache_size=64):
+    d = tempfile.mkdtemp()
+    os.makedirs(os.path.join(d, "certs"))
+    manager = GroupManager(node_conf(d, "wss://127.0.0.1:9100", [], verify_cache_size=cache_size, workers=4))
+    manager.peers.update(peers)
+    calls = []
+    call = manager.pool.call
+    def counting(priority, obj, method, *args):
+        calls.append(obj)
+        return call(priority, obj, method, *args)
+    manager.pool.call = counting
+    return manager, calls
+
+def signed(n):
+    """
+    n peers with RSA keys and a 1b signed by each
+    """
+    peers, msgs = {}, []
+    for i in range(n):
+        key = RSA.generate(1024)
+        wss = "wss://127.0.0.1:{}".format(9110 + 10 * i)
+        peers[wss] = from_spec(('verify', key.publickey().exportKey().decode()))
+        msg = "1b&{}".format(i).encode()
+        msgs.append((wss, msg, from_spec(('sign', key.exportKey().decode())).sign(msg)))
+    return peers, msgs
+
+def test_verify_sigs_caches():
+    peers, msgs = signed(3)
+    manager, calls = group(peers)
+    assert run(manager.verify_sigs(msgs)) == 3
+    assert len(calls) == 3 and len(manager.verified) == 3
+    assert run(manager.verify_sigs(msgs + msgs)) == 3 # one vote per peer
+    assert len(calls) == 3 # all from the cache
+    wss, msg, sig = msgs[0]
+    tampered = bytes([sig[0] ^ 1]) + sig[1:]
+    again = [(wss, msg, tampered), ("wss://unknown:1", msg, sig)]
+    assert run(manager.verify_sigs(again)) == 0
+    assert len(calls) == 4 and len(manager.verified) == 3 # failures are not cached
+    as_int = [(w, m, int.from_bytes(s, byteorder='little')) for w, m, s in msgs] # text proofs
+    assert run(manager.verify_sigs(as_int)) == 3 and len(calls) == 4
+
+def test_verify_sigs_counts_valid_after_invalid():
+    peers, msgs = signed(2)
+    manager, calls = group(peers)
+    wss, msg, sig = msgs[0]
+    tampered = bytes([sig[0] ^ 1]) + sig[1:]
+    assert run(manager.verify_sigs([(wss, msg, tampered)] + msgs + msgs)) == 2
+    assert len(calls) == 3 # the duplicates were checked once
+
+def test_verify_sigs_evicts():
+    peers, msgs = signed(3)
+    manager, calls = group(peers, cache_size=2)
+    assert run(manager.verify_sigs(msgs)) == 3
+    assert len(manager.verified) == 2
+    assert run(manager.verify_sigs(msgs)) == 3
+    assert len(calls) == 4 # the evicted one was checked again
+
+def test_verify_sigs_short_circuits():
+    release = threading.Event()
+    class Slow(object):
+        sig_size = 4
+        def verify(self, msg, sig):
+            return release.wait(5)
+    class Fast(Slow):
+        def verify(self, msg, sig):
+            return True
+    peers = {"wss://a:1": Fast(), "wss://b:1": Slow(), "wss://c:1": Slow()}
+    manager, calls = group(peers)
+    msgs = [(wss, b"1b", b"sig!") for wss in peers]
+    try:
+        assert run(manager.verify_sigs(msgs, needed=1), timeout=2) == 1 # did not wait for the slow ones
+    finally:
+        release.set()
+    assert len(calls) == 3 and len(manager.verified) == 1
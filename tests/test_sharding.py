@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+from BPCon.connections import ConnectionManager
+from BPCon.sharding import ShardRouter, key_point
+from state import StateManager
+from tests.test_protocol import node_conf, node_dirs, run, setup_function, teardown_function
+
+KEYS = ["k{}".format(i) for i in range(24)]
+RIGHT = 'g80000000' # split off at 0.5
+
+def shard_cluster(n, monkeypatch, **extra):
+    """
+    n nodes of one group each, peer connections reach the group named
+    by their path on the other router in-process, requests to a wss
+    added to the returned set fail like a dead peer, no peer is
+    skipped as a suspect so every replica sees every ballot
+    """
+    extra.setdefault('phi_threshold', float('inf'))
+    members = node_dirs(n)
+    wss = [own for _, own in members]
+    routers = []
+    for d, own in members:
+        conf = node_conf(d, own, [p for p in wss if p != own], shards=1,
+                         batch_max_ops=16, batch_max_delay=0.001, **extra)
+        routers.append(ShardRouter(conf, StateManager(conf)))
+    down = set()
+    by_wss = dict(zip(wss, routers))
+
+    @asyncio.coroutine
+    def request(self, peer, msg):
+        group = by_wss[peer].peer_group(self.path.strip('/'))
+        if peer in down or group is None:
+            raise ConnectionError("{}{} is down".format(peer, self.path))
+        reply = yield from asyncio.shield(asyncio.ensure_future(group.handle_msg(msg)))
+        yield from asyncio.sleep(0.001)
+        return reply
+    monkeypatch.setattr(ConnectionManager, 'request', request)
+    return routers, down
+
+def put(router, key, value):
+    return run(router.request("P,{},{}".format(key, value), asyncio.Future()))['code']
+
+def settle(test, timeout=5.0):
+    # runs the loop until test() holds, changes finish in the background
+    deadline = time.time() + timeout
+    while not test() and time.time() < deadline:
+        run(asyncio.sleep(0.05))
+
+def split(routers):
+    return lambda: all(RIGHT in router.groups for router in routers)
+
+def merged(routers):
+    return lambda: all(list(router.groups) == [''] for router in routers)
+
+def contents(router, gid):
+    return dict(router.states[gid].scan())
+
+def test_split_and_merge(monkeypatch):
+    for engine in ('memory', 'sqlite'):
+        split_and_merge(monkeypatch, storage_engine=engine)
+
+def split_and_merge(monkeypatch, **extra):
+    routers, down = shard_cluster(3, monkeypatch, **extra)
+    for k in KEYS:
+        assert put(routers[0], k, "v") == 0
+    assert run(routers[0].split(''))['results'] == [0]
+    settle(split(routers))
+    right = set(k for k in KEYS if key_point(k) >= 0.5)
+    for router in routers:
+        assert router.ranges == {'': (0.0, 0.5), RIGHT: (0.5, 1.0)}
+        assert set(contents(router, '')) == set(KEYS) - right
+        assert set(contents(router, RIGHT)) == right
+    k = sorted(right)[0]
+    assert routers[0].owner(k) == RIGHT and put(routers[0], k, "w") == 0
+
+    assert run(routers[0].merge(''))['results'] == [0]
+    settle(merged(routers))
+    for router in routers:
+        assert router.ranges == {'': (0.0, 1.0)} and list(router.groups) == ['']
+        assert contents(router, '') == dict((key, "w" if key == k else "v") for key in KEYS)
+
+def test_merge_waits_for_lagging_replica(monkeypatch):
+    routers, down = shard_cluster(3, monkeypatch)
+    assert run(routers[0].split(''))['results'] == [0]
+    settle(split(routers))
+    right = [k for k in KEYS if key_point(k) >= 0.5]
+    down.add(routers[2].conf['p_wss'])
+    for k in right:
+        assert put(routers[0], k, "late") == 0
+    assert run(routers[0].groups[RIGHT].request("F,,", asyncio.Future()))['results'] == [0]
+    down.clear()
+    assert routers[2].groups[RIGHT].applied < routers[0].states[RIGHT].frozen
+    assert run(routers[0].merge(''))['results'] == [0]
+    settle(merged(routers)) # the lagging replica catches its right group up first
+    for router in routers:
+        assert router.ranges == {'': (0.0, 1.0)} and list(router.groups) == ['']
+        assert contents(router, '') == dict((k, "late") for k in right)
@@ -0,0 +1,71 @@
+import os
+import tempfile
+
+from Crypto.PublicKey import RSA
+from BPCon import workers
+from BPCon.signing import ECC, KeyFile, from_spec, import_key, read_key
+
+def write(path, data, mtime):
+    with open(path, 'wb') as fh:
+        fh.write(data)
+    os.utime(path, (mtime, mtime))
+
+def test_keyfile_reloads():
+    d = tempfile.mkdtemp()
+    path = os.path.join(d, "server.key")
+    old, new = RSA.generate(1024), RSA.generate(1024)
+    write(path, old.exportKey(), 1000)
+    signer = KeyFile({'sig_scheme': 'rsa'}, path, 'sign')
+    first = signer.get()
+    assert signer.get() is first # built once per version of the file
+    assert from_spec(('verify', old.publickey().exportKey().decode())).verify(b"1b", signer.sign(b"1b"))
+    write(path, new.exportKey(), 2000) # key rotated
+    assert from_spec(('verify', new.publickey().exportKey().decode())).verify(b"1b", signer.sign(b"1b"))
+
+    secret = os.path.join(d, "group.secret")
+    write(secret, b"one", 1000)
+    hmac_signer = KeyFile({'sig_scheme': 'hmac', 'hmac_keyfile': secret}, path, 'sign')
+    sig = hmac_signer.sign(b"1b")
+    write(secret, b"two", 2000)
+    assert hmac_signer.sign(b"1b") != sig
+    assert from_spec(('hmac', b"two")).verify(b"1b", hmac_signer.sign(b"1b"))
+
+def schemes():
+    rsa = RSA.generate(1024)
+    yield 'rsa', rsa.exportKey().decode(), rsa.publickey().exportKey().decode()
+    if ECC is not None:
+        ed = ECC.generate(curve='ed25519')
+        yield 'ed25519', ed.export_key(format='PEM'), ed.public_key().export_key(format='PEM')
+
+def test_sign_verify():
+    for name, private, public in schemes():
+        signer, verifier = from_spec(('sign', private)), from_spec(('verify', public))
+        assert import_key(public)[0] == name
+        sig = signer.sign(b"1b&0&1")
+        assert len(sig) == signer.sig_size == verifier.sig_size
+        assert verifier.verify(b"1b&0&1", sig)
+        assert verifier.verify(memoryview(b"1b&0&1"), memoryview(sig)) # from binary frames
+        assert not verifier.verify(b"1b&0&2", sig)
+        assert not verifier.verify(b"1b&0&1", bytes([sig[0] ^ 1]) + sig[1:])
+        rebuilt = from_spec(verifier.spec) # as a worker process does
+        assert rebuilt.verify(b"1b&0&1", sig)
+    group = from_spec(('hmac', b"secret"))
+    sig = group.sign(b"1b&0&1")
+    assert len(sig) == group.sig_size and group.verify(b"1b&0&1", sig)
+    assert not group.verify(b"1b&0&1", bytes([sig[0] ^ 1]) + sig[1:])
+    assert not from_spec(('hmac', b"other")).verify(b"1b&0&1", sig)
+
+def test_key_cache():
+    d = tempfile.mkdtemp()
+    for name, private, public in schemes():
+        path = os.path.join(d, name + ".pubkey")
+        write(path, public.encode(), 1000)
+        pem, scheme, key = read_key(path)
+        assert scheme == name and read_key(path)[2] is key # parsed once
+        write(path, public.encode() + b"\n", 2000)
+        assert read_key(path)[2] is not key # parsed again once changed
+    workers._built.clear()
+    spec = ('hmac', b"secret")
+    sig = workers.call_spec(spec, 'sign', b"1b")
+    built = workers._built[spec]
+    assert workers.call_spec(spec, 'verify', b"1b", sig) and workers._built[spec] is built
@@ -0,0 +1,41 @@
+import os
+import tempfile
+
+from BPCon.snapshot import write_snapshot, read_snapshot
+
+def snapshot_path():
+    return os.path.join(tempfile.mkdtemp(), "data", "db_copy.snap")
+
+def test_roundtrip():
+    items = [("k{}".format(i), "v" * (i % 50)) for i in range(5000)] + [("", ""), ("ключ", "значение")]
+    for compress in (False, True):
+        path = snapshot_path()
+        assert write_snapshot(path, items, compress) == len(items)
+        assert list(read_snapshot(path)) == items
+        assert not os.path.exists(path + ".tmp")
+
+def test_detects_damage():
+    path = snapshot_path()
+    write_snapshot(path, [("k{}".format(i), "value") for i in range(100)])
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    for damaged in (data[:-4], data[:20] + b'X' + data[21:]):
+        with open(path, 'wb') as fh:
+            fh.write(damaged)
+        try:
+            list(read_snapshot(path))
+            assert False, "damage not detected"
+        except ValueError:
+            pass
+
+def test_failed_write_keeps_old():
+    path = snapshot_path()
+    write_snapshot(path, [("a", "1")])
+    def items():
+        yield ("b", "2")
+        raise RuntimeError("source failed")
+    try:
+        write_snapshot(path, items())
+    except RuntimeError:
+        pass
+    assert list(read_snapshot(path)) == [("a", "1")]
@@ -0,0 +1,119 @@
+import os
+import tempfile
+import threading
+
+from BPCon.storage import InMemoryStorage, SQLiteStorage
+
+def engines():
+    d = tempfile.mkdtemp()
+    return [InMemoryStorage(os.path.join(d, "db_copy.pkl")),
+            SQLiteStorage(os.path.join(d, "kv.sqlite"), cache_size=2)]
+
+def test_engine_batches():
+    for db in engines():
+        db.apply_batch([('P', 'b', '2'), ('P', 'a', '1'), ('P', 'c', '3'), ('D', 'b', '')])
+        assert db.get('a') == '1'
+        assert db.delete('c') == '3'
+        assert db.delete('c') is None
+        assert len(db) == 1
+        try:
+            db.apply_batch([('P', 'x', '9'), ('P', ['bad'], '9')]) # unhashable, unbindable
+        except Exception:
+            pass
+        assert list(db.scan()) == [('a', '1')] # rolled back
+        db.close()
+
+def test_engine_scan_and_snapshot():
+    for db in engines():
+        db.apply_batch([('P', k, k.upper()) for k in ('d', 'a', 'c', 'b')])
+        assert [k for k,_ in db.scan('b', 'd')] == ['b', 'c']
+        snap = db.snapshot()
+        db.put('e', 'E')
+        assert sorted(snap) == [('a', 'A'), ('b', 'B'), ('c', 'C'), ('d', 'D')]
+        db.replace([('z', 'Z')])
+        assert list(db.scan()) == [('z', 'Z')]
+        db.save()
+        db.close()
+
+def test_sorted_keys():
+    import random
+    from BPCon.ordered import SortedKeys
+    rnd = random.Random(7)
+    keys = SortedKeys(load=4)
+    ref = set()
+    for _ in range(2000):
+        k = "k{:03d}".format(rnd.randrange(300))
+        if rnd.random() < 0.6:
+            keys.add(k)
+            ref.add(k)
+        else:
+            keys.discard(k)
+            ref.discard(k)
+    assert len(keys) == len(ref)
+    assert list(keys.irange()) == sorted(ref)
+    assert list(keys.irange("k100", "k200")) == sorted(k for k in ref if "k100" <= k < "k200")
+
+def test_scan_limit_and_prefix():
+    from BPCon.ordered import prefix_end
+    assert prefix_end("ab") == "ac"
+    assert prefix_end("") is None
+    for db in engines():
+        db.apply_batch([('P', k, '') for k in ('user/1', 'user/2', 'user/3', 'users', 'v')])
+        assert [k for k,_ in db.scan('user/', prefix_end('user/'))] == ['user/1', 'user/2', 'user/3']
+        assert [k for k,_ in db.scan('user', None, 2)] == ['user/1', 'user/2']
+        scan = db.scan()
+        next(scan)
+        db.delete('user/2') # applied mid-scan
+        rest = [k for k,_ in scan]
+        assert rest[-3:] == ['user/3', 'users', 'v'] # sqlite scans a snapshot
+        if isinstance(db, InMemoryStorage):
+            assert len(rest) == 3
+        db.close()
+
+def test_snapshot_copy_on_write():
+    from BPCon.storage import InMemoryStorage
+    db = InMemoryStorage()
+    db.apply_batch([('P', "k{}".format(i), str(i)) for i in range(10)])
+    before = sorted((k, db.get(k)) for k, _ in db.scan())
+    snap = db.snapshot()
+    read = [next(snap) for _ in range(4)] # k0..k3
+    db.put('k1', 'new')     # read already
+    db.put('k5', 'new')     # not read yet
+    db.delete('k7')         # gone before it was read
+    db.put('k45', 'added')  # after the snapshot
+    db.delete('k8')
+    db.put('k8', 'again')   # deleted and added back
+    assert sorted(read + list(snap)) == before
+    assert len(db.snapshots) == 1
+    del snap, read
+    import gc
+    gc.collect()
+    assert len(db.snapshots) == 0
+
+def test_saver_writes_state_as_of_call():
+    from BPCon.snapshot import read_snapshot
+    db = InMemoryStorage(os.path.join(tempfile.mkdtemp(), "db_copy.snap"))
+    db.apply_batch([('P', "k{}".format(i), str(i)) for i in range(1000)])
+    save = db.saver()
+    writer = threading.Thread(target=save)
+    writer.start()
+    for i in range(0, 1000, 3): # while the writer runs
+        db.put("k{}".format(i), 'new')
+        db.delete("k{}".format(i + 1))
+    writer.join()
+    assert sorted(read_snapshot(db.path)) == sorted(("k{}".format(i), str(i)) for i in range(1000))
+
+def test_staging_swap():
+    for db in engines():
+        db.apply_batch([('P', 'a', '1'), ('P', 'b', '2')])
+        snap = db.snapshot()
+        staged = db.staging()
+        staged.apply_batch([('P', 'x', '9')])
+        staged.apply_batch([('P', 'y', '8')])
+        assert list(db.scan()) == [('a', '1'), ('b', '2')] # untouched until the swap
+        db.swap(staged)
+        assert list(db.scan()) == [('x', '9'), ('y', '8')]
+        assert db.get('x') == '9' and len(db) == 2
+        db.put('z', '7')
+        assert sorted(snap) == [('a', '1'), ('b', '2')]
+        db.close()
@@ -1,4 +1,9 @@
-from BPCon import storage, routing, quorum
+import logging
+import os
+import tempfile
+
+from Crypto.PublicKey import RSA
+from BPCon import storage, routing, quorum, signing
 
 def test_storage():
     s = storage.InMemoryStorage()
@@ -7,20 +12,114 @@ def test_storage():
 
     
 def test_routing():
-    r = routing.RoutingManager()
-    r.add_peer("127.0.0.1", 8000, "123", "456")
-    assert list(r.get_all()) == ['wss://127.0.0.1:8000']
+    conf = group_conf("wss://127.0.0.1:8000", ["wss://127.0.0.1:8010"])
+    r = routing.GroupManager(conf)
+    r.init_local_group()
+    assert r.get_all() == [] # peer key not known yet
     assert r.num_peers == 1
-    assert r.get("127.0.0.1") == 'wss://127.0.0.1:8000'
-    r.remove_peer("127.0.0.1")
-    assert r.num_peers == 0
+    peer = RSA.generate(1024).publickey().exportKey().decode()
+    assert r.add_peer("wss://127.0.0.1:8010", peer + "<>cert")
+    assert r.get_all() == ['wss://127.0.0.1:8010']
+    assert r.num_peers == 2
+    assert r.quorum_size() == 1
+    assert r.load_peer("wss://127.0.0.1:8010") is not None
+
+def group_conf(wss, peerlist):
+    d = tempfile.mkdtemp()
+    os.makedirs(os.path.join(d, "certs"))
+    os.makedirs(os.path.join(d, "pubkeys"))
+    with open(os.path.join(d, "server.key"), 'wb') as fh:
+        fh.write(RSA.generate(1024).exportKey())
+    with open(os.path.join(d, "server.crt"), 'w') as fh:
+        fh.write("cert")
+    return {'log': logging.getLogger(), 'gid': '', 'p_wss': wss, 'peerlist': peerlist,
+            'keyfile': os.path.join(d, "server.key"), 'certfile': os.path.join(d, "server.crt"),
+            'peer_keys': os.path.join(d, "pubkeys/"), 'peer_certs': os.path.join(d, "certs/"),
+            'sig_scheme': 'rsa', 'verify_cache_size': 16, 'workers': 1, 'worker_pool': 'thread',
+            'phi_threshold': 8.0, 'probe_interval': 1.0, 'min_phase_timeout': 0.05}
 
 def test_quorum():
-    q = quorum.Quorum(1, 5)
-    q.add(1, 0, "q", "w")
-    q.add(1, 0, "e", "r")
-    assert q.is_quorum() == False
-    q.add(1, 0, "t", "y")
-    assert q.is_quorum() == True
-
-    assert q.get_signatures() == 'w,r,y'
+    q = quorum.Quorum(1, 7)
+    q.add_1b(0, "q", "w")
+    q.add_1b(0, "e", "w") # repeated peer
+    q.add_1b(0, "e", "r")
+    assert q.quorum_1b() == False
+    q.add_1b(0, "t", "y")
+    assert q.quorum_1b() == True
+    assert q.got_majority_accept()
+    assert q.get_msgs() == 'w;q,r;e,y;t'
+    q.add_2b(1)
+    q.add_2b(2) # other ballot
+    assert not q.resolved_2b()
+    q.add_2b(1)
+    q.add_2b(1)
+    assert q.quorum_2b()
+
+def test_quorum_counts_leader():
+    q = quorum.Quorum(0, 3) # leader and two peers, one of them down
+    q.add_1b(-1, "a", "w1")
+    assert q.quorum_1b() and q.got_majority_accept()
+    q.add_2b(0)
+    assert q.quorum_2b()
+    q = quorum.Quorum(0, 5)
+    q.add_2n(0, 3)
+    q.add_2n(0, 3)
+    assert not q.resolved_2b() # two peers can still commit it
+    q.add_2n(0, 3)
+    assert q.resolved_2b() and not q.quorum_2b()
+
+def test_quorum_rejects_and_proofs():
+    from BPCon import wire
+    q = quorum.Quorum(3, 7, binary=True)
+    q.add_1b(5, b"a", "w1")
+    q.add_1b(7, b"b", "w2")
+    q.add_1b(5, b"c", "w3")
+    assert q.quorum_1b() and not q.got_majority_accept()
+    assert q.rejecting_quorum_member() is None # no ballot reported by a quorum
+    q.add_1b(7, b"d", "w4")
+    q.add_1b(7, b"e", "w5")
+    assert q.rejecting_quorum_member() in ("w2", "w4", "w5")
+    count, packed = q.get_proofs()
+    frame = wire.encode("1c", [0, 3, "v"], count=3 + 2 * count) + packed
+    assert [bytes(f) for f in wire.decode(frame)[1][3:7]] == [b"w1", b"a", b"w2", b"b"]
+    assert count == 5
+
+def test_replica_log():
+    from BPCon.replicalog import ReplicaLog
+    log = replicalog_fill(ReplicaLog(4), range(6))
+    assert len(log) == 4
+    assert log.range(0) is None # dropped by the ring
+    assert list(log.range(2)) == [(3, b'v3'), (4, b'v4'), (5, b'v5')]
+    assert list(log.range(2, 4)) == [(3, b'v3'), (4, b'v4')]
+    log.truncate(3)
+    assert list(log.range(3)) == [(4, b'v4'), (5, b'v5')]
+    assert log.range(2) is None
+
+def replicalog_fill(log, ballots):
+    for b in ballots:
+        log.append(b, "v{}".format(b))
+    return log
+
+def test_shard_layout():
+    from BPCon.sharding import initial_layout, key_point, shard_name
+    layout = initial_layout(4)
+    assert [gid for gid,_,_ in layout] == ['', 'g40000000', 'g80000000', 'gc0000000']
+    assert layout[-1][2] == 1.0
+    assert shard_name(0.25) == 'g40000000'
+    assert 0.0 <= key_point("test") < 1.0
+    assert key_point("test") == key_point("test")
+
+def test_lazy_keys():
+    conf = group_conf("wss://127.0.0.1:8000", [])
+    r = routing.GroupManager(conf)
+    r.init_local_group()
+    assert conf['keyfile'] not in signing._keys # nothing parsed at startup
+    own = r.peers["wss://127.0.0.1:8000"]
+    assert own.sig_size == 128
+    assert signing.read_key(conf['keyfile']) is not None
+    parsed = signing._keys[conf['keyfile']]
+    signing.read_key(conf['keyfile'])
+    assert signing._keys[conf['keyfile']] is parsed
+    with open(conf['keyfile'], 'wb') as fh:
+        fh.write(RSA.generate(2048).exportKey())
+    assert signing.read_key(conf['keyfile'])[2].n.bit_length() == 2048 # file changed, parsed again
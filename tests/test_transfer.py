@@ -0,0 +1,67 @@
+import asyncio
+
+from BPCon import wire
+from tests.test_protocol import cluster, propose, run, setup_function, teardown_function
+
+def lagging(n_keys, **extra):
+    """
+    three nodes, the last missed n_keys ballots the leader no longer has in its log
+    """
+    nodes, down = cluster(3, transfer_chunk_bytes=64, **extra)
+    down.add(nodes[2].wss)
+    for i in range(n_keys):
+        assert propose(nodes[0], "P,k{:02d},{}".format(i, "v" * 20))['code'] == 0
+    down.clear()
+    nodes[0].bmsgs.truncate(nodes[0].applied) # covered by a checkpoint
+    return nodes
+
+def chunks_requested(node, fail_at=None):
+    """
+    records the (snapshot id, chunk) of each st node sends, the
+    request numbered fail_at is lost
+    """
+    sent = []
+    request = node.peers.connections.request
+
+    @asyncio.coroutine
+    def counting(peer, msg):
+        msg_type, fields = wire.decode(msg)
+        if msg_type == "st":
+            sent.append((wire.to_int(fields[2]), wire.to_int(fields[3])))
+            if len(sent) == fail_at:
+                raise ConnectionError("connection to {} lost".format(peer))
+        return (yield from request(peer, msg))
+    node.peers.connections.request = counting
+    return sent
+
+def test_snapshot_transfer():
+    for engine in ('memory', 'sqlite'):
+        nodes = lagging(20, storage_engine=engine)
+        sent = chunks_requested(nodes[2])
+        run(nodes[2].transfer.catch_up(nodes[0].wss))
+        assert nodes[2].applied == 19
+        assert list(nodes[2].state.scan()) == list(nodes[0].state.scan())
+        assert len(sent) > 3 and nodes[2].transfer.staged is None
+
+def test_transfer_resumes():
+    nodes = lagging(20)
+    sent = chunks_requested(nodes[2], fail_at=4)
+    run(nodes[2].transfer.catch_up(nodes[0].wss))
+    assert nodes[2].applied == -1
+    assert nodes[2].transfer.staged[2] == 3 # chunks 0-2 are staged
+    resumed = len(sent)
+    run(nodes[2].transfer.catch_up(nodes[0].wss))
+    assert sent[resumed][1] == 3 # picked up where it stopped
+    assert nodes[2].applied == 19
+    assert list(nodes[2].state.scan()) == list(nodes[0].state.scan())
+
+def test_transfer_restarts_lost_snapshot():
+    nodes = lagging(20)
+    sent = chunks_requested(nodes[2], fail_at=3)
+    run(nodes[2].transfer.catch_up(nodes[0].wss))
+    nodes[0].transfer.snapshots.clear() # expired on the peer
+    nodes[0].state.db.put('k00', 'changed') # a newer snapshot sees this
+    run(nodes[2].transfer.catch_up(nodes[0].wss))
+    assert nodes[2].applied == 19
+    assert nodes[2].state.read('k00') == 'changed'
+    assert list(nodes[2].state.scan()) == list(nodes[0].state.scan())
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import os
+import tempfile
+import threading
+
+from BPCon.wal import WriteAheadLog, segment_files
+
+def wal(sync_delay=0.001):
+    return WriteAheadLog(os.path.join(tempfile.mkdtemp(), "data", "bpcon.wal"), logging.getLogger(), sync_delay)
+
+def setup_function(function):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+def test_replay():
+    w = wal()
+    w.append(0, "P,a,1")
+    w.append(1, b"P,b,\xc3\xa4")
+    w.append(1, "P,b,2") # a later vote for the ballot
+    w.close()
+    assert WriteAheadLog(w.path, w.log).replay() == [(0, b"P,a,1"), (1, b"P,b,\xc3\xa4"), (1, b"P,b,2")]
+
+def test_torn_tail():
+    w = wal()
+    w.append(0, "P,a,1")
+    w.append(1, "P,b,2")
+    w.close()
+    size = os.path.getsize(w.path)
+    with open(w.path, 'r+b') as fh:
+        fh.truncate(size - 2) # crashed mid-record
+    w = WriteAheadLog(w.path, w.log)
+    assert w.replay() == [(0, b"P,a,1")]
+    w.append(2, "P,c,3")
+    w.close()
+    assert WriteAheadLog(w.path, w.log).replay() == [(0, b"P,a,1"), (2, b"P,c,3")]
+
+def test_bad_checksum():
+    w = wal()
+    for b in range(3):
+        w.append(b, "P,k,{}".format(b))
+    w.close()
+    with open(w.path, 'r+b') as fh:
+        data = fh.read()
+        fh.seek(data.index(b"P,k,1"))
+        fh.write(b"X")
+    assert WriteAheadLog(w.path, w.log).replay() == [(0, b"P,k,0")] # nothing after a bad record
+
+def test_truncate():
+    w = wal()
+    for b in range(5):
+        w.append(b, "P,k,{}".format(b))
+    w.truncate(2) # kept, 3 and 4 are not covered
+    w.append(5, "P,k,5")
+    assert [b for b, _ in w.replay() if b > 2] == [3, 4, 5]
+    w.truncate(4)
+    assert [b for b, _ in w.replay()] == [5]
+    w.append(6, "P,k,6")
+    w.close()
+    w = WriteAheadLog(w.path, w.log)
+    assert [b for b, _ in w.replay()] == [5, 6]
+    w.truncate(6)
+    assert w.replay() == [] and [seq for seq, _ in segment_files(w.path)] == [3]
+
+def test_group_commit(monkeypatch):
+    fsyncs = []
+    real = os.fsync
+    monkeypatch.setattr(os, 'fsync', lambda fd: fsyncs.append(fd) or real(fd))
+    w = wal(sync_delay=0.01)
+    syncs = []
+    for b in range(5):
+        w.append(b, "P,k,v")
+        syncs.append(w.sync())
+    asyncio.get_event_loop().run_until_complete(asyncio.gather(*syncs))
+    assert len(fsyncs) == 1 # one fsync for the five ballots
+    w.append(5, "P,k,v")
+    asyncio.get_event_loop().run_until_complete(w.sync())
+    assert len(fsyncs) == 2
+
+def test_truncate_during_sync(monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    real = os.fsync
+    def slow_fsync(fd):
+        started.set()
+        release.wait(5)
+        real(fd)
+    monkeypatch.setattr(os, 'fsync', slow_fsync)
+    w = wal()
+    w.append(1, "P,a,1")
+    w.append(2, "P,b,2")
+
+    @asyncio.coroutine
+    def truncate_while_syncing():
+        sync = asyncio.ensure_future(w.sync())
+        while not started.is_set():
+            yield from asyncio.sleep(0.001)
+        w.truncate(1) # moves appends to a new segment under the running fsync
+        w.append(3, "P,c,3")
+        release.set()
+        return (yield from sync)
+
+    assert asyncio.get_event_loop().run_until_complete(truncate_while_syncing()) is None
+    synced = w.sync()
+    asyncio.get_event_loop().run_until_complete(synced)
+    assert w.unsynced == {}
+    w.truncate(2)
+    assert w.replay() == [(3, b"P,c,3")]
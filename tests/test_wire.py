@@ -0,0 +1,27 @@
+from BPCon import wire
+
+def test_roundtrip():
+    frame = wire.encode("1a", [1.5, 42, "P,k,v", b'\x00\xff'])
+    assert wire.is_binary(frame)
+    msg_type, fields = wire.decode(frame)
+    assert msg_type == "1a"
+    assert wire.to_float(fields[0]) == 1.5
+    assert wire.to_int(fields[1]) == 42
+    assert wire.to_str(fields[2]) == "P,k,v"
+    assert bytes(fields[3]) == b'\x00\xff'
+
+def test_split_signed():
+    body = wire.encode("1b", [7, "x"], count=3)
+    frame = body + wire.pack_fields([b'sig'])
+    signed, sig = wire.split_signed(frame)
+    assert bytes(signed) == body
+    assert bytes(sig) == b'sig'
+
+def test_malformed():
+    frame = wire.encode("2b", [1.0, 3])
+    for bad in (frame[:-1], frame + b'x', b'1a&1&2'):
+        try:
+            wire.decode(bad)
+            assert False
+        except ValueError:
+            pass
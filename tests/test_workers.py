@@ -0,0 +1,32 @@
+import asyncio
+import threading
+
+from BPCon.workers import WorkerPool, CONSENSUS, CODEC, BACKGROUND
+
+def run(pool, *futures):
+    loop = asyncio.get_event_loop()
+    try:
+        return loop.run_until_complete(asyncio.gather(*futures))
+    finally:
+        pool.shutdown()
+
+def test_priority_order():
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    pool = WorkerPool(1)
+    gate = threading.Event()
+    order = []
+    busy = pool.submit(CODEC, gate.wait)
+    codec = pool.submit(CODEC, order.append, 'codec')
+    consensus = pool.submit(CONSENSUS, order.append, 'consensus')
+    assert len(pool.queue) == 2 # one worker, taken by busy
+    gate.set()
+    run(pool, busy, codec, consensus)
+    assert order == ['consensus', 'codec']
+
+def test_background_bypasses_queue():
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    pool = WorkerPool(1)
+    gate = threading.Event()
+    busy = pool.submit(CONSENSUS, gate.wait)
+    snapshot = pool.submit(BACKGROUND, gate.set) # would deadlock if queued behind busy
+    assert run(pool, busy, snapshot) == [True, None]